@@ -0,0 +1,62 @@
+import time
+from xnat_inventory import get_result_rows
+
+# Wait for sessions sent to the import service to show up in the archive.
+# Rather than sleeping for a fixed time, poll the subject's experiment
+# listing with exponential backoff and hand back each session as soon
+# as it is archived. The prearchive is checked as well so a session
+# that has failed there (conflict, error) is not waited on forever.
+
+prearchive_failed = ("ERROR", "CONFLICT")
+
+
+def archived_labels(xnat_session, project, subject_label):
+    experiment_rows = get_result_rows(
+        xnat_session,
+        f"/data/projects/{project}/subjects/{subject_label}/experiments",
+        {"columns": "ID,label"})
+    return(set(row["label"] for row in experiment_rows))
+
+
+def failed_prearchive_labels(xnat_session, project, subject_label):
+    prearchive_rows = get_result_rows(
+        xnat_session,
+        f"/data/prearchive/projects/{project}",
+        {"format": "json"})
+    failed = {}
+    for row in prearchive_rows:
+        if row.get("subject") == subject_label and \
+                row.get("status") in prearchive_failed:
+            failed[row.get("name")] = row.get("status")
+    return(failed)
+
+
+def wait_for_sessions(xnat_session, project, subject_label, session_labels,
+                      timeout=600, first_delay=1, max_delay=30):
+    """
+    Yield each of session_labels once it is in the archive.
+    Polls straight away, then backs off doubling the delay up to
+    max_delay seconds. Gives up on anything left after timeout seconds.
+    """
+    pending = set(session_labels)
+    delay = first_delay
+    deadline = time.monotonic() + timeout
+    while pending:
+        ready = pending & archived_labels(xnat_session, project, subject_label)
+        for session_label in sorted(ready):
+            yield session_label
+        pending = pending - ready
+        if not pending:
+            break
+        failed = failed_prearchive_labels(xnat_session, project, subject_label)
+        for session_label in sorted(pending & set(failed)):
+            print(f"[WARNING] {session_label} is {failed[session_label]} in the prearchive, not waiting for it")
+        pending = pending - set(failed)
+        if not pending:
+            break
+        if time.monotonic() + delay > deadline:
+            print(f"[WARNING] Gave up waiting for {sorted(pending)} to archive")
+            break
+        print(f"Waiting {delay}s for {len(pending)} sessions to archive")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
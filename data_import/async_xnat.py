@@ -0,0 +1,207 @@
+import asyncio
+import netrc
+import time
+from urllib.parse import urlsplit
+from run_metrics import metrics
+from file_digest import HashingReader, local_digests
+
+# httpx is only needed for the async transport
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# asyncio transport for the parts of the XNAT REST API the importers use:
+# creating subjects, sessions, scans and resources with their fields,
+# file uploads, the import service and JSON listings. One pooled
+# keep-alive client is shared by every task, and a semaphore caps the
+# requests in flight to the host, so one process can keep hundreds of
+# uploads going without a thread for each.
+# Credentials come from ~/.netrc, the same as xnat.connect. They are
+# only sent to log in; every other request carries the JSESSIONID
+# cookie, and one that gets a 401 logs in again and is sent once more,
+# as xnat_sessions does for the threaded transport.
+
+upload_chunk_size = 1024 * 1024
+login_path = '/data/JSESSION'
+
+
+def netrc_auth(host):
+    try:
+        auth = netrc.netrc().authenticators(urlsplit(host).hostname)
+    except (OSError, netrc.NetrcParseError):
+        return None
+    if auth is None:
+        return None
+    return((auth[0], auth[2]))
+
+
+class AsyncXnatSession:
+    def __init__(self, host, max_in_flight=100, max_connections=None,
+                 timeout=600, auth=None, cookies=None):
+        """
+        Session against one XNAT host, used as an async context manager.
+        max_in_flight requests run at once, over at most max_connections
+        pooled connections (max_in_flight by default). Given the cookies
+        of a session that is already logged in, it uses that login
+        rather than making its own.
+        """
+        if httpx is None:
+            raise ImportError("The async transport needs httpx (pip install httpx)")
+        self.host = host.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.max_connections = max_connections or max_in_flight
+        self.timeout = timeout
+        self.auth = auth if auth is not None else netrc_auth(host)
+        self.cookies = cookies
+        self.client = None
+        self.in_flight = None
+        self.login_lock = None
+        # Whether the JSESSIONID in use came from our own login
+        self.own_login = False
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        self.client = httpx.AsyncClient(base_url=self.host,
+                                        limits=limits,
+                                        timeout=self.timeout,
+                                        cookies=self.cookies)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.login_lock = asyncio.Lock()
+        # Log in once. The JSESSIONID cookie is then sent on every
+        # request so the server does not check the password each time
+        if not self.cookies:
+            await self.login()
+        return(self)
+
+    async def __aexit__(self, *exc_info):
+        # A borrowed login belongs to the session it came from
+        if self.own_login:
+            try:
+                await self.client.delete(login_path)
+            except httpx.HTTPError:
+                pass
+        await self.client.aclose()
+
+    def session_cookie(self):
+        # The server's Set-Cookie and borrowed cookies can sit side by
+        # side in the jar, so take the last rather than cookies.get()
+        jsession_ids = [x.value for x in self.client.cookies.jar
+                        if x.name == 'JSESSIONID']
+        return(jsession_ids[-1] if jsession_ids else None)
+
+    async def login(self):
+        # The only request with the password on it
+        self.client.cookies.clear()
+        await self.send('POST', login_path, auth=self.auth)
+        self.own_login = True
+
+    async def send(self, method, path, query=None, content=None,
+                   headers=None, bytes_sent=0, auth=None):
+        # content can be a function returning the body, so that a
+        # streamed body can be made again for a retry
+        if callable(content):
+            content = content()
+        async with self.in_flight:
+            request_start = time.perf_counter()
+            response = await self.client.request(method, path,
+                                                 params=query,
+                                                 content=content,
+                                                 headers=headers,
+                                                 auth=auth)
+        metrics.record_request(method, path,
+                               time.perf_counter() - request_start,
+                               bytes_sent, len(response.content))
+        return(response)
+
+    async def request(self, method, path, query=None, content=None,
+                      headers=None, bytes_sent=0):
+        sent_cookie = self.session_cookie()
+        response = await self.send(method, path, query, content,
+                                   headers, bytes_sent)
+        if response.status_code == 401 and self.auth is not None:
+            async with self.login_lock:
+                # Other tasks may have logged in while this one was out
+                if self.session_cookie() == sent_cookie:
+                    print(f"[WARNING] Session on {self.host} has expired, logging in again")
+                    metrics.count('relogins')
+                    await self.login()
+            response = await self.send(method, path, query, content,
+                                       headers, bytes_sent)
+        response.raise_for_status()
+        return(response)
+
+    async def get_json(self, path, query=None):
+        response = await self.request('GET', path, query)
+        return(response.json())
+
+    async def result_rows(self, path, query=None):
+        response_json = await self.get_json(path, query)
+        return(response_json["ResultSet"]["Result"])
+
+    async def put(self, path, query=None):
+        response = await self.request('PUT', path, query)
+        return(response.text.strip())
+
+    async def put_object(self, path, xsi_type, values):
+        # Same single-request create as importer_core.put_object
+        query = {'xsiType': xsi_type, 'req_format': 'qs'}
+        query.update(values)
+        return(await self.put(path, query))
+
+    async def upload_file(self, path, src_file, query=None,
+                          content_type='application/octet-stream'):
+        """
+        Stream src_file to path. The file is read in chunks off the
+        event loop and hashed on the way, and the digests are cached.
+        """
+        n_bytes = src_file.stat().st_size
+        with open(src_file, 'rb') as src_stream:
+            reader = HashingReader(src_stream, n_bytes)
+
+            async def chunks():
+                # From the start each time, which restarts the hashes
+                reader.seek(0)
+                while True:
+                    chunk = await asyncio.to_thread(reader.read, upload_chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+            await self.request('PUT', path, query, chunks,
+                               {'Content-Type': content_type,
+                                'Content-Length': str(n_bytes)},
+                               n_bytes)
+        local_digests.store(src_file, *reader.digests())
+
+    async def upload_stream(self, path, stream, query=None,
+                            content_type='application/zip', method='PUT'):
+        # An already open file or spooled zip, sent from the start
+        stream.seek(0, 2)
+        n_bytes = stream.tell()
+
+        async def chunks():
+            stream.seek(0)
+            while True:
+                chunk = await asyncio.to_thread(stream.read, upload_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+        response = await self.request(method, path, query, chunks,
+                                      {'Content-Type': content_type,
+                                       'Content-Length': str(n_bytes)},
+                                      n_bytes)
+        return(response.text.strip())
+
+    async def import_zip(self, zip_stream, project, subject, session):
+        # The import service, as import_adni.import_dcm_zip uses it
+        import_query = {
+            'project': project,
+            'subject': subject,
+            'session': session,
+            'inbody': 'true',
+        }
+        return(await self.upload_stream('/data/services/import', zip_stream,
+                                        import_query, method='POST'))
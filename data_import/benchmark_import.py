@@ -0,0 +1,242 @@
+import argparse
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+from mock_xnat import start_server
+import synthetic_data
+
+# Measure an importer end to end against mock_xnat.py.
+# Makes synthetic data, starts the mock server, runs the importer in
+# a child process with its XNAT host globals pointed at the mock
+# and reports files/s, MB/s, REST calls per scan and peak RSS.
+# Each run can be appended to a CSV to track throughput over time.
+
+script_dir = Path(__file__).resolve().parent
+
+# Module and the globals holding server URLs for each importer
+importers = {
+    "wrap": ("import_wrap", ["xnat_host"]),
+    "a4": ("import_a4learn", ["xnat_host"]),
+    "adni": ("import_adni", ["xnat_host"]),
+    "dian": ("import_dian", ["notepad_uri", "cnda_uri"]),
+}
+
+# Run inside the child: repoint the host globals then call main()
+child_code = """
+import importlib, sys
+module = importlib.import_module(sys.argv[1])
+for host_global in sys.argv[3].split(','):
+    setattr(module, host_global, sys.argv[2])
+sys.argv = [sys.argv[1] + '.py'] + sys.argv[4:]
+module.main()
+"""
+
+
+def importer_args(cohort, paths, work_dir):
+    if cohort in ("wrap", "a4"):
+        return(["--in_path", str(paths["in_path"])])
+    if cohort == "adni":
+        return(["--batch_root", str(paths["batch_root"]),
+                "--mr_study", str(paths["mr_study"]),
+                "--mr_image", str(paths["mr_image"]),
+                "--pet_study", str(paths["pet_study"]),
+                "--pet_image", str(paths["pet_image"])])
+    return(["--mr_sessions", str(work_dir / 'mr_sessions.csv'),
+            "--pet_sessions", str(work_dir / 'pet_sessions.csv'),
+            "--staging_dir", str(work_dir / 'staging')])
+
+
+def data_size(paths):
+    # Files and bytes the importer has to send
+    n_files = 0
+    n_bytes = 0
+    for path in paths.values():
+        path = Path(path)
+        if not path.is_dir():
+            continue
+        for f in path.rglob('*'):
+            if f.is_file() and f.suffix in ('.dcm', '.gz', '.json'):
+                n_files = n_files + 1
+                n_bytes = n_bytes + f.stat().st_size
+    return(n_files, n_bytes)
+
+
+def get_stats(server_url, reset=False):
+    method = 'POST' if reset else 'GET'
+    uri = '/benchmark/reset' if reset else '/benchmark/stats'
+    request = urllib.request.Request(server_url + uri, data=b'' if reset else None,
+                                     method=method)
+    with urllib.request.urlopen(request) as response:
+        return(json.load(response))
+
+
+def write_netrc(home_dir, server_url):
+    # xnatpy finds credentials for host:port in ~/.netrc, httpx for the host
+    netloc = server_url.split('//')[-1]
+    host = netloc.split(':')[0]
+    netrc_path = Path(home_dir) / '.netrc'
+    netrc_path.write_text(f"machine {netloc} login benchmark password benchmark\n"
+                          f"machine {host} login benchmark password benchmark\n")
+    netrc_path.chmod(0o600)
+
+
+def git_commit():
+    try:
+        return(subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=script_dir, capture_output=True,
+                              text=True).stdout.strip())
+    except OSError:
+        return("")
+
+
+def run_benchmark(args, work_dir):
+    work_dir = Path(work_dir)
+    data_dir = work_dir / 'data'
+    image_bytes = args.image_kb * 1024
+    print(f"Making {args.cohort} data for {args.subjects} subjects in {data_dir}")
+    paths = synthetic_data.cohort_makers[args.cohort](
+        data_dir, args.subjects, args.sessions,
+        image_bytes=image_bytes, seed=args.seed)
+    n_files, n_bytes = data_size(paths)
+
+    bandwidth = args.bandwidth_mbps * 1e6 / 8 if args.bandwidth_mbps > 0 else None
+    server, server_url = start_server(latency=args.latency_ms / 1000,
+                                      bandwidth=bandwidth,
+                                      schema_dir=args.schema_dir,
+                                      archive_delay=args.archive_delay,
+                                      seed_path=paths.get("seed"))
+    home_dir = work_dir / 'home'
+    home_dir.mkdir(parents=True, exist_ok=True)
+    write_netrc(home_dir, server_url)
+    env = dict(os.environ, HOME=str(home_dir))
+
+    module_name, host_globals = importers[args.cohort]
+    command = [sys.executable, '-c', child_code, module_name, server_url,
+               ','.join(host_globals)]
+    command = command + importer_args(args.cohort, paths, work_dir)
+    command = command + args.importer_args.split()
+    log_path = work_dir / f'{args.cohort}.log'
+    print(f"Running {module_name} against {server_url}, log in {log_path}")
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        result = subprocess.run(command, cwd=script_dir, env=env,
+                                stdout=log_file, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    # Only the importer has been waited for, so this is its peak
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    stats = get_stats(server_url)
+    server.shutdown()
+
+    # Files sent one by one to resources plus those inside import zips
+    files_sent = stats["files_uploaded"] + stats["files_imported"]
+    scans = max(stats["scans_created"], 1)
+    return({
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "cohort": args.cohort,
+        "subjects": args.subjects,
+        "sessions": args.sessions,
+        "image_kb": args.image_kb,
+        "latency_ms": args.latency_ms,
+        "bandwidth_mbps": args.bandwidth_mbps,
+        "importer_args": args.importer_args,
+        "exit_code": result.returncode,
+        "seconds": round(elapsed, 2),
+        "local_files": n_files,
+        "local_mb": round(n_bytes / 1e6, 1),
+        "files_sent": files_sent,
+        "sessions_imported": stats["sessions_imported"],
+        "scans_created": stats["scans_created"],
+        "rest_calls": stats["total_calls"],
+        "files_per_s": round(files_sent / elapsed, 2),
+        "mb_per_s": round(stats["bytes_in"] / 1e6 / elapsed, 2),
+        "calls_per_scan": round(stats["total_calls"] / scans, 2),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "calls": stats["calls"],
+        "unmatched": stats["unmatched"],
+    })
+
+
+def print_report(report):
+    print(f"{report['cohort']}: exit code {report['exit_code']} after {report['seconds']}s")
+    print(f"  {report['files_per_s']} files/s, {report['mb_per_s']} MB/s")
+    print(f"  {report['rest_calls']} REST calls, {report['calls_per_scan']} per scan "
+          f"({report['scans_created']} scans, {report['sessions_imported']} sessions imported)")
+    print(f"  Peak RSS {report['peak_rss_mb']} MB")
+    for key, count in sorted(report['calls'].items(), key=lambda x: -x[1]):
+        print(f"  {count:6d}  {key}")
+    if report['unmatched']:
+        print("  Calls the mock server could not answer:")
+        for key, count in report['unmatched'].items():
+            print(f"  {count:6d}  {key}")
+
+
+def save_report(report, results_path):
+    results_path = Path(results_path)
+    row = {k: v for k, v in report.items() if k not in ('calls', 'unmatched')}
+    write_header = not results_path.exists()
+    with open(results_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(row))
+        if write_header:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark an importer against a mock XNAT server')
+    parser.add_argument('--cohort', type=str, required=True,
+                        choices=sorted(importers),
+                        help='Which importer to run')
+    parser.add_argument('--subjects', type=int, default=10,
+                        help='Number of synthetic subjects')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='Number of visits per subject')
+    parser.add_argument('--image_kb', type=int, default=1024,
+                        help='Size of each NIfTI (or each DIAN file)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the synthetic data')
+    parser.add_argument('--latency_ms', type=float, default=20,
+                        help='Delay the mock server adds to every request')
+    parser.add_argument('--bandwidth_mbps', type=float, default=1000,
+                        help='Mock server bandwidth in megabits per second. 0 is unlimited')
+    parser.add_argument('--archive_delay', type=float, default=2,
+                        help='Seconds before an imported session is archived on the mock server')
+    parser.add_argument('--schema_dir', type=str, default=None,
+                        help='Directory of XNAT .xsd files for xnatpy. Default is the cut down schema in mock_schemas')
+    parser.add_argument('--importer_args', type=str, default='',
+                        help='Extra arguments for the importer, e.g. "--workers 4"')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Where to put data and logs. Default is a temporary directory that is removed')
+    parser.add_argument('--results', type=str, default=None,
+                        help='CSV file to append the results to')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args()
+
+    if args.work_dir is None:
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir:
+            report = run_benchmark(args, work_dir)
+    else:
+        report = run_benchmark(args, args.work_dir)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.results is not None:
+        save_report(report, args.results)
+    if report['exit_code'] != 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import pytest
+import xnat
+from mock_xnat import start_server
+
+# The tests run against mock_xnat.py, started fresh for each test
+
+
+@pytest.fixture
+def xnat_session():
+    server, server_url = start_server()
+    session = xnat.connect(server_url, user='test', password='test',
+                           loglevel='ERROR')
+    yield session
+    session.disconnect()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+import pydicom as dcm
+
+# Cache of the few DICOM header fields the ADNI import needs.
+# Headers are read without pixel data and only for these tags,
+# and kept per file (path, size, mtime) in SQLite so later stages
+# and reruns never have to open the file again.
+
+header_tags = ['StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber']
+
+DicomHeader = namedtuple("DicomHeader",
+                         ["study_uid", "series_uid", "series_number"])
+
+index_schema = """
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    study_uid TEXT,
+    series_uid TEXT,
+    series_number TEXT
+);
+"""
+
+
+def read_dicom_header(dcm_path):
+    ds = dcm.dcmread(dcm_path,
+                     stop_before_pixels=True,
+                     specific_tags=header_tags)
+    # SeriesNumber is optional, and can be there but empty
+    series_number = ds.get('SeriesNumber')
+    if series_number is not None and str(series_number) != '':
+        series_number = str(series_number)
+    else:
+        series_number = None
+    return DicomHeader(str(ds.get('StudyInstanceUID', '')),
+                       str(ds.get('SeriesInstanceUID', '')),
+                       series_number)
+
+
+class DicomHeaderIndex:
+    def __init__(self, db_path=None):
+        # Without a path the cache only lasts for this run
+        if db_path is None:
+            db_path = ':memory:'
+        else:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(index_schema)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def lookup(self, dcm_path, stat):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, study_uid, series_uid, series_number "
+                "FROM headers WHERE path = ?",
+                (str(dcm_path),)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return DicomHeader(row[2], row[3], row[4])
+
+    def store(self, rows):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?,?,?,?,?,?)",
+                rows)
+
+    def get(self, dcm_path):
+        return self.index_files([dcm_path])[Path(dcm_path)]
+
+    def index_files(self, dcm_list):
+        """
+        Return a dict of path -> DicomHeader for every file,
+        reading headers only for files not already in the cache
+        """
+        headers = {}
+        new_rows = []
+        for dcm_path in dcm_list:
+            dcm_path = Path(dcm_path)
+            stat = dcm_path.stat()
+            header = self.lookup(dcm_path, stat)
+            if header is None:
+                header = read_dicom_header(dcm_path)
+                new_rows.append((str(dcm_path), stat.st_size,
+                                 stat.st_mtime_ns) + tuple(header))
+            headers[dcm_path] = header
+        if new_rows:
+            self.store(new_rows)
+        return(headers)
@@ -0,0 +1,156 @@
+import hashlib
+import io
+import sqlite3
+import threading
+from pathlib import Path
+
+# Checksums of local files, worked out once and remembered.
+# XNAT keeps an MD5 for each file in a resource catalog, so uploads
+# hash what they send as it is streamed (HashingReader) and compare
+# with the catalog afterwards. Digests are cached by inode, and only
+# trusted while the size and modification time are unchanged, so
+# checking a whole project again only reads files that have changed.
+# The importers share the module level local_digests object, which is
+# kept in memory unless it is opened on a file.
+
+digest_schema = """
+CREATE TABLE IF NOT EXISTS digests (
+    device INTEGER,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    md5 TEXT,
+    sha256 TEXT,
+    PRIMARY KEY (device, inode)
+);
+"""
+
+hash_chunk_size = 1024 * 1024
+
+
+class HashingReader(io.RawIOBase):
+    # Raw stream over an open file that hashes the bytes as they are
+    # read, so the upload and the checksum share one pass over the file.
+    # It can be rewound, e.g. by requests or xnatpy before sending the
+    # body again, which starts the hashes over. Seeking anywhere else
+    # would leave bytes out of the hashes, so is not allowed
+    def __init__(self, stream, n_bytes):
+        super().__init__()
+        self.stream = stream
+        self.n_bytes = n_bytes
+        self.restart()
+
+    def restart(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+
+    def readable(self):
+        return(True)
+
+    def seekable(self):
+        return(True)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR and offset == 0:
+            return(self.position)
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("HashingReader can only seek to the start")
+        self.stream.seek(0)
+        self.restart()
+        return(0)
+
+    def tell(self):
+        return(self.position)
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.md5.update(chunk)
+        self.sha256.update(chunk)
+        self.position = self.position + len(chunk)
+        return(chunk)
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return(len(chunk))
+
+    def __iter__(self):
+        return(iter(lambda: self.read(hash_chunk_size), b''))
+
+    def __len__(self):
+        # requests sends a Content-Length rather than chunking
+        return(self.n_bytes)
+
+    def digests(self):
+        return(self.md5.hexdigest(), self.sha256.hexdigest())
+
+
+def hash_file(file_path):
+    with open(file_path, 'rb') as f:
+        reader = HashingReader(f, 0)
+        for chunk in reader:
+            pass
+    return(reader.digests())
+
+
+class DigestCache:
+    def __init__(self, db_path=':memory:'):
+        self.lock = threading.Lock()
+        self.db = None
+        self.open(db_path)
+
+    def open(self, db_path):
+        if self.db is not None:
+            self.db.close()
+        if db_path != ':memory:':
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(digest_schema)
+
+    def lookup(self, file_path):
+        # (md5, sha256) if the file has not changed since it was hashed
+        stat = Path(file_path).stat()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT md5, sha256 FROM digests WHERE device = ? AND inode = ? "
+                "AND size = ? AND mtime_ns = ?",
+                (stat.st_dev, stat.st_ino, stat.st_size,
+                 stat.st_mtime_ns)).fetchone()
+        return(None if row is None else tuple(row))
+
+    def store(self, file_path, md5, sha256):
+        stat = Path(file_path).stat()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?,?,?,?,?,?)",
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                 md5, sha256))
+
+    def digests(self, file_path):
+        # Hash only when there is nothing cached for this version of the file
+        cached = self.lookup(file_path)
+        if cached is not None:
+            return(cached)
+        md5, sha256 = hash_file(file_path)
+        self.store(file_path, md5, sha256)
+        return(md5, sha256)
+
+    def md5(self, file_path):
+        return(self.digests(file_path)[0])
+
+    def sha256(self, file_path):
+        return(self.digests(file_path)[1])
+
+
+local_digests = DigestCache()
+
+
+def matches_catalog(file_path, remote_size, remote_md5):
+    # Compare a local file with its resource catalog entry. Servers
+    # that do not keep checksums leave the MD5 empty, so fall back
+    # to the size
+    if not remote_md5:
+        return(remote_size == Path(file_path).stat().st_size)
+    return(remote_md5 == local_digests.md5(file_path))
@@ -0,0 +1,114 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# One pass over a directory tree with os.scandir, sorting every file
+# into the kinds the importers care about. The importers then ask the
+# index for files of a kind, the files in a directory, or whether a
+# sibling file is there, rather than running rglob and exists() again.
+# On a network filesystem with millions of DICOMs every walk and stat
+# is a round trip, so the tree is only listed once. The top level
+# subdirectories can be walked by a pool of threads.
+
+# File name endings and what they are
+file_kinds = [
+    ('.nii.gz', 'nifti'),
+    ('.dcm', 'dicom'),
+    ('.json', 'sidecar'),
+    ('.bval', 'bval'),
+    ('.bvec', 'bvec'),
+]
+
+
+def file_kind(file_name):
+    for suffix, kind in file_kinds:
+        if file_name.endswith(suffix):
+            return(kind)
+    return(None)
+
+
+def walk_tree(top_dir, skip_dirs=(), recursive=True):
+    # (directory, file name, kind) for every file of a known kind
+    found = []
+    pending = [str(top_dir)]
+    while pending:
+        dir_path = pending.pop()
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError as e:
+            print(f"[WARNING] Could not list {dir_path}: {e}")
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive and entry.name not in skip_dirs:
+                    pending.append(entry.path)
+                continue
+            kind = file_kind(entry.name)
+            if kind is not None:
+                found.append((dir_path, entry.name, kind))
+    return(found)
+
+
+class FileIndex:
+    def __init__(self, root, skip_dirs=(), recursive=True, workers=1):
+        """
+        Index the files under root. Directories named in skip_dirs
+        (e.g. 'uploaded') are not entered. With workers > 1 the top
+        level subdirectories are listed in parallel.
+        """
+        self.root = Path(root)
+        # Kind -> list of paths, directory -> list of paths
+        self.by_kind = {}
+        self.by_dir = {}
+        self.paths = set()
+        for dir_path, file_name, kind in self.walk(skip_dirs, recursive, workers):
+            file_path = Path(dir_path, file_name)
+            self.by_kind.setdefault(kind, []).append(file_path)
+            self.by_dir.setdefault(str(file_path.parent), []).append(file_path)
+            self.paths.add(str(file_path))
+        for file_list in self.by_kind.values():
+            file_list.sort()
+        for file_list in self.by_dir.values():
+            file_list.sort()
+
+    def walk(self, skip_dirs, recursive, workers):
+        if workers <= 1 or not recursive:
+            return(walk_tree(self.root, skip_dirs, recursive))
+        # Files at the top, then each subdirectory on its own thread
+        found = walk_tree(self.root, recursive=False)
+        top_dirs = [x.path for x in os.scandir(self.root)
+                    if x.is_dir(follow_symlinks=False) and x.name not in skip_dirs]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for sub_found in executor.map(
+                    lambda x: walk_tree(x, skip_dirs), top_dirs):
+                found.extend(sub_found)
+        return(found)
+
+    def files(self, kind):
+        return(self.by_kind.get(kind, []))
+
+    def dirs(self, kind=None):
+        # Directories holding at least one file (of this kind)
+        if kind is None:
+            return(sorted(self.by_dir))
+        return(sorted(set(str(x.parent) for x in self.files(kind))))
+
+    def dir_files(self, dir_path, kind=None):
+        dir_files = self.by_dir.get(str(dir_path), [])
+        if kind is None:
+            return(dir_files)
+        return([x for x in dir_files if file_kind(x.name) == kind])
+
+    def exists(self, file_path):
+        # Same answer as file_path.exists() when the index was made
+        return(str(file_path) in self.paths)
+
+    def group(self, kind, key_function):
+        # Files of a kind grouped by key_function(path), e.g. by subject
+        groups = {}
+        for file_path in self.files(kind):
+            groups.setdefault(key_function(file_path), []).append(file_path)
+        return(groups)
+
+    def __len__(self):
+        return(len(self.paths))
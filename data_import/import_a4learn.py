@@ -2,8 +2,17 @@ import argparse
 import sys
 from pathlib import Path
 import pandas as pd
-import json
-import xnat
+from xnat_sessions import xnat_sessions
+from upload_ledger import UploadLedger
+from xnat_inventory import ProjectInventory
+from run_metrics import metrics
+from upload_scheduler import scheduler
+from file_digest import local_digests
+from file_index import FileIndex
+from importer_core import CohortAdapter, SubjectInfo, ScanInfo, \
+    run_import, run_import_async, plan_import, run_plan, shard_scans
+from sharding import shard_spec
+from import_plan import write_plan, read_plan, plan_summary
 
 # Some helpful globals
 # Host for the xnat where data is going
@@ -30,226 +39,7 @@ race_map = {
     100: "More than one race",
 }
 
-def bids_extract(data,key,default):
-    output = default
-    if key in data:
-        output = str(data[key])
-    return(output)
-
-def create_subject(session, project, subject_label,df_subject):
-    if subject_label in project.subjects:
-        print("Subject already in project")
-        return(project.subjects[subject_label])
-    elif subject_label not in df_subject.index:
-        print("This subject ID not in main subject info spreadsheet")
-        return None
-    else:
-        print("Creating Subject")
-        df_subject_info = df_subject.loc[subject_label].squeeze()
-        in_age = df_subject_info['AGEYR']
-        in_group = df_subject_info['SUBSTUDY']
-        in_gender = df_subject_info['SEX_STR']
-        in_ethnicity = df_subject_info['ETHNIC_STR']
-        in_education = df_subject_info['EDCCNTU']
-        in_race = df_subject_info['RACE_STR']
-        in_apoe = str(df_subject_info['APOEGN'])
-        subject = session.classes.SubjectData(
-                parent=project, 
-                label=subject_label)
-            
-        if str(in_age) != "nan":
-            subject.demographics.age = in_age
-        if str(in_gender) != "nan":
-            subject.demographics.gender = in_gender
-        if str(in_ethnicity) != "nan":
-            subject.demographics.ethnicity = in_ethnicity
-        if str(in_education) != "nan":
-            subject.demographics.education=in_education if in_education <=30 else 30
-        if str(in_race) != "nan":
-            subject.demographics.race = in_race
-        if in_apoe == "nan":
-            in_apoe = "NA"
-        else:
-            in_apoe = in_apoe.replace('E','')
-            in_apoe = in_apoe.replace('/','_')
-            
-        # This command will have to happen after upgrade or via REST call 
-        var_string = {
-            "xnat:subjectData/fields/field[name=apoe]/field": in_apoe,
-            "xnat:subjectData/fields/field[name=group]/field": in_group,
-        }   
-        session.put(
-            path=f"/data/projects/{notepad_project}/subjects/{subject_label}",
-            query=var_string
-            )
-        return(subject)
-
-
-def create_experiment(session,subject,modality,
-                      experiment_label,
-                      nii_file,json_file,
-                      visit_label,days_to_random,
-                      cdr_sob = '-1',cdr_global = 'NA',mmse = '-1'):
-    resource="BIDS"
-    subject_label=subject.label
-    if experiment_label in subject.experiments:
-        print("Subject already in project")
-        if nii_file.exists():
-            # Move to uploaded path when done
-            nii_new_path = nii_file.parent / 'uploaded' / nii_file.name
-            nii_file.rename(nii_new_path)
-        else:   
-            print(f"[WARNING] Could not find file: {nii_file}")
-        if json_file.exists():
-            #Move to uploaded path when done
-            json_new_path = json_file.parent / 'uploaded' / json_file.name
-            json_file.rename(json_new_path)
-        else:
-            print(f"[WARNING] Could not find file: {json_file}")
-        
-        return(subject.experiments[experiment_label])
-    else:
-        print("Creating Session")
-        #Read in JSON
-        with open(json_file,'r') as sidecar:
-            bids_data = json.load(sidecar)
-        #Get series Number
-        series_number = bids_extract(bids_data,"SeriesNumber",3)
-        if modality == "MR":
-            series_description = bids_extract(bids_data,
-                                              "SeriesDescription",
-                                              "T1")
-            xnat_experiment = session.classes.MrSessionData(
-                parent=subject, label=experiment_label)
-            xnat_experiment.field_strength = bids_extract(bids_data,
-                                                          'MagneticFieldStrength',
-                                                          'Not specified')
-            var_string = {
-                "xnat:mrSessionData/fields/field[name=visitlabel]/field": visit_label,
-                "xnat:mrSessionData/fields/field[name=daysfromrandomisation]/field": str(days_to_random),
-                "xnat:mrSessionData/fields/field[name=mmse]/field": mmse,
-                "xnat:mrSessionData/fields/field[name=cdrsob]/field": cdr_sob,
-                "xnat:mrSessionData/fields/field[name=cdrglobal]/field": cdr_global,
-                }   
-            session.put(
-                path=f"/data/projects/{notepad_project}/subjects/{subject_label}/experiments/{experiment_label}",
-                query=var_string
-            )
-       
-
-        else:
-            series_description = bids_extract(bids_data,
-                                              "SeriesDescription",
-                                              "PET AC")
-            xnat_experiment = session.classes.PetSessionData(
-                parent=subject, label=experiment_label)
-            xnat_experiment.tracer.name = bids_extract(bids_data,
-                                                  'Radiopharmaceutical',
-                                                  'Unknown')
-            xnat_experiment.tracer.data['dose'] = bids_extract(
-                bids_data,
-                'InjectedRadioactivity',
-                '0.0'
-            )
-            var_string = {
-                "xnat:petSessionData/fields/field[name=visitlabel]/field": visit_label,
-                "xnat:petSessionData/fields/field[name=daysfromrandomization]/field": days_to_random,
-                "xnat:petSessionData/fields/field[name=mmse]/field": mmse,
-                "xnat:petSessionData/fields/field[name=cdrsob]/field": cdr_sob,
-                "xnat:petSessionData/fields/field[name=cdrglobal]/field": cdr_global,
-                }   
-            session.put(
-                path=f"/data/projects/{notepad_project}/subjects/{subject_label}/experiments/{experiment_label}",
-                query=var_string
-            )
-        # See if you can add some more important stuff here
-        # For the sessions
-        xnat_experiment.manufacturer = bids_extract(bids_data,
-                                                    'Manufacturer',
-                                                    'Unknown')
-        slice_thickness = bids_extract(bids_data,
-                                       'SliceThickness',
-                                       '0.0')
-        # If there isn't a scan we need to create one
-        # If the scan isn't in the list, we need to create one
-        xnat_scan = None
-        if xnat_experiment.scans:
-            if series_number in xnat_experiment.scans:
-                xnat_scan = xnat_experiment.scans[series_number]
-        if xnat_scan is None:
-            if modality == "MR":
-                xnat_scan = session.classes.MrScanData(
-                    parent=xnat_experiment, 
-                    id=series_number, 
-                    type=series_description, 
-                    series_description=series_description
-                    )
-                xnat_scan.parameters.te = bids_extract(bids_data,
-                                                      'EchoTime',
-                                                       '0.0')
-                xnat_scan.parameters.tr = bids_extract(bids_data,
-                                                       'RepetitionTime',
-                                                       '0.0')
-                xnat_scan.parameters.ti = bids_extract(bids_data,
-                                                       'InversionTime',
-                                                       '0.0')
-            else:
-                xnat_scan = session.classes.PetScanData(
-                    parent=xnat_experiment, 
-                    id=series_number, 
-                    type=series_description, 
-                    series_description=series_description
-                    )
-        xnat_resource = None
-        if xnat_scan.resources:
-            if resource in xnat_scan.resources:
-                xnat_resource = xnat_scan.resources[resource]
-        if xnat_resource is None:
-            xnat_resource = session.classes.ResourceCatalog(
-                parent=xnat_scan, label=resource)
-        if nii_file.exists():
-            xnat_resource.upload(str(nii_file), nii_file.name)
-            # Move to uploaded path when done
-            nii_new_path = nii_file.parent / 'uploaded' / nii_file.name
-            nii_file.rename(nii_new_path)
-        else:   
-            print(f"[WARNING] Could not find file: {nii_file}")
-        if json_file.exists():
-            xnat_resource.upload(str(json_file), json_file.name)
-            #Move to uploaded path when done
-            json_new_path = json_file.parent / 'uploaded' / json_file.name
-            json_file.rename(json_new_path)
-        else:
-            print(f"[WARNING] Could not find file: {json_file}")
-        var_string = {
-            "xnat:subjectData/fields/field[name=VisitLabel]/field": visit_label,
-            "xnat:subjectData/fields/field[name=DaysFromRandomisation]/field": days_to_random,
-            }   
-        session.put(
-            path=f"/data/projects/{notepad_project}/subjects/{subject_label}/experiments/{experiment_label}",
-            query=var_string
-        )
-
-    return(xnat_experiment)
-
-
-def main():
-    parser = argparse.ArgumentParser(
-            description='Import A4/LEARN to NOTEPAD XNAT')
-    parser.add_argument('--in_path', type=str,
-                    required=True,
-                    help='Path to data')
-    parser.add_argument("--stop", default=-1, type=int, help="Number of scans to start. Default is -1 which means do them all")
-    parser.add_argument("--start", default=0, type=int, help="session type (CT/MR)")
-    args = parser.parse_args()
-
-    in_dir=Path(args.in_path)
-    done_dir = in_dir / 'uploaded'
-    done_dir.mkdir(parents=True,exist_ok=True)
-    max_i = args.stop
-    start_i = args.start
-    i=0
-
+def load_spreadsheets(in_dir):
     # Read in key spreadsheets
     subject_info_sheet = in_dir / 'SUBJINFO.csv'
     df_subject = pd.read_csv(subject_info_sheet)
@@ -276,98 +66,219 @@ def main():
                           dtype={'VISCODE': 'str'})
     df_mmse = df_mmse.set_index(['BID','VISCODE'])
     df_mmse = df_mmse.loc[:,['MMSCORE']]
+    return(df_subject, df_visits, df_cdr, df_mmse)
+
+def parse_scan_name(json_path):
+    # The file names look pretty sensible, delineated by _
+    # First split: GROUP (A4, LEARN, SF)
+    # Secont split: modality (PET/MR)
+    # Third split: Submodality (T1 for MR, tracer for PET)
+    # Fourth split: Subject ID
+    # Fifith split: Visit Code
+    image_parts = json_path.stem.split('_')
+    subject_group = image_parts[0]
+    modality = image_parts[1]
+    submodality = image_parts[2]
+    subject_id = image_parts[3]
+    visit_id = image_parts[4]
+    return(subject_group, modality, submodality, subject_id, visit_id)
+
+class A4Adapter(CohortAdapter):
+    project = notepad_project
+
+    def __init__(self, in_dir, df_subject, df_visits, df_cdr, df_mmse):
+        self.in_dir = in_dir
+        self.df_subject = df_subject
+        self.df_visits = df_visits
+        self.df_cdr = df_cdr
+        self.df_mmse = df_mmse
+
+    def find_scans(self):
+        # The images are all at the top of in_dir
+        self.file_index = FileIndex(self.in_dir, recursive=False)
+        return(self.file_index.files('sidecar'))
+
+    def find_visit(self, subject_id, visit_id):
+        if (subject_id,visit_id) in self.df_visits.index:
+            return(self.df_visits.loc[(subject_id,visit_id)])
+        if visit_id=='999':
+            if (subject_id,'997') in self.df_visits.index:
+                return(self.df_visits.loc[(subject_id,'997')])
+            elif (subject_id,'998') in self.df_visits.index:
+                return(self.df_visits.loc[(subject_id,'998')])
+        return None
+
+    def parse_scan(self, json_path):
+        subject_group, modality, submodality, subject_id, visit_id = \
+            parse_scan_name(json_path)
+        visit_info = self.find_visit(subject_id, visit_id)
+        if visit_info is None:
+            print('Error visit info not found for:')
+            print(subject_id)
+            print(visit_id)
+            return None
+        visit_label = visit_info['VISIT']
+        days_to_random = visit_info['SVSTDTC_DAYS_T0']
+
+        cdr_sob = '-1'
+        cdr_global = 'NA'
+        mmse = '-1'
+        if (subject_id,visit_id) in self.df_cdr.index:
+            cdr_info = self.df_cdr.loc[(subject_id,visit_id)]
+            cdr_sob = cdr_info['CDSOB']
+            cdr_global = cdr_info['CDGLOBAL']
+        if (subject_id,visit_id) in self.df_mmse.index:
+            mmse_info = self.df_mmse.loc[(subject_id,visit_id)]
+            mmse = mmse_info['MMSCORE']
+
+        if modality=="PET":
+            radiopharm = submodality.replace("FBP","AV45")
+            radiopharm = submodality.replace("FTP","AV1451")
+            experiment_id = f"{subject_id}-{visit_id}-{modality}-{radiopharm}"
+            fields = {
+                "xnat:petSessionData/fields/field[name=visitlabel]/field": visit_label,
+                "xnat:petSessionData/fields/field[name=daysfromrandomization]/field": days_to_random,
+                "xnat:petSessionData/fields/field[name=mmse]/field": mmse,
+                "xnat:petSessionData/fields/field[name=cdrsob]/field": cdr_sob,
+                "xnat:petSessionData/fields/field[name=cdrglobal]/field": cdr_global,
+                }
+        else:
+            experiment_id = f"{subject_id}-{visit_id}-{modality}"
+            fields = {
+                "xnat:mrSessionData/fields/field[name=visitlabel]/field": visit_label,
+                "xnat:mrSessionData/fields/field[name=daysfromrandomisation]/field": str(days_to_random),
+                "xnat:mrSessionData/fields/field[name=mmse]/field": mmse,
+                "xnat:mrSessionData/fields/field[name=cdrsob]/field": cdr_sob,
+                "xnat:mrSessionData/fields/field[name=cdrglobal]/field": cdr_global,
+                }
+        fields["xnat:subjectData/fields/field[name=VisitLabel]/field"] = visit_label
+        fields["xnat:subjectData/fields/field[name=DaysFromRandomisation]/field"] = days_to_random
+        return(ScanInfo(subject_id, experiment_id, modality, submodality, fields))
+
+    def scan_subject(self, json_path):
+        return(parse_scan_name(json_path)[3])
+
+    def subject_info(self, subject_label):
+        if subject_label not in self.df_subject.index:
+            return None
+        df_subject_info = self.df_subject.loc[subject_label].squeeze()
+        in_education = df_subject_info['EDCCNTU']
+        if str(in_education) != "nan":
+            in_education = in_education if in_education <=30 else 30
+        in_apoe = str(df_subject_info['APOEGN'])
+        if in_apoe == "nan":
+            in_apoe = "NA"
+        else:
+            in_apoe = in_apoe.replace('E','')
+            in_apoe = in_apoe.replace('/','_')
+        demographics = {
+            'age': df_subject_info['AGEYR'],
+            'gender': df_subject_info['SEX_STR'],
+            'ethnicity': df_subject_info['ETHNIC_STR'],
+            'education': in_education,
+            'race': df_subject_info['RACE_STR'],
+        }
+        fields = {
+            "xnat:subjectData/fields/field[name=apoe]/field": in_apoe,
+            "xnat:subjectData/fields/field[name=group]/field": df_subject_info['SUBSTUDY'],
+        }
+        return(SubjectInfo(demographics, fields))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Import A4/LEARN to NOTEPAD XNAT')
+    parser.add_argument('--in_path', type=str,
+                    help='Path to data')
+    parser.add_argument("--stop", default=-1, type=int, help="Index of the last scan to import. Default is -1 which means do them all")
+    parser.add_argument("--start", default=0, type=int, help="Index of the first scan to import")
+    parser.add_argument("--shard", type=shard_spec, default=None,
+                        help="Only import the subjects in shard K of N (K/N), split by a hash of the subject ID. See shard_import.py to run every shard")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of subjects to upload at the same time. Default is 1 (one scan at a time)")
+    parser.add_argument("--async_requests", default=0, type=int,
+                        help="Upload over the asyncio transport with up to this many requests in flight instead of worker threads (needs httpx)")
+    parser.add_argument("--inflight_mb", type=int, default=512,
+                        help="Most MB of files to be uploading at once, across all workers")
+    parser.add_argument("--bundle_mb", type=int, default=16,
+                        help="Files smaller than this are zipped together into one upload per resource")
+    parser.add_argument("--digest_cache", type=str, default=None,
+                        help="SQLite file to keep checksums of local files in, so unchanged files are never hashed twice")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="SQLite file recording uploads. When given, files are left in place instead of moved to uploaded/")
+    parser.add_argument("--ledger_match_content", action="store_true",
+                        help="Treat any file whose content matches an upload as done, even under another name. Hashes every file the size of one already uploaded")
+    parser.add_argument("--plan", type=str, default=None,
+                        help="Work out the import without uploading anything and write the plan to this JSON (or .parquet) file")
+    parser.add_argument("--run_plan", type=str, default=None,
+                        help="Run a plan written by --plan instead of looking at the data")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Write stage timings and REST call counts to this JSON (or .csv) file at the end of the run")
+    parser.add_argument("--progress", action='store_true',
+                        help="Show a progress line with an ETA on stderr")
+    args = parser.parse_args()
+    if args.in_path is None and args.run_plan is None:
+        parser.error("--in_path is needed unless running a saved plan")
+    metrics.start('import_a4learn', args.metrics, args.progress)
+    scheduler.configure(max_bytes=args.inflight_mb * 1024 * 1024,
+                        small_file_bytes=args.bundle_mb * 1024 * 1024)
+    if args.digest_cache is not None:
+        local_digests.open(args.digest_cache)
+
+    ledger = None
+    if args.ledger is not None:
+        ledger = UploadLedger(args.ledger, args.ledger_match_content)
+
+    if args.run_plan is not None:
+        actions = read_plan(args.run_plan)
+        plan_summary(actions)
+        with xnat_sessions.connect(xnat_host) as xnat_session:
+            failures = run_plan(xnat_session, actions, ledger, args.workers)
+        if failures:
+            print(f"{len(failures)} subjects failed: {sorted(failures)}")
+            sys.exit(1)
+        return
+
+    in_dir=Path(args.in_path)
+    done_dir = in_dir / 'uploaded'
+    done_dir.mkdir(parents=True,exist_ok=True)
+    max_i = args.stop
+    start_i = args.start
 
-    a4_scans = in_dir.glob('*.json')
-    with xnat.connect(xnat_host) as xnat_session:
-        xnat_project = xnat_session.projects[notepad_project]
+    with metrics.span('load_spreadsheets'):
+        df_subject, df_visits, df_cdr, df_mmse = load_spreadsheets(in_dir)
 
-        for json_path in sorted(a4_scans):
-            if i < start_i:
-                i=i+1
-                continue
-            print(f"{i} - {json_path.name}")
-            json_name = str(json_path)
-            # Check to see if there is both a JSON and a GZIPPED NII        
-            nii_name = json_name.replace('.json','.nii.gz')
-            nii_path = Path(nii_name)
-            if not nii_path.exists():
-                print('This is not a complete set, the nifi file is missing')
-                continue
-            # The file names look pretty sensible, delineated by _
-            # First split: GROUP (A4, LEARN, SF)
-            # Secont split: modality (PET/MR)
-            # Third split: Submodality (T1 for MR, tracer for PET)
-            # Fourth split: Subject ID
-            # Fifith split: Visit Code
-            image_parts = json_path.stem.split('_')
-            subject_group = image_parts[0]
-            modality = image_parts[1]
-            submodality = image_parts[2]
-            subject_id = image_parts[3]
-            # Think about what imaging custom variables you want here. 
-            visit_id = image_parts[4]
-            print(f"Subject ID: {subject_id}")
-            print(f"Study Group: {subject_group}")
-            print(f"Visit ID: {visit_id}")
-            print(f"Modality: {modality}")
-            print(f"Sequence/Tracer: {submodality}")
-            visit_info = None
-            if (subject_id,visit_id) in df_visits.index:
-                visit_info = df_visits.loc[(subject_id,visit_id)]
-            elif visit_id=='999':
-                if (subject_id,'997') in df_visits.index:
-                    visit_info = df_visits.loc[(subject_id,'997')]
-                elif (subject_id,'998') in df_visits.index:
-                    visit_info = df_visits.loc[(subject_id,'998')]                
-            if visit_info is not None:
-                print(visit_info)
-                visit_label = visit_info['VISIT']
-                days_to_random = visit_info['SVSTDTC_DAYS_T0']
-            else:
-                print('Error visit info not found for:')
-                print(subject_id)
-                print(visit_id)
-                continue 
+    adapter = A4Adapter(in_dir, df_subject, df_visits, df_cdr, df_mmse)
+    with metrics.span('find_scans'):
+        scan_list = adapter.find_scans()
+    stop_i = max_i + 1 if max_i > 0 else len(scan_list)
+    scan_window = range(start_i, min(stop_i, len(scan_list)))
+    indexed_scans = [(x, scan_list[x]) for x in scan_window]
+    if args.shard is not None:
+        indexed_scans = shard_scans(adapter, indexed_scans, args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: {len(indexed_scans)} of {len(scan_window)} scans")
 
-            cdr_sob = '-1'
-            cdr_global = 'NA'
-            mmse = '-1'
-            if (subject_id,visit_id) in df_cdr.index:
-                cdr_info = df_cdr.loc[(subject_id,visit_id)]
-                cdr_sob = cdr_info['CDSOB']
-                cdr_global = cdr_info['CDGLOBAL']
-            if (subject_id,visit_id) in df_mmse.index:
-                mmse_info = df_mmse.loc[(subject_id,visit_id)]
-                mmse = mmse_info['MMSCORE']
-            
-            if modality=="PET":
-                radiopharm = submodality.replace("FBP","AV45")
-                radiopharm = submodality.replace("FTP","AV1451")
-                experiment_id = f"{subject_id}-{visit_id}-{modality}-{radiopharm}"
-            else:
-                experiment_id = f"{subject_id}-{visit_id}-{modality}"
-                
-            xnat_subject = create_subject(xnat_session,
-                                          xnat_project,
-                                          subject_id,
-                                          df_subject)
-            if xnat_subject is not None:
-                experiment = create_experiment(xnat_session,
-                                               xnat_subject,
-                                               modality,
-                                               experiment_id,
-                                               nii_path,
-                                               json_path,
-                                               visit_label,
-                                               days_to_random,
-                                               cdr_sob,
-                                               cdr_global,
-                                               mmse)
-            if i >= max_i and max_i > 0:
-                print("Hit stopping condition")
-                sys.exit(1)
-            else:
-                i=i+1
+    with xnat_sessions.connect(xnat_host) as xnat_session:
+        with metrics.span('inventory'):
+            inventory = ProjectInventory(xnat_session, notepad_project)
+        if args.plan is not None:
+            with metrics.span('plan'):
+                plan = plan_import(adapter, indexed_scans, inventory,
+                                   ledger, args.workers)
+            plan_summary(plan.actions)
+            write_plan(plan, args.plan)
+            return
+        if args.async_requests <= 0:
+            failures = run_import(xnat_session, adapter, indexed_scans,
+                                  inventory, ledger, args.workers)
+    if args.async_requests > 0:
+        failures = run_import_async(xnat_host, adapter, indexed_scans,
+                                    inventory, ledger, args.async_requests)
+    if failures:
+        print(f"{len(failures)} subjects failed: {sorted(failures)}")
+        sys.exit(1)
+    if max_i > 0 and stop_i <= len(scan_list):
+        print(f"Stopped at scan {stop_i - 1} of {len(scan_list)}")
 
         
 if __name__ == "__main__":
@@ -1,14 +1,28 @@
 import sys
 import re
-import time
 from pathlib import Path
-from zipfile import ZipFile
-import shutil
+from zipfile import ZipFile, ZipInfo
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
 import argparse
 import pandas as pd
 import pydicom as dcm
-import xnat 
 import heudiconv
+from upload_ledger import UploadLedger
+from xnat_inventory import ProjectInventory, get_result_rows
+from sheet_cache import cached_frames
+from file_index import FileIndex
+from dicom_index import DicomHeaderIndex, read_dicom_header
+from archive_wait import wait_for_sessions
+from run_metrics import metrics
+from importer_core import put_subject, get_resource, subject_values, \
+    run_plan
+from import_plan import ImportPlan, write_plan, read_plan, plan_summary
+from xnat_sessions import xnat_sessions
+from upload_scheduler import scheduler, send_stream
+from file_digest import HashingReader, local_digests
+from parallel_upload import buffered_stdout, scan_log, \
+    run_grouped
 
 # Some helpful globals
 # Host for the xnat where data is going
@@ -20,6 +34,13 @@ subject_id_pattern = re.compile(r"^\d{3}_S_\d{4,5}$")
 image_id_pattern = re.compile(r"^I\d+$")
 file_pattern = re.compile(r"^ADNI_(\d{3}_S_\d{4,5})_.*_S(\d+)_I(\d+).[dn].*")
 datetime_pattern = re.compile(r"^20\d{2}-[01]\d-[0123]\d_[012]\d_[0-5]\d_[0-5]\d")
+# Directory -> (image_id, series_id) for the files in it.
+# Only the directories of the subjects in progress are ever needed,
+# so it is emptied when it reaches parsed_dirs_limit
+parsed_dirs = {}
+parsed_dirs_limit = 10000
+# How much of a study zip to hold in memory before spilling to disk
+zip_memory_limit = 512 * 1024 * 1024
 
 # Which columns from ADNI MRI and PET spreadsheets should be kept
 mr_keep_cols = [
@@ -64,26 +85,25 @@ def extract_from_path(input_path,input_pattern):
     # Parse the path to get the subject ID and image ID
     path_parts = input_path.parts
     for p in path_parts:
-        hit = re.match(input_pattern,p)
+        hit = input_pattern.match(p)
         if hit:
             out_key = hit.group()
             return out_key
 
-def get_image_ids(in_path,path_glob,id_list):
-    file_path_list = in_path.glob(path_glob)
-    dir_path_list = set([x.parent for x in file_path_list])
+def get_image_ids(dir_path_list,id_list):
     for p in dir_path_list:
-        image_id = extract_from_path(p,image_id_pattern)
+        image_id = extract_from_path(Path(p),image_id_pattern)
         image_id = int(image_id.replace('I',''))
         if image_id not in id_list:
             id_list.append(image_id)
 
-def parse_image_filename(file_path):
-    file_info = re.match(file_pattern,file_path.name)
+def parse_image_dir(dir_path,file_name):
+    file_info = file_pattern.match(file_name)
     if file_info is None:
-        image_id = extract_from_path(file_path.parent,image_id_pattern)
+        dir_path = Path(dir_path)
+        image_id = extract_from_path(dir_path,image_id_pattern)
         image_id = int(image_id.replace('I',''))
-        scandate = extract_from_path(file_path.parent,datetime_pattern)
+        scandate = extract_from_path(dir_path,datetime_pattern)
         series_id = scandate.replace('_','')
         series_id = int(series_id.replace('-',''))
     else:
@@ -91,87 +111,123 @@ def parse_image_filename(file_path):
         series_id = int(file_info.group(2))
     return (image_id, series_id)
 
+# Every file in an I<image id> directory belongs to the same image
+# and series, so the path is only parsed once per directory
+def parse_image_filename(file_path):
+    dir_path = str(file_path.parent)
+    if dir_path in parsed_dirs:
+        return parsed_dirs[dir_path]
+    image_ids = parse_image_dir(dir_path,file_path.name)
+    if len(parsed_dirs) >= parsed_dirs_limit:
+        parsed_dirs.clear()
+    parsed_dirs[dir_path] = image_ids
+    return image_ids
+
+def parse_image_files(file_list):
+    """
+    IDs for a whole list of image files as a DataFrame with columns
+    path, image_id and series_id, in the order of file_list.
+    ADNI file names are parsed in one go, the rest once per directory.
+    """
+    df_files = pd.DataFrame({'path': list(file_list)})
+    if df_files.empty:
+        return(df_files.assign(image_id=pd.Series(dtype='int64'),
+                               series_id=pd.Series(dtype='int64')))
+    df_files['dir'] = [str(x.parent) for x in df_files['path']]
+    df_ids = pd.Series([x.name for x in df_files['path']]).str.extract(file_pattern)
+    df_files['series_id'] = pd.to_numeric(df_ids[1])
+    df_files['image_id'] = pd.to_numeric(df_ids[2])
+    unparsed = df_files['image_id'].isna()
+    for dir_path, df_dir in df_files.loc[unparsed].groupby('dir', sort=False):
+        image_id, series_id = parse_image_filename(df_dir['path'].iloc[0])
+        df_files.loc[df_dir.index, 'image_id'] = image_id
+        df_files.loc[df_dir.index, 'series_id'] = series_id
+    df_files['image_id'] = df_files['image_id'].astype('int64')
+    df_files['series_id'] = df_files['series_id'].astype('int64')
+    return(df_files.loc[:,['path','image_id','series_id']])
+
 def process_image_list(subject_id,image_list,adni_studies,
                        df_mr,df_pet,
-                       dcm_flag=True):
-    current_image_id = None
-    df_session = None
-    adni_info={}
-    for f in image_list:
-        image_id, series_id = parse_image_filename(f)
-        # To avoid reading in the spreadsheet for every file
-        # Just change it when a new image pops up
-        if image_id != current_image_id:
-            # Grab releant info from image spreadsheets
-            modality=""
-            xnat_session_label = None
-            if image_id in df_mr.index:
-                df_session = df_mr.loc[image_id].squeeze()
-                modality = "MR"
-            elif image_id in df_pet.index:
-                df_session = df_pet.loc[image_id].squeeze()
-                radiopharm = df_session['pet_radiopharm'].replace('18F-','')
-                modality = f"PET-{radiopharm}"
-            else:
-                print(f'WARNING: Could not find {image_id} in the spreadsheets')
-                print('Skipping this session for now')
-                continue
-            # Make a dict to store the relevant information
-            # So it is to hand for the next image
-            # if it is from the same image ID
-            adni_info['image_id'] = image_id
-            adni_info['series_id'] = series_id
-            adni_info['visit_id'] = df_session['visit']
-            adni_info['study_id'] = int(df_session['study_id'])
-            adni_info['image_date'] = df_session['image_date']
-            image_description = df_session['image_description']
-            image_description = image_description.replace(';','_')
-            image_description = image_description.replace(' ','_')
-            adni_info['image_description'] = image_description
-            adni_info['session_label'] = f"{subject_id}-{adni_info['visit_id']}-{modality}"
-            current_image_id = image_id
+                       dcm_flag=True,
+                       header_index=None):
+    # Files are parsed together then handled an image at a time,
+    # so the spreadsheets and the study tree are only touched
+    # once for each image rather than for each file
+    df_files = parse_image_files(image_list)
+    for image_id, df_image in df_files.groupby('image_id', sort=False):
+        image_id = int(image_id)
+        image_files = list(df_image['path'])
+        # The series comes from the first file of the image
+        series_id = int(df_image['series_id'].iloc[0])
+        # Grab releant info from image spreadsheets
+        modality=""
+        if image_id in df_mr.index:
+            df_session = df_mr.loc[image_id].squeeze()
+            modality = "MR"
+        elif image_id in df_pet.index:
+            df_session = df_pet.loc[image_id].squeeze()
+            radiopharm = df_session['pet_radiopharm'].replace('18F-','')
+            modality = f"PET-{radiopharm}"
+        else:
+            print(f'WARNING: Could not find {image_id} in the spreadsheets')
+            print('Skipping this session for now')
+            continue
+        visit_id = df_session['visit']
+        study_id = int(df_session['study_id'])
+        image_description = df_session['image_description']
+        image_description = image_description.replace(';','_')
+        image_description = image_description.replace(' ','_')
         # If we don't have information for this study ID
         # Add it
-        if adni_info['study_id'] not in adni_studies:
+        if study_id not in adni_studies:
             study_info = {
                 'modality': modality,
-                'visit_id': adni_info['visit_id'],
-                'image_date': adni_info['image_date'],
-                'session_id': adni_info['session_label'],
+                'visit_id': visit_id,
+                'image_date': df_session['image_date'],
+                'session_id': f"{subject_id}-{visit_id}-{modality}",
                 'series_list' : {},
             }
-            adni_studies[adni_info['study_id']] = study_info
-        series_map = adni_studies[adni_info['study_id']]['series_list']
-        if adni_info['series_id'] not in series_map:
-            xnat_scan_number = str(adni_info['series_id'])
+            adni_studies[study_id] = study_info
+        series_map = adni_studies[study_id]['series_list']
+        if series_id not in series_map:
+            xnat_scan_number = str(series_id)
             if dcm_flag:
-                with dcm.dcmread(f) as ds:
-                    if ds.SeriesNumber is not None:
-                        xnat_scan_number = str(ds.SeriesNumber)
+                if header_index is not None:
+                    header = header_index.get(image_files[0])
+                else:
+                    header = read_dicom_header(image_files[0])
+                if header.series_number is not None:
+                    xnat_scan_number = header.series_number
             series_info = {
                 'scan_number': xnat_scan_number,
                 'image_list':{},
                 }
             print(series_id)
             print(series_info['scan_number'])
-            series_map[adni_info['series_id']] = series_info
-        image_map = series_map[adni_info['series_id']]['image_list']
-        if adni_info['image_id'] not in image_map:
+            series_map[series_id] = series_info
+        image_map = series_map[series_id]['image_list']
+        if image_id not in image_map:
             image_info = {
-                'image_description': adni_info['image_description'],
+                'image_description': image_description,
                 'dcm_files': [],
                 'nii_files': [],
             }
-            image_map[adni_info['image_id']] = image_info
+            image_map[image_id] = image_info
         if dcm_flag:        
-            image_map[adni_info['image_id']]['dcm_files'].append(f)
+            image_map[image_id]['dcm_files'].extend(image_files)
         else:
-            image_map[adni_info['image_id']]['nii_files'].append(f)
-            
+            image_map[image_id]['nii_files'].extend(image_files)
+
 
 
 # This processes the study sheet of subject metadata
-def process_study_sheet(img_info):
+def process_study_sheet(img_info,cache_dir=None):
+    return(cached_frames(f'adni_study_{Path(img_info).stem}',
+                         [img_info],
+                         lambda: (read_study_sheet(img_info),),
+                         cache_dir)[0])
+
+def read_study_sheet(img_info):
     df_info = pd.read_csv(img_info)
     df_info = df_info.sort_values(by=['subject_id','visit'])
     # A bit of cleaning up on the racial category
@@ -190,10 +246,17 @@ def process_study_sheet(img_info):
     return df_info
 
 # This processes the imaging metadata sheet
-def process_image_sheet(img_study,modality):
+def process_image_sheet(img_study,modality,cache_dir=None):
+    return(cached_frames(f'adni_image_{modality}_{Path(img_study).stem}',
+                         [img_study],
+                         lambda: (read_image_sheet(img_study,modality),),
+                         cache_dir)[0])
+
+def read_image_sheet(img_study,modality):
     # Load in the MRI data - it's a lot of lot of data
-    # So first we are only going to keep a handful of columns
-    df_image = pd.read_csv(img_study,low_memory = False)
+    # So we only read in a handful of columns
+    keep_cols = mr_keep_cols if modality=='MR' else pet_keep_cols
+    df_image = pd.read_csv(img_study,usecols=keep_cols,low_memory = False)
     if (modality=='MR'):
         df_image = df_image[mr_keep_cols]
         df_image = df_image.rename(
@@ -219,58 +282,84 @@ def process_image_sheet(img_study,modality):
     df_image = df_image.sort_values(by=['subject_id','image_date'])
     return df_image
 
-def get_scan_number(dcm_file_list):
+def get_scan_number(dcm_file_list,header_index):
     scan_number_list = []
-    for f in dcm_file_list:
-        with dcm.dcmread(f) as ds:
-            if (ds.SeriesNumber is not None) and (ds.SeriesNumber not in scan_number_list):
-                scan_number_list.append(ds.SeriesNumber)
+    headers = header_index.index_files(dcm_file_list)
+    for header in headers.values():
+        if (header.series_number is not None) and (header.series_number not in scan_number_list):
+            scan_number_list.append(header.series_number)
     return scan_number_list
 
 
-def make_dcm_zip(dcm_list,study_id):
-    zip_path = Path('/tmp',f'{study_id}.zip')
+# Build the import zip for a study without temporary copies.
+# Files that need new UIDs or series numbers are patched in memory
+# and written straight into their zip entry. The zip itself stays in
+# memory up to memory_limit bytes, then spills to scratch_dir.
+# Returns the open zip file, rewound and ready to upload.
+def make_dcm_zip(dcm_list,study_id,header_index,
+                 scratch_dir=None,memory_limit=zip_memory_limit):
     study_uids = []
-    series_uids = []
     make_new_uid = False
     create_series_number=False
-    for dcm_up in dcm_list:
-        ds = dcm.dcmread(dcm_up)
-        if ds.SeriesNumber is None:
+    # Headers come from the index, so no pixel data is read here
+    headers = header_index.index_files(dcm_list)
+    for header in headers.values():
+        if header.series_number is None:
             create_series_number=True
-        study_uids.append(ds.StudyInstanceUID)
-        series_uids.append(ds.SeriesInstanceUID)
+        study_uids.append(header.study_uid)
     study_uid_set = set(study_uids)
-    series_uid_set = set(series_uids)
     if len(study_uid_set) > 1:
         print('Multiple UIDs detected')
         print(study_uid_set)
         make_new_uid=True
-    if make_new_uid or create_series_number:
-        temp_dcm_dir=Path('/tmp',f'{study_id}-temp')
-        temp_dcm_dir.mkdir(exist_ok=True,parents=True)
-        new_study_uid = dcm.uid.generate_uid()
+    new_study_uid = dcm.uid.generate_uid()
+
+    zip_stream = SpooledTemporaryFile(max_size=memory_limit,
+                                      dir=scratch_dir,
+                                      prefix=f'{study_id}-',
+                                      suffix='.zip')
+    # Each file is hashed as it is read, so the ledger records the
+    # study without reading the DICOMs again
+    with ZipFile(zip_stream,'w') as import_zip:
         for dcm_up in dcm_list:
-            adni_image_id, adni_series_id = parse_image_filename(dcm_up)
-            ds = dcm.dcmread(dcm_up)
-            if make_new_uid:
-                ds.StudyInstanceUID = new_study_uid
-            if create_series_number:
-                ds.SeriesNumber=adni_series_id
-            dcm_out = temp_dcm_dir / dcm_up.name
-            ds.save_as(dcm_out)
-      
-    with ZipFile(zip_path,'w') as import_zip:
-        if make_new_uid or create_series_number:
-            for dcm_up in temp_dcm_dir.glob('*.dcm'):
-                import_zip.write(dcm_up)
-        else:
-            for dcm_up in dcm_list:
-                import_zip.write(dcm_up)
+            arc_name = str(dcm_up).lstrip('/')
+            with open(dcm_up, 'rb') as dcm_stream:
+                reader = HashingReader(dcm_stream, Path(dcm_up).stat().st_size)
+                if make_new_uid or create_series_number:
+                    adni_image_id, adni_series_id = parse_image_filename(dcm_up)
+                    ds = dcm.dcmread(BytesIO(reader.read()))
+                    if make_new_uid:
+                        ds.StudyInstanceUID = new_study_uid
+                    if create_series_number:
+                        ds.SeriesNumber=adni_series_id
+                    # One file at a time in memory, never a temp copy on disk
+                    dcm_buffer = BytesIO()
+                    ds.save_as(dcm_buffer)
+                    import_zip.writestr(arc_name, dcm_buffer.getvalue())
+                else:
+                    with import_zip.open(ZipInfo.from_file(dcm_up, arc_name),
+                                         'w') as zip_entry:
+                        for chunk in reader:
+                            zip_entry.write(chunk)
+            local_digests.store(dcm_up, *reader.digests())
+    zip_stream.seek(0)
+    return(zip_stream)
 
-    if make_new_uid or create_series_number:
-        shutil.rmtree(temp_dcm_dir)
-    return(zip_path)
+def import_dcm_zip(xnat_session,zip_stream,subject_label,session_label):
+    # Same request as xnat_session.services.import_ makes for a zip
+    # but the body comes from the open stream rather than a path.
+    # Returns the URI of the session in the prearchive or archive
+    import_query = {
+        'project': notepad_project,
+        'subject': subject_label,
+        'session': session_label,
+        'inbody': 'true',
+    }
+    zip_stream.seek(0)
+    response = send_stream(xnat_session, '/data/services/import',
+                           zip_stream, import_query,
+                           'application/zip', method='post')
+    return(response.text.strip())
                 
 
 # Refactor: Look at a whole subject's data
@@ -291,49 +380,16 @@ def make_dcm_zip(dcm_list,study_id):
 # 3. Is there a session matching this directory? If not DICOM inbox it
 # 4. Is there BIDS for this directory? If not heudiconv it
 # For steps 3 and 4 - allow for an overwrite
-def main():
-
-    parser = argparse.ArgumentParser(
-        description='Import ADNI DICOM to NOTEPAD XNAT')
-    parser.add_argument('--in_path', type=str,
-                        required=True,
-                        help='Path to subject to upload')
-    parser.add_argument('--mr_study', type=str,
-                        required=True,
-                        help='Location of spreadsheet with study info for visits with MR data')
-    parser.add_argument('--mr_image', type=str,
-                        required=True,
-                        help='Location of spreadsheet with image info for visits with MR data')
-    parser.add_argument('--pet_study', type=str,
-                        required=True,
-                        help='Location of spreadsheet with study info for visits with PET data')
-    parser.add_argument('--pet_image', type=str,
-                        required=True,
-                        help='Location of spreadsheet with image info for visits with PET data')
-    parser.add_argument('--update',action='store_true',
-                        help='Update existing records if already on XNAT')
-    args = parser.parse_args()
-
-
-    # Parse path to get subject ID and image ID 
-    in_path = Path(args.in_path)
-    adni_subject_id = extract_from_path(in_path,subject_id_pattern)
-
-    if adni_subject_id is None:
-        print("Could not identify subject from path")
-        print(in_path)
-        sys.exit(1)
-
-
-    print(f'Subject {adni_subject_id}')    
-
+def load_adni_metadata(args):
     # Load in the data from the info sheet
-    df_mr_info = process_study_sheet(args.mr_study)
-    df_pet_info = process_study_sheet(args.pet_study)
+    df_mr_info = process_study_sheet(args.mr_study,args.cache_dir)
+    df_pet_info = process_study_sheet(args.pet_study,args.cache_dir)
 
 
-    df_mr_image = process_image_sheet(args.mr_image,modality='MR')
-    df_pet_image = process_image_sheet(args.pet_image,modality='PT')
+    df_mr_image = process_image_sheet(args.mr_image,modality='MR',
+                                      cache_dir=args.cache_dir)
+    df_pet_image = process_image_sheet(args.pet_image,modality='PT',
+                                       cache_dir=args.cache_dir)
     
     # Now merge the two
     df_mr_info = pd.merge(df_mr_info,df_mr_image,
@@ -347,7 +403,10 @@ def main():
                     right_on=['subject_id','image_visit'],
                     how='outer')
     df_pet_info = df_pet_info.set_index('image_id')
+    return(df_mr_info, df_pet_info)
 
+def adni_subject_values(adni_subject_id,df_mr_info):
+    # Demographics and fields for the subject from the MR sheet
     # Find the rows that matches the subject and scan
     df_subject = df_mr_info.loc[df_mr_info['subject_id']==adni_subject_id]
     df_subject_demog = df_subject.dropna(subset='PTDOBYY')
@@ -381,51 +440,45 @@ def main():
         print("Missing APOE Genotype")
     else:
         in_apoe = first_row['GENOTYPE'].replace("/","_")
+    demographics = {
+        'yob': in_yob,
+        'gender': in_gender,
+        'ethnicity': in_ethnicity,
+        'education': in_education,
+        'race': in_race,
+    }
+    fields = {"xnat:subjectData/fields/field[name=apoe]/field": in_apoe}
+    return(demographics, fields)
 
-    update_subject=args.update
-    with xnat.connect(xnat_host) as xnat_session:
-        # Get list of subjects for the project. 
-        xnat_project = xnat_session.projects[notepad_project]
-        xnat_subjects = xnat_project.subjects
-        # If we don't have the subject in XNAT create it
-        if adni_subject_id not in xnat_subjects:
-            # This needs key demographics
-            print(f"Creating subject {adni_subject_id}")
-            xnat_subject = xnat_session.classes.SubjectData(
-                parent=xnat_project, 
-                label=adni_subject_id)
-            update_subject=True
-        else:
-            xnat_subject = xnat_subjects[adni_subject_id]
-        # If just created or args say to update it
-        # Grab the metadata
-        if update_subject:
-            xnat_subject.demographics.yob = in_yob
-            xnat_subject.demographics.gender = in_gender
-            xnat_subject.demographics.ethnicity = in_ethnicity
-            xnat_subject.demographics.education=in_education
-            xnat_subject.demographics.race = in_race
-            # This command will have to happen after upgrade or via REST call 
-            if in_apoe is not None:
-                apoe_string = {
-                    "xnat:subjectData/fields/field[name=apoe]/field": in_apoe
-                    }   
-                xnat_session.put(
-                    path=f"/data/projects/{notepad_project}/subjects/{adni_subject_id}",
-                    query=apoe_string
-                    )
+def create_adni_subject(xnat_session,inventory,adni_subject_id,
+                        df_mr_info,update_subject):
+    # If we don't have the subject in XNAT create it
+    # with its demographics and fields in the same request.
+    # If args say to update it the same request updates it
+    if not inventory.has_subject(adni_subject_id) or update_subject:
+        print(f"Creating subject {adni_subject_id}")
+        demographics, fields = adni_subject_values(adni_subject_id,df_mr_info)
+        subject_id = put_subject(xnat_session, notepad_project,
+                                 adni_subject_id, demographics, fields)
+        inventory.add_subject(adni_subject_id, subject_id)
+    xnat_subject = inventory.subject_object(adni_subject_id)
+    return(xnat_subject)
 
+def find_subject_images(in_path,adni_subject_id,df_mr_info,df_pet_info,
+                        ledger,header_index,scan_workers=1):
     # Now we need to identify:
     # What images are DICOM and what are Nifti
     # Which ones are PET and which ones are MRI
+    # One walk of the subject directory lists both
+    file_index = FileIndex(in_path, workers=scan_workers)
     adni_image_id_list = []
-    get_image_ids(in_path=in_path, path_glob='**/*.nii.gz', id_list=adni_image_id_list)
-    get_image_ids(in_path=in_path, path_glob='**/*.dcm', id_list=adni_image_id_list)
+    get_image_ids(file_index.dirs('nifti'), adni_image_id_list)
+    get_image_ids(file_index.dirs('dicom'), adni_image_id_list)
         
     if not adni_image_id_list:
         print("Could not identify any images from paths")
         print(in_path)
-        sys.exit(1)
+        return None
 
     # So this should be a tree
     # STUDY (i.e. MR or PET session in XNAT)
@@ -437,106 +490,546 @@ def main():
 
     # Go through all of the paths and find out what needs to be added
     upload_studies = {}
+    # Files only count as done if they went to this subject
+    ledger_subject = {'project': notepad_project, 'subject': adni_subject_id}
 
-    dcm_files = in_path.glob('**/*.dcm')
+    dcm_files = file_index.files('dicom')
+    if ledger is not None:
+        dcm_files = [f for f in dcm_files
+                     if not ledger.is_done(f, ledger_subject)]
+    # One header-only pass over the DICOMs
+    # Everything after this reads UIDs and series numbers from the index
+    dcm_files = sorted(dcm_files)
+    header_index.index_files(dcm_files)
     process_image_list(adni_subject_id,dcm_files,upload_studies,
-                       df_mr_info,df_pet_info,dcm_flag=True)
+                       df_mr_info,df_pet_info,dcm_flag=True,
+                       header_index=header_index)
 
-    nii_files = in_path.glob('**/*.nii.gz')
+    nii_files = file_index.files('nifti')
+    if ledger is not None:
+        nii_files = [f for f in nii_files
+                     if not ledger.is_done(f, ledger_subject)]
     process_image_list(adni_subject_id,nii_files,upload_studies,
                        df_mr_info,df_pet_info,dcm_flag=False)
- 
-    with xnat.connect(xnat_host) as xnat_session:
-        # Get list of subjects for the project. 
-        xnat_project = xnat_session.projects[notepad_project]
-        xnat_subject = xnat_project.subjects[adni_subject_id]
-
-        xnat_img_sessions = xnat_subject.experiments
-        # Go through all of the entries in the dictionary
-        for study_id, study_info in upload_studies.items():
-            xnat_session_label = study_info['session_id']
-            print(xnat_session_label)
-            print(study_info['image_date'])
-            
-            # If a session is not present it needs to be created
-            # in part by archive_session
-            xnat_image_session=None
-            if xnat_session_label not in xnat_img_sessions:
-                print(f"New session {xnat_session_label}")
-                # Go through all of the series
-                # Collecting the DICOM to upload
-                series_map = study_info['series_list']
-                n_total_dcm = 0
-                study_dcm_list = []
-                for series_id,series_info in series_map.items():
-                    print(f"Series ID: {series_id}")
-                    image_map = series_info['image_list']
-                    for image_id, image_info in image_map.items():
-                        n_dcm = len(image_info['dcm_files'])
-                        print(f"DICOM Files: {n_dcm}")
-                        # Concatenate all study files to one list
-                        if n_dcm > 0:
-                            n_total_dcm = n_total_dcm + n_dcm
-                            study_dcm_list = study_dcm_list + image_info['dcm_files']
-                if n_total_dcm > 0:
-                    print(f"Total DICOM files: {n_total_dcm}")
-                    zip_path = make_dcm_zip(study_dcm_list,
-                                            study_id)
-                    archive_session = xnat_session.services.import_(
-                                zip_path, project=notepad_project, 
-                                subject=adni_subject_id,
-                                experiment=xnat_session_label)
-                    for f in study_dcm_list:
+    return(upload_studies)
+
+def dicom_archived(xnat_session,experiment_uri,n_sent):
+    # The import service rewrites DICOM headers, so the checksums can
+    # never match the local files. Count what was archived instead,
+    # from the catalog listing alone
+    with metrics.span('verify'):
+        file_rows = get_result_rows(
+            xnat_session,
+            f"{experiment_uri}/scans/ALL/files",
+            {"format": "json"})
+    n_archived = sum(1 for x in file_rows if x.get("collection") == "DICOM")
+    print(f"{n_archived} of {n_sent} DICOM files archived")
+    return(n_archived >= n_sent)
+
+def upload_dicom_studies(xnat_session,inventory,adni_subject_id,
+                         upload_studies,ledger,header_index,
+                         scratch_dir=None,memory_limit=zip_memory_limit):
+    # Returns the labels of the sessions sent to the import service
+    # and the DICOM files that went in each one
+    imported_sessions = {}
+    # Go through all of the entries in the dictionary
+    for study_id, study_info in upload_studies.items():
+        xnat_session_label = study_info['session_id']
+        print(xnat_session_label)
+        print(study_info['image_date'])
+        
+        # If a session is not present it needs to be created
+        # in part by import_dcm_zip
+        if not inventory.has_experiment(xnat_session_label):
+            print(f"New session {xnat_session_label}")
+            # Go through all of the series
+            # Collecting the DICOM to upload
+            series_map = study_info['series_list']
+            n_total_dcm = 0
+            study_dcm_list = []
+            for series_id,series_info in series_map.items():
+                print(f"Series ID: {series_id}")
+                image_map = series_info['image_list']
+                for image_id, image_info in image_map.items():
+                    n_dcm = len(image_info['dcm_files'])
+                    print(f"DICOM Files: {n_dcm}")
+                    # Concatenate all study files to one list
+                    if n_dcm > 0:
+                        n_total_dcm = n_total_dcm + n_dcm
+                        study_dcm_list = study_dcm_list + image_info['dcm_files']
+            if n_total_dcm > 0:
+                print(f"Total DICOM files: {n_total_dcm}")
+                with metrics.span('make_dcm_zip'):
+                    zip_stream = make_dcm_zip(study_dcm_list,
+                                              study_id,
+                                              header_index,
+                                              scratch_dir,
+                                              memory_limit)
+                with zip_stream, metrics.span('import_dcm_zip'):
+                    import_dcm_zip(xnat_session, zip_stream,
+                                   adni_subject_id,
+                                   xnat_session_label)
+                metrics.count('dicom_files', n_total_dcm)
+                imported_sessions[xnat_session_label] = study_dcm_list
+                if ledger is not None:
+                    ledger.record_many(study_dcm_list,
+                                       notepad_project,
+                                       adni_subject_id,
+                                       xnat_session_label,
+                                       resource='DICOM')
+        else:
+            print(f"Session {xnat_session_label} already archived")
+    return(imported_sessions)
+
+def attach_nifti(xnat_session,inventory,adni_subject_id,
+                 study_info,ledger):
+    xnat_session_label = study_info['session_id']
+    print(xnat_session_label)
+    print(study_info['image_date'])
+    
+    # If a session is not present it needs to be created
+    # in part by import_dcm_zip
+    if inventory.has_experiment(xnat_session_label):
+        scan_type = "xnat:mrScanData"
+        if study_info['modality'].startswith('PET'):
+            scan_type = "xnat:petScanData"
+        series_map = study_info['series_list']
+        for series_id,series_info in series_map.items():
+            print(f"Series ID: {series_id}")
+            scan_label = str(series_info['scan_number'])
+            print(scan_label)
+            if inventory.has_scan(xnat_session_label, scan_label):
+                print("Branding Series ID in scan")
+                xnat_scan = inventory.scan_object(
+                    xnat_session_label, scan_label, scan_type)
+                xnat_scan.note = f"ADNI Series {series_id}"
+            image_map = series_info['image_list']
+            for image_id, image_info in image_map.items():
+                n_nii = len(image_info['nii_files'])
+                print(f"NII Files: {n_nii}")
+                # For NIFTIs only upload when there is an established scan there
+                if n_nii > 0:
+                    # We are only uploading data where DICOM is available
+                    # So the session exists and the scan does too
+                    # All the NIfTIs of an image go to one resource
+                    # so the scheduler can send them together
+                    if inventory.has_scan(xnat_session_label, scan_label):
+                        image_description = image_info['image_description']
+                        resource_uri = get_resource(xnat_session,
+                                                    xnat_session_label,
+                                                    scan_label,
+                                                    image_description,
+                                                    inventory)
+                        print(f"Uploading Nifti to {resource_uri}")
+                        scheduler.upload(xnat_session, resource_uri,
+                                         image_info['nii_files'])
+                        metrics.count('nifti_files', n_nii)
+                        for nii in image_info['nii_files']:
+                            if ledger is not None:
+                                ledger.record(nii,
+                                              notepad_project,
+                                              adni_subject_id,
+                                              xnat_session_label,
+                                              scan_label,
+                                              image_description)
+                            else:
+                                nii.unlink()
+
+# Everything for one subject directory, over an already open connection
+# and with the inventory of the project made once for the run
+# Returns False if there was nothing that could be imported
+def import_subject(xnat_session,inventory,in_path,df_mr_info,df_pet_info,
+                   args,ledger,header_index):
+    # Parse path to get subject ID and image ID 
+    in_path = Path(in_path)
+    adni_subject_id = extract_from_path(in_path,subject_id_pattern)
+
+    if adni_subject_id is None:
+        print("Could not identify subject from path")
+        print(in_path)
+        return False
+
+    print(f'Subject {adni_subject_id}')    
+    create_adni_subject(xnat_session,inventory,adni_subject_id,
+                        df_mr_info,args.update)
+
+    with metrics.span('find_subject_images'):
+        upload_studies = find_subject_images(in_path,adni_subject_id,
+                                             df_mr_info,df_pet_info,
+                                             ledger,header_index,
+                                             args.scan_workers)
+    if upload_studies is None:
+        return False
+
+    imported_sessions = upload_dicom_studies(
+        xnat_session,inventory,adni_subject_id,
+        upload_studies,ledger,header_index,
+        args.scratch_dir,
+        args.zip_memory_mb * 1024 * 1024)
+    studies_by_label = {}
+    for study_info in upload_studies.values():
+        studies_by_label.setdefault(study_info['session_id'],[]).append(study_info)
+
+    # Sessions that were already archived can have NIFTIs straight away
+    for xnat_session_label, study_list in studies_by_label.items():
+        if xnat_session_label not in imported_sessions:
+            for study_info in study_list:
+                with metrics.span('attach_nifti'):
+                    attach_nifti(xnat_session,inventory,adni_subject_id,
+                                 study_info,ledger)
+    # The rest get them as soon as each one has archived
+    if imported_sessions:
+        print("DICOM uploaded. Waiting for sessions to archive")
+    # Time spent waiting on the archive is this minus attach_nifti
+    with metrics.span('archive_wait_and_attach'):
+        for xnat_session_label in wait_for_sessions(xnat_session,
+                                                    notepad_project,
+                                                    adni_subject_id,
+                                                    imported_sessions,
+                                                    timeout=args.archive_timeout):
+            print(f"Session {xnat_session_label} archived")
+            # Only this subject's sessions, not the whole project again
+            with metrics.span('inventory'):
+                inventory.refresh_subject(adni_subject_id)
+            # Without a ledger the DICOM is removed, but only once
+            # the archive has all of it
+            if ledger is None:
+                sent_dcm_list = imported_sessions[xnat_session_label]
+                if dicom_archived(xnat_session,
+                                  inventory.experiment_uri(xnat_session_label),
+                                  len(sent_dcm_list)):
+                    for f in sent_dcm_list:
                         f.unlink()
-            else:
-                print(f"Session {xnat_session_label} already archived")
-        # Now add NIFTIs to existing sessions
-        print("DICOM uploaded. Brief pause to let session archive")
-        time.sleep(20)
-        xnat_subject.clearcache()
-        xnat_img_sessions = xnat_subject.experiments
-        for study_id, study_info in upload_studies.items():
-            xnat_session_label = study_info['session_id']
-            print(xnat_session_label)
-            print(study_info['image_date'])
-            
-            # If a session is not present it needs to be created
-            # in part by archive_session
-            xnat_image_session=None
-            if xnat_session_label in xnat_img_sessions:
-                xnat_image_session = xnat_img_sessions[xnat_session_label]
-                series_map = study_info['series_list']
-                for series_id,series_info in series_map.items():
-                    print(f"Series ID: {series_id}")
-                    scan_label = str(series_info['scan_number'])
-                    print(scan_label)
-                    if scan_label in xnat_image_session.scans:
-                        print("Branding Series ID in scan")
-                        xnat_scan = xnat_image_session.scans[scan_label]
-                        xnat_scan.note = f"ADNI Series {series_id}"
-                    image_map = series_info['image_list']
-                    for image_id, image_info in image_map.items():
-                        n_nii = len(image_info['nii_files'])
-                        print(f"NII Files: {n_nii}")
-                        # For NIFTIs only upload when there is an established scan there
-                        if n_nii > 0:
-                            # We are only uploading data where DICOM is available
-                            # So the session exists and the scan does too
-                            for nii in image_info['nii_files']:
-                                if scan_label in xnat_image_session.scans:
-                                    xnat_scan = xnat_image_session.scans[scan_label]
-                                    image_description = image_info['image_description']
-                                    if image_description in xnat_scan.resources:
-                                        xnat_resource = xnat_scan.resources[image_description]
-                                    else:
-                                        xnat_resource = xnat_session.classes.ResourceCatalog(
-                                            parent=xnat_scan, 
-                                            label=image_description)
-                                    print(f"Uploading Nifti to {xnat_resource}")
-                                    xnat_resource.upload(str(nii), nii.name)
-                                    nii.unlink()
+                else:
+                    print(f"[WARNING] Not all DICOM for {xnat_session_label} is in the archive, keeping the local files")
+            for study_info in studies_by_label[xnat_session_label]:
+                with metrics.span('attach_nifti'):
+                    attach_nifti(xnat_session,inventory,adni_subject_id,
+                                 study_info,ledger)
+    return True
+
+# The same as import_subject, as actions in an ImportPlan.
+# New sessions are assumed to get a scan for every series with DICOM,
+# since that can only be checked once they are archived
+def plan_nifti(plan,inventory,adni_subject_id,study_info,
+               experiment_uri,after):
+    xnat_session_label = study_info['session_id']
+    new_session = not inventory.has_experiment(xnat_session_label)
+    scan_type = "xnat:mrScanData"
+    if study_info['modality'].startswith('PET'):
+        scan_type = "xnat:petScanData"
+    for series_id,series_info in study_info['series_list'].items():
+        scan_label = str(series_info['scan_number'])
+        image_map = series_info['image_list']
+        if new_session:
+            has_scan = any(x['dcm_files'] for x in image_map.values())
+        else:
+            has_scan = inventory.has_scan(xnat_session_label, scan_label)
+        if not has_scan:
+            continue
+        scan_uri = f"{experiment_uri}/scans/{scan_label}"
+        plan.add('update_scan', adni_subject_id, scan_uri, after=after,
+                 xsi_type=scan_type,
+                 values={f"{scan_type}/note": f"ADNI Series {series_id}"})
+        for image_id, image_info in image_map.items():
+            if not image_info['nii_files']:
+                continue
+            image_description = image_info['image_description']
+            resource_uri = f"{scan_uri}/resources/{image_description}"
+            if not plan.has(resource_uri) and (new_session or \
+                    not inventory.has_resource(xnat_session_label,
+                                               scan_label,
+                                               image_description)):
+                plan.add('create_resource', adni_subject_id, resource_uri,
+                         after=after, xsi_type='xnat:resourceCatalog')
+            upload_step = plan.add_upload(adni_subject_id, resource_uri,
+                                          image_info['nii_files'])
+            plan.add_mark(adni_subject_id, image_info['nii_files'],
+                          {
+                              'project': notepad_project,
+                              'subject': adni_subject_id,
+                              'experiment': xnat_session_label,
+                              'scan': scan_label,
+                              'resource': image_description,
+                          },
+                          upload_step, local_action='delete')
+
+def plan_subject(plan,inventory,in_path,df_mr_info,df_pet_info,
+                 args,ledger,header_index):
+    in_path = Path(in_path)
+    adni_subject_id = extract_from_path(in_path,subject_id_pattern)
+    if adni_subject_id is None:
+        print("Could not identify subject from path")
+        print(in_path)
+        return False
+    print(f'Subject {adni_subject_id}')
+    adni_subject_uri = f"/data/projects/{notepad_project}/subjects/{adni_subject_id}"
+    if not inventory.has_subject(adni_subject_id) or args.update:
+        demographics, fields = adni_subject_values(adni_subject_id,df_mr_info)
+        plan.add('create_subject', adni_subject_id, adni_subject_uri,
+                 xsi_type="xnat:subjectData",
+                 values=subject_values(demographics, fields))
+
+    with metrics.span('find_subject_images'):
+        upload_studies = find_subject_images(in_path,adni_subject_id,
+                                             df_mr_info,df_pet_info,
+                                             ledger,header_index,
+                                             args.scan_workers)
+    if upload_studies is None:
+        return False
+
+    # DICOM for new sessions goes first, as in upload_dicom_studies
+    archive_steps = {}
+    for study_id, study_info in upload_studies.items():
+        xnat_session_label = study_info['session_id']
+        if inventory.has_experiment(xnat_session_label) or \
+                xnat_session_label in archive_steps:
+            continue
+        study_dcm_list = []
+        for series_info in study_info['series_list'].values():
+            for image_info in series_info['image_list'].values():
+                study_dcm_list = study_dcm_list + image_info['dcm_files']
+        if not study_dcm_list:
+            continue
+        import_step = plan.add('import_dicom', adni_subject_id,
+                               '/data/services/import',
+                               after=adni_subject_uri,
+                               values={'study_id': study_id,
+                                       'session': xnat_session_label},
+                               files=study_dcm_list,
+                               n_bytes=sum(x.stat().st_size for x in study_dcm_list))
+        plan.add_mark(adni_subject_id, study_dcm_list,
+                      {
+                          'project': notepad_project,
+                          'subject': adni_subject_id,
+                          'experiment': xnat_session_label,
+                          'resource': 'DICOM',
+                      },
+                      import_step, local_action='keep')
+        archive_steps[xnat_session_label] = plan.add(
+            'wait_archive', adni_subject_id,
+            f"{adni_subject_uri}/experiments/{xnat_session_label}",
+            after=import_step,
+            values={'session': xnat_session_label},
+            files=study_dcm_list)
+
+    # NIfTIs for sessions already archived, then for the new ones
+    for study_info in upload_studies.values():
+        xnat_session_label = study_info['session_id']
+        if inventory.has_experiment(xnat_session_label):
+            plan_nifti(plan,inventory,adni_subject_id,study_info,
+                       inventory.experiment_uri(xnat_session_label),
+                       -1)
+    for study_info in upload_studies.values():
+        xnat_session_label = study_info['session_id']
+        if xnat_session_label in archive_steps:
+            plan_nifti(plan,inventory,adni_subject_id,study_info,
+                       f"{adni_subject_uri}/experiments/{xnat_session_label}",
+                       archive_steps[xnat_session_label])
+    return True
+
+def import_planned_dicom(xnat_session,planned,ledger,header_index,
+                         scratch_dir=None,memory_limit=zip_memory_limit):
+    dcm_list = [Path(x) for x in planned['files']]
+    with metrics.span('make_dcm_zip'):
+        zip_stream = make_dcm_zip(dcm_list,
+                                  planned['values']['study_id'],
+                                  header_index,
+                                  scratch_dir,
+                                  memory_limit)
+    with zip_stream, metrics.span('import_dcm_zip'):
+        import_dcm_zip(xnat_session, zip_stream,
+                       planned['subject'],
+                       planned['values']['session'])
+    metrics.count('dicom_files', len(dcm_list))
+
+def wait_planned_archive(xnat_session,planned,ledger,timeout=600):
+    # The NIfTIs planned after this need the archived scans,
+    # so stop the subject if the session never archives
+    xnat_session_label = planned['values']['session']
+    with metrics.span('archive_wait'):
+        archived = list(wait_for_sessions(xnat_session,
+                                          planned['project'],
+                                          planned['subject'],
+                                          [xnat_session_label],
+                                          timeout=timeout))
+    if not archived:
+        raise TimeoutError(f"{xnat_session_label} was not archived")
+    print(f"Session {xnat_session_label} archived")
+    if ledger is None:
+        if dicom_archived(xnat_session, planned['uri'], len(planned['files'])):
+            for f in planned['files']:
+                Path(f).unlink()
+        else:
+            print(f"[WARNING] Not all DICOM for {xnat_session_label} is in the archive, keeping the local files")
+
+def plan_handlers(header_index=None,scratch_dir=None,
+                  memory_limit=zip_memory_limit,archive_timeout=600):
+    # Handlers for the actions only ADNI plans have, for run_plan
+    if header_index is None:
+        header_index = DicomHeaderIndex()
+    return({
+        'import_dicom': lambda xnat_session, planned, ledger: import_planned_dicom(
+            xnat_session, planned, ledger, header_index,
+            scratch_dir, memory_limit),
+        'wait_archive': lambda xnat_session, planned, ledger: wait_planned_archive(
+            xnat_session, planned, ledger, archive_timeout),
+    })
+
+def find_subject_dirs(args):
+    # Either one subject, every subject directory under a root
+    # or a text file listing subject directories one per line
+    if args.in_path is not None:
+        return([Path(args.in_path)])
+    if args.batch_root is not None:
+        batch_root = Path(args.batch_root)
+        return(sorted(x for x in batch_root.iterdir()
+                      if x.is_dir() and subject_id_pattern.match(x.name)))
+    with open(args.subject_list,'r') as subject_list:
+        return([Path(x.strip()) for x in subject_list if x.strip()])
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Import ADNI DICOM to NOTEPAD XNAT')
+    subject_source = parser.add_mutually_exclusive_group()
+    subject_source.add_argument('--in_path', type=str,
+                        help='Path to subject to upload')
+    subject_source.add_argument('--batch_root', type=str,
+                        help='Directory holding one directory per subject (e.g. 002_S_0295) to upload in one go')
+    subject_source.add_argument('--subject_list', type=str,
+                        help='Text file with the path of one subject directory per line')
+    parser.add_argument('--mr_study', type=str,
+                        help='Location of spreadsheet with study info for visits with MR data')
+    parser.add_argument('--mr_image', type=str,
+                        help='Location of spreadsheet with image info for visits with MR data')
+    parser.add_argument('--pet_study', type=str,
+                        help='Location of spreadsheet with study info for visits with PET data')
+    parser.add_argument('--pet_image', type=str,
+                        help='Location of spreadsheet with image info for visits with PET data')
+    parser.add_argument('--update',action='store_true',
+                        help='Update existing records if already on XNAT')
+    parser.add_argument('--archive_timeout', type=int, default=600,
+                        help='Seconds to wait for uploaded DICOM sessions to archive before giving up on their NIfTIs')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of subjects to import at the same time in batch mode')
+    parser.add_argument('--inflight_mb', type=int, default=512,
+                        help='Most MB of files to be uploading at once, across all workers')
+    parser.add_argument('--bundle_mb', type=int, default=16,
+                        help='Files smaller than this are zipped together into one upload per resource')
+    parser.add_argument('--digest_cache', type=str, default=None,
+                        help='SQLite file to keep checksums of local files in, so unchanged files are never hashed twice')
+    parser.add_argument('--scan_workers', type=int, default=1,
+                        help='Threads to list the top level directories of each subject with')
+    parser.add_argument('--scratch_dir', type=str, default=None,
+                        help='Where study zips spill to once they outgrow memory. Default is the system temp directory')
+    parser.add_argument('--zip_memory_mb', type=int,
+                        default=zip_memory_limit // (1024 * 1024),
+                        help='How much of a study zip to keep in memory before using the scratch directory')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory to cache the cleaned spreadsheets between runs')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='SQLite file recording uploads. When given, DICOM and NIfTI files are kept instead of deleted')
+    parser.add_argument('--ledger_match_content', action='store_true',
+                        help='Treat any file whose content matches an upload as done, even under another name. Hashes every file the size of one already uploaded')
+    parser.add_argument('--plan', type=str, default=None,
+                        help='Work out the import without uploading anything and write the plan to this JSON (or .parquet) file')
+    parser.add_argument('--run_plan', type=str, default=None,
+                        help='Run a plan written by --plan instead of looking at the data')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write stage timings and REST call counts to this JSON (or .csv) file at the end of the run')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show a progress line with an ETA on stderr')
+    args = parser.parse_args()
+    if args.run_plan is None:
+        if args.in_path is None and args.batch_root is None and \
+                args.subject_list is None:
+            parser.error("one of --in_path, --batch_root or --subject_list is needed unless running a saved plan")
+        if None in (args.mr_study, args.mr_image, args.pet_study, args.pet_image):
+            parser.error("--mr_study, --mr_image, --pet_study and --pet_image are needed unless running a saved plan")
+    metrics.start('import_adni', args.metrics, args.progress)
+    scheduler.configure(max_bytes=args.inflight_mb * 1024 * 1024,
+                        small_file_bytes=args.bundle_mb * 1024 * 1024)
+    if args.digest_cache is not None:
+        local_digests.open(args.digest_cache)
+
+    ledger = None
+    if args.ledger is not None:
+        ledger = UploadLedger(args.ledger, args.ledger_match_content)
+    # DICOM header cache lives with the spreadsheet cache if there is one
+    header_cache = None
+    if args.cache_dir is not None:
+        header_cache = Path(args.cache_dir) / 'dicom_headers.sqlite'
+    header_index = DicomHeaderIndex(header_cache)
+
+    if args.run_plan is not None:
+        actions = read_plan(args.run_plan)
+        plan_summary(actions)
+        adni_handlers = plan_handlers(header_index, args.scratch_dir,
+                                      args.zip_memory_mb * 1024 * 1024,
+                                      args.archive_timeout)
+        with xnat_sessions.connect(xnat_host) as xnat_session:
+            failures = run_plan(xnat_session, actions, ledger,
+                                max(args.workers, 1), adni_handlers)
+        if failures:
+            print(f"Failed: {sorted(failures)}")
+            sys.exit(1)
+        return
+
+    subject_dirs = find_subject_dirs(args)
+    print(f'{len(subject_dirs)} subject directories to import')
+    metrics.add_total(len(subject_dirs))
+
+    # Spreadsheets are loaded and merged once for all subjects
+    with metrics.span('load_adni_metadata'):
+        df_mr_info, df_pet_info = load_adni_metadata(args)
+
+    # One connection for every subject and both upload phases
+    with xnat_sessions.connect(xnat_host) as xnat_session:
+        # One inventory of the whole project rather than one per subject
+        with metrics.span('inventory'):
+            inventory = ProjectInventory(xnat_session, notepad_project)
+        if args.plan is not None:
+            plan = ImportPlan(notepad_project)
+            for subject_dir in subject_dirs:
+                with metrics.span('plan'):
+                    plan_subject(plan,inventory,subject_dir,
+                                 df_mr_info,df_pet_info,
+                                 args,ledger,header_index)
+                metrics.step(subject_dir.name)
+            plan_summary(plan.actions)
+            write_plan(plan, args.plan)
+            return
+        if args.in_path is not None:
+            if not import_subject(xnat_session,inventory,subject_dirs[0],
+                                  df_mr_info,df_pet_info,
+                                  args,ledger,header_index):
+                sys.exit(1)
+            return
+
+        def import_subject_logged(subject_dir, thread_stdout=None):
+            with scan_log(thread_stdout):
+                print(f"=== {subject_dir}")
+                imported = import_subject(xnat_session,inventory,subject_dir,
+                                          df_mr_info,df_pet_info,
+                                          args,ledger,header_index)
+                metrics.step(subject_dir.name)
+                if not imported:
+                    raise ValueError(f"Nothing imported from {subject_dir}")
+
+        subject_groups = {str(x): x for x in subject_dirs}
+        xnat_sessions.ensure_pool(xnat_session, max(args.workers, 1))
+        with buffered_stdout() as thread_stdout:
+            failures = run_grouped(
+                subject_groups,
+                lambda key, subject_dir: import_subject_logged(
+                    subject_dir, thread_stdout if args.workers > 1 else None),
+                max(args.workers, 1))
+        print(f"{len(subject_dirs) - len(failures)} of {len(subject_dirs)} subjects imported")
+        if failures:
+            print(f"Failed: {sorted(failures)}")
+            sys.exit(1)
                                     
         
 if __name__ == "__main__":
     main()
- 
@@ -1,7 +1,17 @@
-import xnat
+import sys
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from zipfile import ZipFile
 import pandas as pd
 import argparse
 from pathlib import Path
+from upload_ledger import UploadLedger
+from sheet_cache import read_frame, write_frame, write_atomic
+from run_metrics import metrics
+from xnat_sessions import xnat_sessions
 
 # Add argparse to provide MR and PET session data freeze CSV lists
 # So that we don't have to get them again
@@ -16,18 +26,25 @@ cnda_uri = "https://cnda.wustl.edu"
 # Project for data
 cnda_project = "DIANDF17"
 
-def get_session_list(xnat_host,project,modality):
+def get_session_list(xnat_host,project,modality,modified_since=None):
+    # With modified_since, only the sessions changed since that
+    # last_modified value (as the server writes it) are listed. Those
+    # changed in the same instant are listed too, to be safe
     df_sessions={}
-    with xnat.connect(xnat_host,
-                    extension_types=False,
-                    loglevel="ERROR") as xnat_server:
+    with xnat_sessions.connect(xnat_host,
+                               extension_types=False,
+                               loglevel="ERROR") as xnat_server:
         experiments_uri = f"/REST/projects/{project}/experiments"
         xsi_type = f"xnat:{modality}SessionData"
         sessions_query = {
             "xsiType": xsi_type,
-            "columns": "subject_label,label,date,time"
+            "columns": "subject_label,label,date,time,last_modified"
         }
-        print(f"Getting sessions of {xsi_type} from {xnat_host}") 
+        if modified_since is not None:
+            sessions_query["last_modified"] = f">={modified_since}"
+            print(f"Getting sessions of {xsi_type} changed since {modified_since} from {xnat_host}")
+        else:
+            print(f"Getting sessions of {xsi_type} from {xnat_host}") 
         response_json = xnat_server.get_json(experiments_uri,
                                             sessions_query)
         if response_json is None:
@@ -37,51 +54,287 @@ def get_session_list(xnat_host,project,modality):
             sorted(response_json["ResultSet"]["Result"],
                 key=lambda k: k["label"])
         )
-        if df_sessions.empty:
+        if df_sessions.empty and modified_since is None:
             print(f"No sessions of {xsi_type} in {xnat_host}")
+        elif modified_since is not None and not df_sessions.empty:
+            # In case the server ignores the filter
+            df_sessions = df_sessions.loc[
+                df_sessions["last_modified"].astype(str) >= modified_since]
     return(df_sessions)
 
-def transfer_session(df_transfer, scan_filter=[]):
-    for label,session_data in df_transfer.iterrows():
+def inventory_path(inventory_dir,xnat_host,project,modality):
+    host_name = xnat_host.split('//')[-1].replace('.','_')
+    return(Path(inventory_dir) / f"{host_name}-{project}-{modality}.parquet")
+
+def merge_sessions(df_sessions,df_new):
+    # Newer rows replace older ones with the same label
+    if df_new.empty:
+        return(df_sessions)
+    df_new = df_new.reindex(columns=df_sessions.columns).astype('string')
+    df_sessions = pd.concat([df_sessions,df_new],ignore_index=True)
+    df_sessions = df_sessions.drop_duplicates(subset='label',keep='last')
+    return(df_sessions.reset_index(drop=True))
+
+def cached_session_list(xnat_host,project,modality,
+                        inventory_dir=None,ttl_hours=24):
+    # Same as get_session_list, but kept in a Parquet file. Within
+    # ttl_hours of a full listing a rerun only asks the server for
+    # the sessions modified since the newest last_modified in the
+    # cache, and merges them in. After that the whole project is
+    # listed again, which also drops sessions deleted on the server.
+    # The .fetched file next to it records when the full listing was
+    # made, so delta and local updates do not extend its life.
+    if inventory_dir is None:
+        return(get_session_list(xnat_host,project,modality))
+    cache_path = inventory_path(inventory_dir,xnat_host,project,modality)
+    fetched_path = cache_path.with_suffix('.fetched')
+    if cache_path.exists() and fetched_path.exists():
+        age_hours = (time.time() - fetched_path.stat().st_mtime) / 3600
+        df_sessions = read_frame(cache_path)
+        # Sessions this tool added itself have no last_modified
+        modified_since = None
+        if 'last_modified' in df_sessions.columns:
+            modified_since = df_sessions['last_modified'].dropna().max()
+        if age_hours < ttl_hours and not pd.isna(modified_since):
+            print(f"Using {modality} sessions of {project} listed {age_hours:.1f} hours ago")
+            df_changed = get_session_list(xnat_host,project,modality,
+                                          modified_since)
+            print(f"{len(df_changed)} {modality} sessions changed since then")
+            df_sessions = merge_sessions(df_sessions,df_changed)
+            if not df_changed.empty:
+                write_frame(df_sessions,cache_path)
+            return(df_sessions)
+    df_sessions = get_session_list(xnat_host,project,modality)
+    if not df_sessions.empty:
+        df_sessions = df_sessions.astype('string')
+    cache_path.parent.mkdir(parents=True,exist_ok=True)
+    write_frame(df_sessions,cache_path)
+    fetched_path.touch()
+    return(df_sessions)
+
+def add_to_session_cache(inventory_dir,xnat_host,project,modality,df_new):
+    # Put sessions we know we have just uploaded into the cached
+    # listing without asking the server again
+    if inventory_dir is None or df_new.empty:
+        return
+    cache_path = inventory_path(inventory_dir,xnat_host,project,modality)
+    if not cache_path.exists():
+        return
+    df_sessions = merge_sessions(read_frame(cache_path),df_new.reset_index())
+    write_frame(df_sessions,cache_path)
+
+def session_list_csv(csv_path,xnat_host,project,modality,
+                     inventory_dir=None,ttl_hours=24):
+    # The CNDA session list, also written to csv_path as a record of
+    # what was transferred. Without an inventory_dir the CSV stands in
+    # for the cache, so it is only reused for ttl_hours
+    csv_path = Path(csv_path)
+    if inventory_dir is None and csv_path.exists():
+        age_hours = (time.time() - csv_path.stat().st_mtime) / 3600
+        if age_hours < ttl_hours:
+            print(f"Using {modality} sessions of {project} from {csv_path}")
+            return(pd.read_csv(csv_path))
+    df_sessions = cached_session_list(xnat_host,project,modality,
+                                      inventory_dir,ttl_hours)
+    df_sessions.to_csv(csv_path)
+    return(df_sessions)
+
+def sessions_to_transfer(df_remote,df_local,done_labels=()):
+    # Anti-join on the label index: sessions on CNDA that are not
+    # on NOTEPAD yet, nor recorded as uploaded in the transfer state
+    df_remote = df_remote.set_index('label')
+    local_labels = pd.Index(list(done_labels))
+    if not df_local.empty:
+        local_labels = local_labels.union(pd.Index(df_local['label']))
+    return(df_remote.loc[df_remote.index.difference(local_labels)])
+
+def staged_size(dl_path):
+    return(sum(f.stat().st_size for f in dl_path.rglob('*') if f.is_file()))
+
+class ScanCatalogue:
+    # Scan IDs and types for each CNDA experiment, from one listing
+    # query per experiment rather than a lazy scan object per scan.
+    # Kept in a CSV alongside the session lists so reruns skip the query.
+    # The CSV is written once the downloads are done, not per label.
+    def __init__(self, catalogue_path=None):
+        self.catalogue_path = None
+        self.lock = threading.Lock()
+        self.scans = {}
+        self.changed = False
+        if catalogue_path is not None:
+            self.catalogue_path = Path(catalogue_path)
+            if self.catalogue_path.exists():
+                df_catalogue = pd.read_csv(self.catalogue_path,
+                                           dtype={'ID': 'str'})
+                for label, df_scans in df_catalogue.groupby('label'):
+                    self.scans[label] = list(zip(df_scans['ID'],
+                                                 df_scans['type']))
+
+    def get(self, xnat_server, label):
+        with self.lock:
+            if label in self.scans:
+                return(self.scans[label])
+        scans_uri = f"/REST/projects/{cnda_project}/experiments/{label}/scans"
+        response_json = xnat_server.get_json(scans_uri,
+                                             query={"columns": "ID,type"})
+        scan_list = [(str(x["ID"]), x["type"])
+                     for x in response_json["ResultSet"]["Result"]]
+        with self.lock:
+            self.scans[label] = scan_list
+            self.changed = True
+        return(scan_list)
+
+    def save(self):
+        # Renamed into place, so a crash never leaves half a catalogue
+        with self.lock:
+            if self.catalogue_path is None or not self.changed:
+                return
+            rows = [(label, scan_id, scan_type)
+                    for label, scan_list in self.scans.items()
+                    for scan_id, scan_type in scan_list]
+            self.changed = False
+        df_catalogue = pd.DataFrame(rows, columns=['label','ID','type'])
+        write_atomic(lambda x: df_catalogue.to_csv(x, index=False),
+                     self.catalogue_path)
+
+def download_session(xnat_source_server, label, staging_dir,
+                     scan_filter=[], catalogue=None):
+    experiment_uri = f"/REST/projects/{cnda_project}/experiments/{label}"
+    # If we are filteirng out scans (so we only get MPRAGE and FLAIR)
+    # Find the right IDS and only download those
+    # Otherwise download the whole experiment.
+    if scan_filter:
+        if catalogue is None:
+            catalogue = ScanCatalogue()
+        filtered_scans = []
+        for filter_name in scan_filter:
+            filtered_scans = filtered_scans + [x[0] for x in catalogue.get(xnat_source_server, label) if filter_name in x[1]]
+        filtered_scans = list(dict.fromkeys(filtered_scans))
+        if not filtered_scans:
+            raise ValueError(f"No scans in {label} match {scan_filter}")
+        # All of the wanted scans in one archive request
+        files_uri = f"{experiment_uri}/scans/{','.join(filtered_scans)}/files"
+        with tempfile.TemporaryFile(dir=staging_dir) as zip_stream:
+            xnat_source_server.download_stream(files_uri, zip_stream,
+                                               format='zip',
+                                               verbose=False)
+            with ZipFile(zip_stream) as scan_zip:
+                scan_zip.extractall(staging_dir)
+    else:
+        experiment = xnat_source_server.create_object(experiment_uri)
+        experiment.download_dir(str(staging_dir))
+    return(staging_dir / label)
+
+def upload_session(xnat_dest_server, label, subject_label, dl_path):
+    dest_project = xnat_dest_server.projects[notepad_project]
+    dest_subjects = dest_project.subjects
+    if subject_label not in dest_subjects:
+        xnat_dest_subject = xnat_dest_server.classes.SubjectData(
+        parent=dest_project, 
+        label=subject_label)
+    else:
+        xnat_dest_subject = dest_subjects[subject_label]
+    archive_session = xnat_dest_server.services.import_dir(
+                        dl_path, 
+                        project=dest_project, 
+                        subject=xnat_dest_subject,
+                        experiment=label)
+    return(archive_session)
+
+class StagingBudget:
+    # Keeps the bytes of downloaded but not yet uploaded sessions
+    # under a limit. A download only starts while there is room,
+    # so at most one session can take the total over the limit.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.condition = threading.Condition()
+
+    def wait_for_room(self):
+        with self.condition:
+            while self.used_bytes >= self.max_bytes:
+                self.condition.wait()
+
+    def add(self, n_bytes):
+        with self.condition:
+            self.used_bytes = self.used_bytes + n_bytes
+
+    def release(self, n_bytes):
+        with self.condition:
+            self.used_bytes = self.used_bytes - n_bytes
+            self.condition.notify_all()
+
+def transfer_session(df_transfer, xnat_source_server, xnat_dest_server,
+                     staging_dir, state, scan_filter=[],
+                     max_staged_bytes=50 * 1024**3, queue_size=2,
+                     catalogue=None):
+    # Two stage pipeline: a download thread pulls sessions from CNDA
+    # into the staging directory while this thread uploads the ones
+    # already staged to NOTEPAD. The queue and the staging budget
+    # stop downloads from running too far ahead of the uploads.
+    staging_dir = Path(staging_dir)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    staged = queue.Queue(maxsize=queue_size)
+    budget = StagingBudget(max_staged_bytes)
+
+    def download_all():
+        # Always tell the uploader we are done, even on a crash
+        try:
+            for label, session_data in df_transfer.iterrows():
+                session_state = state.session_state(notepad_project, label)
+                if session_state == "uploaded":
+                    continue
+                dl_path = staging_dir / label
+                # Pick up a finished download from an interrupted run
+                if session_state != "downloaded" or not dl_path.exists():
+                    budget.wait_for_room()
+                    print(f"Downloading {label}")
+                    # Clear out anything half downloaded last time
+                    shutil.rmtree(dl_path, ignore_errors=True)
+                    try:
+                        with metrics.span('download'):
+                            dl_path = download_session(xnat_source_server, label,
+                                                       staging_dir, scan_filter,
+                                                       catalogue)
+                    except Exception as e:
+                        print(f"Exception on download for {label}. Skipping ")
+                        print(type(e))
+                        print(e)
+                        state.mark_session(notepad_project, label, "failed")
+                        shutil.rmtree(dl_path, ignore_errors=True)
+                        metrics.step(label)
+                        continue
+                    state.mark_session(notepad_project, label, "downloaded")
+                n_bytes = staged_size(dl_path)
+                budget.add(n_bytes)
+                staged.put((label, session_data.subject_label, dl_path, n_bytes))
+        finally:
+            if catalogue is not None:
+                catalogue.save()
+            staged.put(None)
+
+    downloader = threading.Thread(target=download_all, daemon=True)
+    downloader.start()
+    while True:
+        item = staged.get()
+        if item is None:
+            break
+        label, subject_label, dl_path, n_bytes = item
         print(label)
-        dl_path=Path(f"/tmp/{label}")
-        with xnat.connect(cnda_uri,
-                          extension_types=False,
-                          loglevel="ERROR") as xnat_source_server:
-            experiment_uri = f"/REST/projects/{cnda_project}/experiments/{label}"
-            experiment = xnat_source_server.create_object(experiment_uri)
-            # If we are filteirng out scans (so we only get MPRAGE and FLAIR)
-            # Find the right IDS and only download those
-            # Otherwise download the whole experiment.
-            if scan_filter:
-                filtered_scans = []
-                for filter_name in scan_filter:
-                    filtered_scans = filtered_scans + [x.id for x in experiment.scans if filter_name in x.type]
-                for scan_id in filtered_scans:
-                    experiment.scans[scan_id].download_dir("/tmp")
-            else:
-                experiment.download_dir("/tmp")
-        with xnat.connect(notepad_uri,
-                          extension_types=False,
-                          loglevel="ERROR") as xnat_dest_server: 
-            dest_project = xnat_dest_server.projects[notepad_project]
-            dest_subjects = dest_project.subjects
-            if session_data.subject_label not in dest_subjects:
-                xnat_dest_subject = xnat_dest_server.classes.SubjectData(
-                parent=dest_project, 
-                label=session_data.subject_label)
-            else:
-                xnat_dest_subject = dest_subjects[session_data.subject_label]
-            try:
-                archive_session = xnat_dest_server.services.import_dir(
-                                    dl_path, 
-                                    project=dest_project, 
-                                    subject=xnat_dest_subject,
-                                    experiment=label)
-            except Exception as e:
-                print(f"Exception on upload for {label}. Skipping ")
-                print(type(e))
-                print(e)
+        try:
+            with metrics.span('upload'):
+                upload_session(xnat_dest_server, label, subject_label, dl_path)
+            state.mark_session(notepad_project, label, "uploaded")
+            metrics.count('bytes_staged', n_bytes)
+        except Exception as e:
+            print(f"Exception on upload for {label}. Skipping ")
+            print(type(e))
+            print(e)
+            state.mark_session(notepad_project, label, "failed")
+        shutil.rmtree(dl_path, ignore_errors=True)
+        budget.release(n_bytes)
+        metrics.step(label)
+    downloader.join()
             
 
 def main():
@@ -90,6 +343,7 @@ def main():
     help_str = """
     Path to store file of MR sessions on CNDA. 
     If it does not exist it will be created to this location. 
+    It is refreshed once it is older than --inventory_ttl.
     """
     parser.add_argument('--mr_sessions', 
                         type=str,
@@ -98,75 +352,125 @@ def main():
     help_str = """
     Path to store file of PET sessions on CNDA. 
     If it does not exist it will be created to this location. 
+    It is refreshed once it is older than --inventory_ttl.
     """
     parser.add_argument('--pet_sessions', 
                         type=str,
                         required=True,
                         help=help_str)
+    help_str = """
+    Path to store the scan IDs and types of each CNDA MR session.
+    Used to pick out scans by type without asking CNDA again.
+    """
+    parser.add_argument('--scan_catalogue', 
+                        type=str,
+                        default=None,
+                        help=help_str)
+    parser.add_argument('--inventory_dir',
+                        type=str,
+                        default=None,
+                        help='Directory to cache the session lists of both servers as Parquet')
+    parser.add_argument('--inventory_ttl',
+                        type=float,
+                        default=24,
+                        help='Hours before a cached session list is fetched from the server again. In between only sessions modified since are fetched')
+    parser.add_argument('--staging_dir',
+                        type=str,
+                        default='/tmp/dian_staging',
+                        help='Where sessions are downloaded to before upload. Each one is removed once uploaded')
+    parser.add_argument('--max_staged_gb',
+                        type=float,
+                        default=50,
+                        help='Stop downloading while this much data is waiting to be uploaded')
+    parser.add_argument('--queue_size',
+                        type=int,
+                        default=2,
+                        help='How many downloaded sessions can wait for upload')
+    parser.add_argument('--state',
+                        type=str,
+                        default=None,
+                        help='SQLite file recording the state of each session, so an interrupted transfer resumes. Default is in the staging directory')
+    parser.add_argument('--metrics',
+                        type=str,
+                        default=None,
+                        help='Write stage timings and REST call counts to this JSON (or .csv) file at the end of the run')
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help='Show a progress line with an ETA on stderr')
     args = parser.parse_args()
+    metrics.start('import_dian', args.metrics, args.progress)
+    state_path = args.state
+    if state_path is None:
+        state_path = Path(args.staging_dir) / 'transfer_state.sqlite'
+    state = UploadLedger(state_path)
+    max_staged_bytes = int(args.max_staged_gb * 1024**3)
 
     modality_list = []
-    mrsession_list_path = Path(args.mr_sessions)
-    if not mrsession_list_path.exists():
-        df_mrsessions = get_session_list(cnda_uri,
-                                         cnda_project,
-                                         "mr")
-        df_mrsessions.to_csv(mrsession_list_path)
-    else:
-        df_mrsessions = pd.read_csv(mrsession_list_path)
-
-    petsession_list_path = Path(args.pet_sessions)
-    if not petsession_list_path.exists():
-        df_petsessions = get_session_list(cnda_uri,
-                                          cnda_project,
-                                          "pet")
-        df_petsessions.to_csv(petsession_list_path)
-    else:
-        df_petsessions = pd.read_csv(petsession_list_path)
+    df_mrsessions = session_list_csv(args.mr_sessions,
+                                     cnda_uri,
+                                     cnda_project,
+                                     "mr",
+                                     args.inventory_dir,
+                                     args.inventory_ttl)
+    df_petsessions = session_list_csv(args.pet_sessions,
+                                      cnda_uri,
+                                      cnda_project,
+                                      "pet",
+                                      args.inventory_dir,
+                                      args.inventory_ttl)
 
     # Now do same thing for local XNAT
-    # This one I don't want preloaded, as it will be dynamic
-    # Based on the upload
-    df_mruploaded = get_session_list(notepad_uri,
-                                     notepad_project,
-                                     "mr")
-    if df_mruploaded.empty:
-        df_toupload = df_mrsessions
-    else:
-        df_toupload = pd.merge(df_mruploaded,
-                            df_mrsessions,
-                            how="right",
-                            suffixes=['_local',''],
-                            on=["subject_label","label"],
-                            indicator = True
-                            )
-        df_toupload = df_toupload.loc[df_toupload["_merge"]=="right_only"]
-
-    df_toupload = df_toupload.set_index('label')
+    # This one changes with every upload, so it is only cached
+    # for inventory_ttl and anything this tool has uploaded since
+    # comes from the transfer state instead of the server
+    uploaded_labels = state.sessions_in_state(notepad_project,"uploaded")
+    df_mruploaded = cached_session_list(notepad_uri,
+                                        notepad_project,
+                                        "mr",
+                                        args.inventory_dir,
+                                        args.inventory_ttl)
+    df_toupload = sessions_to_transfer(df_mrsessions,df_mruploaded,
+                                       uploaded_labels)
     print(len(df_toupload))
-    transfer_session(df_toupload,["MPRAGE","FLAIR"])
+    metrics.add_total(len(df_toupload))
+    # One connection to each server for the whole run, shared with
+    # the session listings above and the PET transfer below. The
+    # downloader thread and the uploader each need a socket
+    xnat_source_server = xnat_sessions.get(cnda_uri, 2,
+                                           extension_types=False,
+                                           loglevel="ERROR")
+    xnat_dest_server = xnat_sessions.get(notepad_uri, 2,
+                                         extension_types=False,
+                                         loglevel="ERROR")
+    transfer_session(df_toupload, xnat_source_server, xnat_dest_server,
+                     args.staging_dir, state, ["MPRAGE","FLAIR"],
+                     max_staged_bytes, args.queue_size,
+                     ScanCatalogue(args.scan_catalogue))
+    now_uploaded = state.sessions_in_state(notepad_project,"uploaded")
+    add_to_session_cache(args.inventory_dir,notepad_uri,notepad_project,"mr",
+                         df_toupload.loc[df_toupload.index.isin(now_uploaded)])
     # Need to account for PET sessions being uploaded as PET-MR
-    df_petonlyuploaded = get_session_list(notepad_uri,
-                                     notepad_project,
-                                     "pet")
-    df_petmruploaded = get_session_list(notepad_uri,
-                                     notepad_project,
-                                     "petmr")
+    df_petonlyuploaded = cached_session_list(notepad_uri,
+                                             notepad_project,
+                                             "pet",
+                                             args.inventory_dir,
+                                             args.inventory_ttl)
+    df_petmruploaded = cached_session_list(notepad_uri,
+                                           notepad_project,
+                                           "petmr",
+                                           args.inventory_dir,
+                                           args.inventory_ttl)
     df_petuploaded = pd.concat([df_petonlyuploaded,df_petmruploaded])
-    if df_petuploaded.empty:
-        df_toupload = df_petsessions
-    else:
-        df_toupload = pd.merge(df_petuploaded,
-                            df_petsessions,
-                            how="right",
-                            suffixes=['_local',''],
-                            on=["subject_label","label"],
-                            indicator = True
-                            )
-        df_toupload = df_toupload.loc[df_toupload["_merge"]=="right_only"]
-    df_toupload = df_toupload.set_index('label')
+    df_toupload = sessions_to_transfer(df_petsessions,df_petuploaded,
+                                       uploaded_labels)
     print(len(df_toupload))
-    transfer_session(df_toupload)
+    metrics.add_total(len(df_toupload))
+    transfer_session(df_toupload, xnat_source_server, xnat_dest_server,
+                     args.staging_dir, state, [],
+                     max_staged_bytes, args.queue_size)
+    now_uploaded = state.sessions_in_state(notepad_project,"uploaded")
+    add_to_session_cache(args.inventory_dir,notepad_uri,notepad_project,"pet",
+                         df_toupload.loc[df_toupload.index.isin(now_uploaded)])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+import json
+from pathlib import Path
+import pandas as pd
+from upload_scheduler import scheduler
+
+# An import worked out ahead of time, without sending anything.
+# Planning reads the local files, the spreadsheets and one inventory of
+# the project, and writes down every request the import would make:
+# the subjects, sessions, scans and resources to create, the files to
+# upload into them and what to do with the local files afterwards,
+# with an estimate of the requests and bytes for each. A plan can be
+# checked before a run, and executing a saved plan makes only network
+# calls, with no spreadsheet lookups in between.
+# A plan is a list of action dicts in the order they run. Each action
+# names the step it has to come after (-1 if it only needs what is
+# already on XNAT), so the plan is also the dependency graph.
+# Plans are written as JSON, or as Parquet if the name ends .parquet.
+
+# Columns of a saved plan
+plan_columns = ['step', 'project', 'subject', 'action', 'uri', 'after',
+                'xsi_type', 'values', 'files', 'target', 'local_action',
+                'move_to', 'requests', 'bytes']
+# Columns that hold lists or dicts, kept as JSON text in Parquet
+nested_columns = ['values', 'files', 'target', 'move_to']
+
+
+class ImportPlan:
+    def __init__(self, project):
+        self.project = project
+        self.actions = []
+        # URI -> step of the first action that makes or fills it
+        self.made = {}
+
+    def add(self, action, subject, uri='', after=None, xsi_type='',
+            values=None, files=(), target=None, local_action='',
+            move_to=(), requests=1, n_bytes=0):
+        """
+        Add an action and return its step. after is the URI of an
+        object made earlier in the plan, or the step of an action.
+        """
+        if isinstance(after, str):
+            after = self.made.get(after, -1)
+        step = len(self.actions)
+        self.actions.append({
+            'step': step,
+            'project': self.project,
+            'subject': subject,
+            'action': action,
+            'uri': uri,
+            'after': -1 if after is None else after,
+            'xsi_type': xsi_type,
+            'values': values or {},
+            'files': [str(x) for x in files],
+            'target': target or {},
+            'local_action': local_action,
+            'move_to': [str(x) for x in move_to],
+            'requests': requests,
+            'bytes': n_bytes,
+        })
+        if uri:
+            self.made.setdefault(uri, step)
+        return(step)
+
+    def has(self, uri):
+        return(uri in self.made)
+
+    def add_upload(self, subject, resource_uri, src_files):
+        # Requests as the scheduler would make them: one for the
+        # bundle of small files, one per large file and the catalog check
+        bundle, single, src_sizes = scheduler.plan(list(src_files))
+        n_requests = (1 if bundle else 0) + len(single) + 1
+        return(self.add('upload', subject, resource_uri, after=resource_uri,
+                        files=src_files, requests=n_requests,
+                        n_bytes=sum(src_sizes.values())))
+
+    def add_mark(self, subject, src_files, target, after,
+                 local_action='move', move_to=()):
+        # Record the files in the ledger, or else move, delete or
+        # keep them (local_action) once they are on XNAT
+        return(self.add('mark_uploaded', subject, after=after,
+                        files=src_files, target=target,
+                        local_action=local_action, move_to=move_to,
+                        requests=0))
+
+    def extend(self, other):
+        # Append another plan, e.g. one subject planned on its own thread
+        offset = len(self.actions)
+        for planned in other.actions:
+            planned = dict(planned)
+            planned['step'] = planned['step'] + offset
+            if planned['after'] >= 0:
+                planned['after'] = planned['after'] + offset
+            self.actions.append(planned)
+            if planned['uri']:
+                self.made.setdefault(planned['uri'], planned['step'])
+
+
+def write_plan(plan, plan_path):
+    plan_path = Path(plan_path)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    if plan_path.suffix == '.parquet':
+        df_plan = pd.DataFrame(plan.actions, columns=plan_columns)
+        for column in nested_columns:
+            df_plan[column] = df_plan[column].map(json.dumps)
+        df_plan.to_parquet(plan_path, index=False)
+    else:
+        with open(plan_path, 'w') as plan_file:
+            json.dump(plan.actions, plan_file, indent=1)
+    print(f"Plan of {len(plan.actions)} actions written to {plan_path}")
+
+
+def read_plan(plan_path):
+    # The actions of a saved plan, in order
+    plan_path = Path(plan_path)
+    if plan_path.suffix != '.parquet':
+        with open(plan_path, 'r') as plan_file:
+            return(json.load(plan_file))
+    actions = pd.read_parquet(plan_path).to_dict('records')
+    for planned in actions:
+        for column in nested_columns:
+            planned[column] = json.loads(planned[column])
+        for column in ('step', 'after', 'requests', 'bytes'):
+            planned[column] = int(planned[column])
+    return(actions)
+
+
+def plan_summary(actions):
+    # Print and return the count, requests and bytes of each kind of action
+    summary = {}
+    for planned in actions:
+        totals = summary.setdefault(planned['action'], [0, 0, 0])
+        totals[0] = totals[0] + 1
+        totals[1] = totals[1] + planned['requests']
+        totals[2] = totals[2] + planned['bytes']
+    subjects = set(x['subject'] for x in actions)
+    print(f"Plan for {len(subjects)} subjects")
+    print(f"{'action':<20}{'count':>8}{'requests':>10}{'MB':>12}")
+    for action, totals in summary.items():
+        print(f"{action:<20}{totals[0]:>8}{totals[1]:>10}{totals[2] / 1024**2:>12.1f}")
+    n_requests = sum(x[1] for x in summary.values())
+    n_bytes = sum(x[2] for x in summary.values())
+    print(f"{'total':<20}{len(actions):>8}{n_requests:>10}{n_bytes / 1024**2:>12.1f}")
+    return(summary)
@@ -3,8 +3,18 @@ import sys
 from pathlib import Path
 from collections import namedtuple
 import pandas as pd
-import json
-import xnat
+from xnat_sessions import xnat_sessions
+from upload_ledger import UploadLedger
+from xnat_inventory import ProjectInventory
+from sheet_cache import cached_frames
+from run_metrics import metrics
+from upload_scheduler import scheduler
+from file_digest import local_digests
+from file_index import FileIndex
+from importer_core import CohortAdapter, SubjectInfo, ScanInfo, \
+    run_import, run_import_async, plan_import, run_plan, shard_scans
+from sharding import shard_spec
+from import_plan import write_plan, read_plan, plan_summary
 
 # Some helpful globals
 # Host for the xnat where data is going
@@ -28,310 +38,88 @@ race_map = {
     100: "More than one race",
 }
 
+# Spreadsheets in the Data directory and the columns we use from them
+# Age_At_Baseline_Int is only taken from whichever sheet has it
+clinical_sheets = [
+    'Demographics.csv', 'APG.csv', 'fqryStatisticalData.csv',
+    'CDR.csv', 'NeuropsychScores.csv'
+    ]
+subject_cols = [
+    'wrapnum', 'race1', 'race2', 'hispanic_or_latino',
+    'gender', 'EducYrs', 'Age_At_Baseline_Int'
+    ]
+visit_cols = [
+    'wrapnum', 'VisNo', 'Age_At_Baseline_Int', 'Days_Since_Baseline'
+    ]
+
 CogScores = namedtuple("CogScores",["Visit","CDR_Global","CDR_Sum","MMSE"])
 
 
-def bids_extract(data,key,default):
-    output = default
-    if key in data:
-        output = str(data[key])
-    return(output)
+# Work out the cognitive scores for every (subject, scan age) at once.
+# The closest visit to each scan is found with one merge_asof over all
+# subjects, then CDR and MMSE are joined on (subject, visit).
+# Returns a dict of (subject, scan_age) -> CogScores.
+def build_cog_table(scan_keys,df_visits,df_cdr,df_mmse):
+    df_scans = pd.DataFrame(sorted(set(scan_keys)),
+                            columns=['wrapnum','scan_age'])
+    df_scans['scan_age_years'] = df_scans['scan_age'].str[:3].astype(float)
+    df_visit_ages = df_visits.reset_index()
+    df_visit_ages = df_visit_ages.loc[:,['wrapnum','VisNo','Age_At_Visit']]
+    df_visit_ages = df_visit_ages.dropna(subset=['Age_At_Visit'])
+    # merge_asof needs both sides sorted on the age
+    df_closest = pd.merge_asof(
+        df_scans.sort_values('scan_age_years'),
+        df_visit_ages.sort_values('Age_At_Visit'),
+        left_on='scan_age_years',
+        right_on='Age_At_Visit',
+        by='wrapnum',
+        direction='nearest'
+        )
 
-def create_subject(session, project, subject_label,df_subject):
-    if subject_label in project.subjects:
-        print("Subject already in project")
-        return(project.subjects[subject_label])
-    elif subject_label not in df_subject.index:
-        print("This subject ID is not in the main subject info spreadsheet")
-        return None
-    else:
-        print("Creating Subject")
-        df_subject_info = df_subject.loc[[subject_label],:]
-        first_visit = df_subject_info.iloc[0]
-        in_age = first_visit['Age_At_Baseline_Int']
-        in_gender = first_visit['SEX_STR']
-        in_ethnicity = first_visit['ETHNIC_STR']
-        in_education = first_visit['EducYrs']
-        in_race = first_visit['RACE_STR']
-        in_apoe = str(first_visit['APOEGN'])
-        subject = session.classes.SubjectData(
-                parent=project, 
-                label=subject_label)
-            
-        if str(in_age) != "nan":
-            subject.demographics.age = in_age
-        if str(in_gender) != "nan":
-            subject.demographics.gender = in_gender
-        if str(in_ethnicity) != "nan":
-            subject.demographics.ethnicity = in_ethnicity
-        if str(in_education) != "nan":
-            subject.demographics.education=in_education if in_education <=30 else 30
-        if str(in_race) != "nan":
-            subject.demographics.race = in_race
-        if in_apoe == "nan":
-            in_apoe = "NA"
-        else:
-            in_apoe = in_apoe.replace('E','')
-            in_apoe = in_apoe.replace('/','_')
-            
-        # This command will have to happen after upgrade or via REST call 
-        var_string = {
-            "xnat:subjectData/fields/field[name=apoe]/field": in_apoe,
-        }   
-        session.put(
-            path=f"/data/projects/{notepad_project}/subjects/{subject_label}",
-            query=var_string
-            )
-        print(f"Subject created {subject}")
-        return(subject)
-
-def find_cog_scores(subject,age,df_visits,df_cdr, df_mmse):
-    cdr_global = 'NA'
-    cdr_sum = '-1'
-    mmse = '-1'
-    df_subject_visits = df_visits.loc[[subject],:]
-    print(df_subject_visits['Age_At_Visit'])
-    df_subject_visits['diff_to_scan'] = df_subject_visits['Age_At_Visit'] - float(age[:3])
-    # Modified from Source - https://stackoverflow.com/a
-    # Posted by Zero, modified by community. See post 'Timeline' for change history
-    # Retrieved 2025-11-17, License - CC BY-SA 4.0
-    df_closest_visit = df_subject_visits.iloc[df_subject_visits['diff_to_scan'].abs().argsort()[:1]].squeeze()
-    closest_visit = df_closest_visit['VisNo']
-    print("Closest visit")
-    print(f"Visit Number: {closest_visit}")
-    print(f"Age At Visit: {df_closest_visit['Age_At_Visit']}")
-    print(f"Diff From Image: {df_closest_visit['diff_to_scan']}")
-
-    # Find the right visit code for the imaging visit
-    if subject in df_cdr.index:
-        df_cdr_subject = df_cdr.loc[[subject],:]
-        df_cdr_subject = df_cdr_subject.reset_index()
-        df_cdr_subject = df_cdr_subject.set_index('VisNo')
-        print(df_cdr_subject)
-        if closest_visit in df_cdr_subject.index:
-            print("Match")
-            cdr_global = df_cdr_subject.loc[
-                closest_visit,
-                'CDRRating']
-            cdr_sum = df_cdr_subject.loc[
-                closest_visit,
-                'SumOfBoxes']
-
-    if subject in df_mmse.index:
-        df_mmse_subject = df_mmse.loc[[subject],:]
-        df_mmse_subject = df_mmse_subject.reset_index()
-        df_mmse_subject = df_mmse_subject.set_index('VisNo')
-        if closest_visit in df_mmse_subject.index:
-            print("Match")
-            mmse = df_mmse_subject.loc[closest_visit,'mmseTot']
-    output_cog = CogScores(closest_visit,cdr_global,cdr_sum,mmse)
-    print(output_cog)
-    return(output_cog)
+    # Keep the first score for a visit if there are repeats
+    df_cdr_visit = df_cdr.reset_index()
+    df_cdr_visit = df_cdr_visit.drop_duplicates(subset=['wrapnum','VisNo'])
+    df_cdr_visit = df_cdr_visit.loc[:,['wrapnum','VisNo','CDRRating','SumOfBoxes']]
+    df_cdr_visit['has_cdr'] = True
+    df_mmse_visit = df_mmse.reset_index()
+    df_mmse_visit = df_mmse_visit.drop_duplicates(subset=['wrapnum','VisNo'])
+    df_mmse_visit = df_mmse_visit.loc[:,['wrapnum','VisNo','mmseTot']]
+    df_mmse_visit['has_mmse'] = True
+    df_closest = df_closest.merge(df_cdr_visit, how='left',
+                                  on=['wrapnum','VisNo'])
+    df_closest = df_closest.merge(df_mmse_visit, how='left',
+                                  on=['wrapnum','VisNo'])
+    # Rows without a matching score come back as NaN
+    df_closest['has_cdr'] = df_closest['has_cdr'].notna()
+    df_closest['has_mmse'] = df_closest['has_mmse'].notna()
+
+    cog_table = {}
+    for row in df_closest.itertuples(index=False):
+        closest_visit = row.VisNo if pd.notna(row.VisNo) else None
+        cdr_global = 'NA'
+        cdr_sum = '-1'
+        mmse = '-1'
+        if row.has_cdr:
+            cdr_global = row.CDRRating
+            cdr_sum = row.SumOfBoxes
+        if row.has_mmse:
+            mmse = row.mmseTot
+        cog_table[(row.wrapnum, row.scan_age)] = CogScores(
+            closest_visit,cdr_global,cdr_sum,mmse)
+    return(cog_table)
     
-def move_uploaded_file(src_file,src_path_list,upload_pos):
+def uploaded_file_path(src_path_list,upload_pos):
     if len(src_path_list) >= upload_pos:
         src_path_list.insert(upload_pos,'uploaded')
-        trg_path = Path(*src_path_list)
-        trg_path.parent.mkdir(parents=True,exist_ok=True)
-        src_file.rename(trg_path)
-    else:
-        print(f"Error in path: {upload_pos} not in list {src_path_list}")
-        
-def create_experiment(session,subject,modality,
-                      experiment_label,
-                      nii_file,json_file,
-                      upload_pos,
-                      cog_outcomes):
-    resource="BIDS"
-    subject_label=subject.label
-    #Read in JSON
-    if not json_file.exists():
-        return(None)
-    with open(json_file,'r') as sidecar:
-        bids_data = json.load(sidecar)
-
-    nii_path_list = list(nii_file.parts)
-    json_path_list = list(json_file.parts)
-
-    if experiment_label in subject.experiments:
-        print("Subject already in project")
-        xnat_experiment = subject.experiments[experiment_label]
-    else:
-        print(f"Creating Session {experiment_label}")
-        if modality == "MR":
-            xnat_experiment = session.classes.MrSessionData(
-                    parent=subject, label=experiment_label)
-            xnat_experiment.field_strength = bids_extract(bids_data,
-                                                        'MagneticFieldStrength',
-                                                        'Not specified')
-            var_string = {
-                "xnat:mrSessionData/fields/field[name=mmse]/field": cog_outcomes.MMSE,
-                "xnat:mrSessionData/fields/field[name=cdrsb]/field": cog_outcomes.CDR_Sum,
-                "xnat:mrSessionData/fields/field[name=cdrglobal]/field": cog_outcomes.CDR_Global,
-                }   
-            session.put(
-                path=f"/data/projects/{notepad_project}/subjects/{subject_label}/experiments/{experiment_label}",
-                query=var_string
-            )
-        else:
-            xnat_experiment = session.classes.PetSessionData(
-                parent=subject, label=experiment_label)
-            xnat_experiment.tracer.name = bids_extract(
-                bids_data,
-                'Radiopharmaceutical',
-                'Unknown')
-            xnat_experiment.tracer.data['dose'] = bids_extract(
-                bids_data,
-                'InjectedRadioactivity',
-                '0.0'
-            )
-        xnat_experiment.manufacturer = bids_extract(
-            bids_data,
-            'Manufacturer',
-            'Unknown'
-            )
-
-    # Get series Number
-    series_number = bids_extract(bids_data,"SeriesNumber",3)
-
-    xnat_scan = None
-    # Now that the session is created, 
-    # let's check if the scan
-    # is in the experiment
-    if xnat_experiment.scans:
-        if series_number in xnat_experiment.scans:
-            # This data has already been uploaded
-            # So we can move it to the uploaded path
-            if nii_file.exists():
-                move_uploaded_file(nii_file,nii_path_list,upload_pos)
-            else:   
-                print(f"[WARNING] Could not find file: {nii_file}")
-
-            if json_file.exists():
-                #Move to uploaded path when done
-                move_uploaded_file(json_file,json_path_list,upload_pos)         
-            else:
-                print(f"[WARNING] Could not find file: {json_file}")
-
-            # OPtional -bval for diffusion file
-            json_name = str(json_file)
-            bval_name = json_name.replace('.json','.bval')
-            bval_file = Path(bval_name)
-            if bval_file.exists():
-                #Move to uploaded path when done
-                move_uploaded_file(bval_file,json_path_list,upload_pos)         
-            
-            bvec_name = json_name.replace('.json','.bvec')
-            bvec_file = Path(bvec_name)
-            if bvec_file.exists():
-                #Move to uploaded path when done
-                move_uploaded_file(bvec_file,json_path_list,upload_pos)         
-            xnat_scan = xnat_experiment.scans[series_number]
-    
-    # Create a scan if not available
-    if xnat_scan is None:
-        # Can't really do much if no Nifti file present
-        if nii_file.exists():
-            slice_thickness = bids_extract(bids_data,
-                                        'SliceThickness',
-                                        '0.0')
-            if modality == "MR":
-                series_description = bids_extract(
-                    bids_data,
-                    "SeriesDescription",
-                    "T1"
-                    )
-                xnat_scan = session.classes.MrScanData(
-                    parent=xnat_experiment, 
-                    id=series_number, 
-                    type=series_description, 
-                    series_description=series_description
-                    )
-                xnat_scan.parameters.te = bids_extract(
-                    bids_data,
-                    'EchoTime',
-                    '0.0'
-                    )
-                xnat_scan.parameters.tr = bids_extract(
-                    bids_data,
-                    'RepetitionTime',
-                    '0.0'
-                    )
-                xnat_scan.parameters.ti = bids_extract(
-                    bids_data,
-                    'InversionTime',
-                    '0.0'
-                    )
-            else:
-                series_description = bids_extract(
-                    bids_data,
-                    "SeriesDescription",
-                    "PET AC"
-                    )
-                xnat_scan = session.classes.PetScanData(
-                        parent=xnat_experiment, 
-                        id=series_number, 
-                        type=series_description, 
-                        series_description=series_description
-                        )
-            
-            xnat_resource = None
-            if xnat_scan.resources:
-                if resource in xnat_scan.resources:
-                    xnat_resource = xnat_scan.resources[resource]
-            if xnat_resource is None:
-                xnat_resource = session.classes.ResourceCatalog(
-                    parent=xnat_scan, 
-                    label=resource
-                    )
-            xnat_resource.upload(str(nii_file), nii_file.name)
-            # Move to uploaded path when done
-            move_uploaded_file(nii_file,nii_path_list,upload_pos)
-            
-            xnat_resource.upload(str(json_file), json_file.name)
-            #Move to uploaded path when done
-            move_uploaded_file(json_file,json_path_list,upload_pos)
-
-            # OPtional -bval for diffusion file
-            json_name = str(json_file)
-            bval_name = json_name.replace('.json','.bval')
-            bval_file = Path(bval_name)
-            if bval_file.exists():
-                #Move to uploaded path when done
-                move_uploaded_file(bval_file,json_path_list,upload_pos)         
-            
-            bvec_name = json_name.replace('.json','.bvec')
-            bvec_file = Path(bvec_name)
-            if bvec_file.exists():
-                #Move to uploaded path when done
-                move_uploaded_file(bvec_file,json_path_list,upload_pos)
-    return(xnat_experiment)
-
-
-def main():
-    parser = argparse.ArgumentParser(
-            description='Import WRAP to NOTEPAD XNAT')
-    parser.add_argument('--in_path', type=str,
-                    required=True,
-                    help='Path to data')
-    parser.add_argument("--stop", default=-1, type=int, help="Number of scans to start. Default is -1 which means do them all")
-    parser.add_argument("--start", default=0, type=int, help="session type (CT/MR)")
-    args = parser.parse_args()
-
-    in_dir=Path(args.in_path)
-    done_dir = in_dir / 'uploaded'
-    print(done_dir)
-    done_dir_list = list(done_dir.parts)
-    done_dir_insert_pos = len(done_dir_list)-1
-    print(done_dir_insert_pos)
-    done_dir.mkdir(parents=True,exist_ok=True)
-    max_i = args.stop
-    start_i = args.start
-    i=0
+        return(Path(*src_path_list))
+    print(f"Error in path: {upload_pos} not in list {src_path_list}")
+    return None
 
+def build_clinical_data(data_dir):
     # Read in key spreadsheets
-    subject_info_sheet = in_dir / 'Data' / 'Demographics.csv'
+    subject_info_sheet = data_dir / 'Demographics.csv'
     df_subject = pd.read_csv(subject_info_sheet,
+                             usecols=lambda c: c in subject_cols,
                              low_memory=False)
     # Set index to BID for quick indexing
     df_subject = df_subject.set_index('wrapnum')
@@ -342,9 +130,10 @@ def main():
     df_subject.loc[df_subject['hispanic_or_latino'].isna(),'ETHNIC_STR'] = "Unknown"
     df_subject['SEX_STR'] = df_subject['gender'].map(gender_map)
 
-    apoe_sheet = in_dir / 'Data' / 'APG.csv'
+    apoe_sheet = data_dir / 'APG.csv'
     df_apoe = pd.read_csv(apoe_sheet,
                           dtype = {'all1': 'str','all2':'str'},
+                          usecols=['wrapnum','all1','all2'],
                           low_memory=False)
     df_apoe = df_apoe.set_index('wrapnum')
     df_apoe = df_apoe.loc[:,['all1','all2']]
@@ -355,9 +144,10 @@ def main():
                                   right_index=True,
                                   validate="one_to_one") 
 
-    visit_info_sheet = in_dir / 'Data' / 'fqryStatisticalData.csv'
+    visit_info_sheet = data_dir / 'fqryStatisticalData.csv'
     df_visit = pd.read_csv(visit_info_sheet,
                            dtype = {'VisNo': 'str'},
+                           usecols=lambda c: c in visit_cols,
                            low_memory=False)
     df_visit = df_visit.sort_values(by=['wrapnum','VisNo'])
     df_visit = df_visit.set_index('wrapnum')
@@ -371,9 +161,11 @@ def main():
         validate="one_to_many"
         ) 
 
-    cdr_sheet = in_dir / 'Data' / 'CDR.csv'
+    cdr_sheet = data_dir / 'CDR.csv'
     df_cdr = pd.read_csv(cdr_sheet,
                          dtype = {'VisNo': 'str'},
+                         usecols=['wrapnum','VisNo','SumOfBoxes','CDRRating',
+                                  'estimated_questionnaire_days_after_baseline'],
                          low_memory=False)
     df_cdr = df_cdr.sort_values(by=['wrapnum','VisNo'])
     df_cdr = df_cdr.set_index('wrapnum')
@@ -383,85 +175,226 @@ def main():
                          'CDRRating',
                          'estimated_questionnaire_days_after_baseline']]
     
-    mmse_sheet = in_dir / 'Data' / 'NeuropsychScores.csv'
+    mmse_sheet = data_dir / 'NeuropsychScores.csv'
     df_mmse = pd.read_csv(mmse_sheet,
                           dtype = {'VisNo': 'str'},
+                          usecols=['wrapnum','VisNo','mmseTot'],
                           low_memory=False)
     df_mmse = df_mmse.sort_values(by=['wrapnum','VisNo'])
     df_mmse = df_mmse.set_index('wrapnum')
     df_mmse = df_mmse.loc[:,['VisNo','mmseTot']]
-    
+    return(df_subject_visit, df_visit, df_cdr, df_mmse)
 
-    
-    wrap_scans = in_dir.rglob('sub*.json')
-    with xnat.connect(xnat_host) as xnat_session:
-        xnat_project = xnat_session.projects[notepad_project]
-
-        for json_path in sorted(wrap_scans):
-            if i < start_i:
-                i=i+1
-                continue
-            print(f"{i} - {json_path.name}")
-            json_name = str(json_path)
-            # Check to see if there is both a JSON and a GZIPPED NII        
-            nii_name = json_name.replace('.json','.nii.gz')
-            nii_path = Path(nii_name)
-            if not nii_path.exists():
-                print('This is not a complete set, the nifti file is missing')
-                continue
-            # The file names look pretty sensible, delineated by _
-            # First split: Subject ID (sub-wrap02020)
-            # Secont split: Visit Code, really ses_age (ses-060)
-            # Third split: MOdality information (T1, FLAIR, tracer for PET)
-            image_parts = json_path.stem.split('_')
-            subject_id = image_parts[0].replace('sub-','')
-            scan_age = image_parts[1].replace('ses-','')
-            if 'trc-' in image_parts[2]:
-                modality = "PET"
-                image_type = image_parts[2].replace('trc-','')
-            else:
-                modality = "MR"
-                image_type = image_parts[2]
-            print(f"Subject ID: {subject_id}")
-            print(f"Visit ID: {scan_age}")
-            print(f"Modality: {modality}")
-            print(f"Image: {image_type}")
-            
-            # Create subject
-            xnat_subject = create_subject(xnat_session,
-                                          xnat_project,
-                                          subject_id,
-                                          df_subject_visit)
-            if xnat_subject is not None:
-                cog_values = find_cog_scores(
-                    subject_id,
-                    scan_age, 
-                    df_visit,
-                    df_cdr,
-                    df_mmse
-                    )
-                
-                if modality=="PET":
-                    radiopharm = image_type.replace("11CPiB","PIB")
-                    radiopharm = image_type.replace("18FMK6240","MK6240")
-                    radiopharm = image_type.replace("18FNAV4694","NAV4694")
-                    experiment_id = f"{subject_id}-v{scan_age}-{modality}-{radiopharm}"
-                else:
-                    experiment_id = f"{subject_id}-v{scan_age}-{modality}"
-                    
-                experiment = create_experiment(xnat_session,
-                                               xnat_subject,
-                                               modality,
-                                               experiment_id,
-                                               nii_path,
-                                               json_path,
-                                               done_dir_insert_pos,
-                                               cog_values)
-            if i >= max_i and max_i > 0:
-                print("Hit stopping condition")
-                sys.exit(1)
-            else:
-                i=i+1
+def load_clinical_data(in_dir, cache_dir=None):
+    data_dir = in_dir / 'Data'
+    sheets = [data_dir / x for x in clinical_sheets]
+    return(cached_frames('wrap_clinical', sheets,
+                         lambda: build_clinical_data(data_dir),
+                         cache_dir))
+
+def parse_scan_name(json_path):
+    # The file names look pretty sensible, delineated by _
+    # First split: Subject ID (sub-wrap02020)
+    # Secont split: Visit Code, really ses_age (ses-060)
+    # Third split: MOdality information (T1, FLAIR, tracer for PET)
+    image_parts = json_path.stem.split('_')
+    subject_id = image_parts[0].replace('sub-','')
+    scan_age = image_parts[1].replace('ses-','')
+    if 'trc-' in image_parts[2]:
+        modality = "PET"
+        image_type = image_parts[2].replace('trc-','')
+    else:
+        modality = "MR"
+        image_type = image_parts[2]
+    return(subject_id, scan_age, modality, image_type)
+
+class WrapAdapter(CohortAdapter):
+    project = notepad_project
+
+    def __init__(self, in_dir, done_dir_insert_pos,
+                 df_subject_visit, df_visit, df_cdr, df_mmse,
+                 scan_workers=1):
+        self.in_dir = in_dir
+        self.scan_workers = scan_workers
+        self.done_dir_insert_pos = done_dir_insert_pos
+        self.df_subject_visit = df_subject_visit
+        self.df_visit = df_visit
+        self.df_cdr = df_cdr
+        self.df_mmse = df_mmse
+        self.cog_table = {}
+
+    def find_scans(self):
+        # One walk of the tree finds the sidecars and what is next to them
+        # Files already moved to uploaded/ are not looked at again
+        self.file_index = FileIndex(self.in_dir, skip_dirs=('uploaded',),
+                                    workers=self.scan_workers)
+        return([x for x in self.file_index.files('sidecar')
+                if x.name.startswith('sub')])
+
+    def prepare(self, scan_paths):
+        # Look up the cognitive scores for every scan before any uploads
+        # so the upload loop only has to read from a dict
+        scan_keys = [parse_scan_name(x)[:2] for x in scan_paths]
+        with metrics.span('build_cog_table'):
+            self.cog_table = build_cog_table(scan_keys, self.df_visit,
+                                             self.df_cdr, self.df_mmse)
+
+    def parse_scan(self, json_path):
+        subject_id, scan_age, modality, image_type = parse_scan_name(json_path)
+        if modality=="PET":
+            radiopharm = image_type.replace("11CPiB","PIB")
+            radiopharm = image_type.replace("18FMK6240","MK6240")
+            radiopharm = image_type.replace("18FNAV4694","NAV4694")
+            experiment_id = f"{subject_id}-v{scan_age}-{modality}-{radiopharm}"
+            fields = {}
+        else:
+            experiment_id = f"{subject_id}-v{scan_age}-{modality}"
+            cog_outcomes = self.cog_table[(subject_id, scan_age)]
+            fields = {
+                "xnat:mrSessionData/fields/field[name=mmse]/field": cog_outcomes.MMSE,
+                "xnat:mrSessionData/fields/field[name=cdrsb]/field": cog_outcomes.CDR_Sum,
+                "xnat:mrSessionData/fields/field[name=cdrglobal]/field": cog_outcomes.CDR_Global,
+                }
+        return(ScanInfo(subject_id, experiment_id, modality, image_type, fields))
+
+    def scan_subject(self, json_path):
+        return(parse_scan_name(json_path)[0])
+
+    def subject_info(self, subject_label):
+        if subject_label not in self.df_subject_visit.index:
+            return None
+        df_subject_info = self.df_subject_visit.loc[[subject_label],:]
+        first_visit = df_subject_info.iloc[0]
+        in_education = first_visit['EducYrs']
+        if str(in_education) != "nan":
+            in_education = in_education if in_education <=30 else 30
+        in_apoe = str(first_visit['APOEGN'])
+        if in_apoe == "nan":
+            in_apoe = "NA"
+        else:
+            in_apoe = in_apoe.replace('E','')
+            in_apoe = in_apoe.replace('/','_')
+        demographics = {
+            'age': first_visit['Age_At_Baseline_Int'],
+            'gender': first_visit['SEX_STR'],
+            'ethnicity': first_visit['ETHNIC_STR'],
+            'education': in_education,
+            'race': first_visit['RACE_STR'],
+        }
+        fields = {
+            "xnat:subjectData/fields/field[name=apoe]/field": in_apoe,
+        }
+        return(SubjectInfo(demographics, fields))
+
+    def uploaded_path(self, src_file):
+        return(uploaded_file_path(list(src_file.parts),
+                                  self.done_dir_insert_pos))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Import WRAP to NOTEPAD XNAT')
+    parser.add_argument('--in_path', type=str,
+                    help='Path to data')
+    parser.add_argument("--stop", default=-1, type=int, help="Index of the last scan to import. Default is -1 which means do them all")
+    parser.add_argument("--start", default=0, type=int, help="Index of the first scan to import")
+    parser.add_argument("--shard", type=shard_spec, default=None,
+                        help="Only import the subjects in shard K of N (K/N), split by a hash of the subject ID. See shard_import.py to run every shard")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of subjects to upload at the same time. Default is 1 (one scan at a time)")
+    parser.add_argument("--scan_workers", default=1, type=int,
+                        help="Threads to list the top level directories of the data with")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory to cache the cleaned spreadsheets between runs")
+    parser.add_argument("--async_requests", default=0, type=int,
+                        help="Upload over the asyncio transport with up to this many requests in flight instead of worker threads (needs httpx)")
+    parser.add_argument("--inflight_mb", type=int, default=512,
+                        help="Most MB of files to be uploading at once, across all workers")
+    parser.add_argument("--bundle_mb", type=int, default=16,
+                        help="Files smaller than this are zipped together into one upload per resource")
+    parser.add_argument("--digest_cache", type=str, default=None,
+                        help="SQLite file to keep checksums of local files in, so unchanged files are never hashed twice")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="SQLite file recording uploads. When given, files are left in place instead of moved to uploaded/")
+    parser.add_argument("--ledger_match_content", action="store_true",
+                        help="Treat any file whose content matches an upload as done, even under another name. Hashes every file the size of one already uploaded")
+    parser.add_argument("--plan", type=str, default=None,
+                        help="Work out the import without uploading anything and write the plan to this JSON (or .parquet) file")
+    parser.add_argument("--run_plan", type=str, default=None,
+                        help="Run a plan written by --plan instead of looking at the data")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Write stage timings and REST call counts to this JSON (or .csv) file at the end of the run")
+    parser.add_argument("--progress", action='store_true',
+                        help="Show a progress line with an ETA on stderr")
+    args = parser.parse_args()
+    if args.in_path is None and args.run_plan is None:
+        parser.error("--in_path is needed unless running a saved plan")
+    metrics.start('import_wrap', args.metrics, args.progress)
+    scheduler.configure(max_bytes=args.inflight_mb * 1024 * 1024,
+                        small_file_bytes=args.bundle_mb * 1024 * 1024)
+    if args.digest_cache is not None:
+        local_digests.open(args.digest_cache)
+
+    ledger = None
+    if args.ledger is not None:
+        ledger = UploadLedger(args.ledger, args.ledger_match_content)
+
+    if args.run_plan is not None:
+        actions = read_plan(args.run_plan)
+        plan_summary(actions)
+        with xnat_sessions.connect(xnat_host) as xnat_session:
+            failures = run_plan(xnat_session, actions, ledger, args.workers)
+        if failures:
+            print(f"{len(failures)} subjects failed: {sorted(failures)}")
+            sys.exit(1)
+        return
+
+    in_dir=Path(args.in_path)
+    done_dir = in_dir / 'uploaded'
+    print(done_dir)
+    done_dir_list = list(done_dir.parts)
+    done_dir_insert_pos = len(done_dir_list)-1
+    print(done_dir_insert_pos)
+    done_dir.mkdir(parents=True,exist_ok=True)
+    max_i = args.stop
+    start_i = args.start
+
+    with metrics.span('load_clinical_data'):
+        df_subject_visit, df_visit, df_cdr, df_mmse = load_clinical_data(
+            in_dir, args.cache_dir)
+
+    adapter = WrapAdapter(in_dir, done_dir_insert_pos,
+                          df_subject_visit, df_visit, df_cdr, df_mmse,
+                          args.scan_workers)
+    with metrics.span('find_scans'):
+        scan_list = adapter.find_scans()
+    stop_i = max_i + 1 if max_i > 0 else len(scan_list)
+    scan_window = range(start_i, min(stop_i, len(scan_list)))
+    indexed_scans = [(x, scan_list[x]) for x in scan_window]
+    if args.shard is not None:
+        indexed_scans = shard_scans(adapter, indexed_scans, args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: {len(indexed_scans)} of {len(scan_window)} scans")
+
+    with xnat_sessions.connect(xnat_host) as xnat_session:
+        with metrics.span('inventory'):
+            inventory = ProjectInventory(xnat_session, notepad_project)
+        if args.plan is not None:
+            with metrics.span('plan'):
+                plan = plan_import(adapter, indexed_scans, inventory,
+                                   ledger, args.workers)
+            plan_summary(plan.actions)
+            write_plan(plan, args.plan)
+            return
+        if args.async_requests <= 0:
+            failures = run_import(xnat_session, adapter, indexed_scans,
+                                  inventory, ledger, args.workers)
+    if args.async_requests > 0:
+        failures = run_import_async(xnat_host, adapter, indexed_scans,
+                                    inventory, ledger, args.async_requests)
+    if failures:
+        print(f"{len(failures)} subjects failed: {sorted(failures)}")
+        sys.exit(1)
+    if max_i > 0 and stop_i <= len(scan_list):
+        print(f"Stopped at scan {stop_i - 1} of {len(scan_list)}")
 
         
 if __name__ == "__main__":
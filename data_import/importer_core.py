@@ -0,0 +1,626 @@
+import asyncio
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from parallel_upload import buffered_stdout, scan_log, \
+    run_grouped
+from run_metrics import metrics
+from upload_scheduler import scheduler
+from async_xnat import AsyncXnatSession
+from xnat_sessions import xnat_sessions
+from import_plan import ImportPlan
+from sharding import subject_shard
+
+# Ingestion engine shared by the BIDS importers (WRAP, A4/LEARN).
+# Creating subjects, MR/PET sessions, scans and BIDS resources and
+# uploading the files lives here once. Each cohort supplies an adapter
+# that knows how its files are named and where its clinical data is,
+# so caching, batching and concurrency changes apply to every cohort.
+# ADNI goes through the import service for DICOM, but shares the
+# subject and resource helpers.
+
+# Demographics for a new subject and its custom fields
+SubjectInfo = namedtuple("SubjectInfo", ["demographics", "fields"])
+# What the engine needs to know about one BIDS image
+ScanInfo = namedtuple("ScanInfo",
+                      ["subject_label", "experiment_label", "modality",
+                       "image_type", "fields"])
+
+
+def bids_extract(data,key,default):
+    output = default
+    if key in data:
+        output = str(data[key])
+    return(output)
+
+def load_sidecar(json_file):
+    with open(json_file,'r') as sidecar:
+        return(json.load(sidecar))
+
+def is_missing(value):
+    return(value is None or str(value) == "nan")
+
+def object_values(xsi_type, attributes, fields=None):
+    # Gather everything to write for one object as XNAT query string
+    # xpaths. attributes are relative to the object
+    # (demographics[@xsi:type=xnat:demographicData]/age), fields are
+    # custom fields already given as full xpaths
+    values = {f"{xsi_type}/{k}": v for k, v in attributes.items()}
+    values.update(fields or {})
+    return({k: str(v) for k, v in values.items() if not is_missing(v)})
+
+def put_object(session, uri, xsi_type, values, span):
+    # Create (or update) an object with all of its values in one PUT
+    # instead of creating it and then setting each value with its own call.
+    # XNAT answers with the ID of the object
+    query = {'xsiType': xsi_type, 'req_format': 'qs'}
+    query.update(values)
+    with metrics.span(span):
+        response = session.put(path=uri, query=query)
+    return(response.text.strip())
+
+def demographic_values(demographics):
+    return({f"demographics[@xsi:type=xnat:demographicData]/{k}": v
+            for k, v in demographics.items()})
+
+
+class CohortAdapter:
+    # Per-cohort part of an import. Subclasses fill in how scans are
+    # found and named, and the clinical data for subjects and sessions
+    project = None
+    # FileIndex made by find_scans, so checking for the NIfTI and
+    # bval/bvec next to a sidecar needs no stat calls
+    file_index = None
+
+    def find_scans(self):
+        # Sorted list of the BIDS JSON sidecars to import
+        raise NotImplementedError
+
+    def prepare(self, scan_paths):
+        # Chance to look up everything for these scans in bulk
+        pass
+
+    def parse_scan(self, json_path):
+        # ScanInfo for this sidecar, or None to skip it
+        raise NotImplementedError
+
+    def scan_subject(self, json_path):
+        # Subject label of a sidecar from its name alone, for sharding
+        raise NotImplementedError
+
+    def subject_info(self, subject_label):
+        # SubjectInfo, or None if the subject is not in the spreadsheets
+        raise NotImplementedError
+
+    def has_file(self, file_path):
+        if self.file_index is None:
+            return(file_path.exists())
+        return(self.file_index.exists(file_path))
+
+    def mark_uploaded(self, src_file, ledger=None, target=None):
+        # With a ledger the file stays where it is and the upload is recorded
+        # Otherwise fall back to moving it into the uploaded directory
+        if ledger is not None:
+            ledger.record(src_file, **target)
+        else:
+            self.move_uploaded(src_file)
+
+    def uploaded_path(self, src_file):
+        # Where move_uploaded puts a file, or None to leave it
+        return(src_file.parent / 'uploaded' / src_file.name)
+
+    def move_uploaded(self, src_file):
+        src_new_path = self.uploaded_path(src_file)
+        if src_new_path is None:
+            return
+        src_new_path.parent.mkdir(parents=True,exist_ok=True)
+        src_file.rename(src_new_path)
+
+
+def subject_uri(project_id, subject_label):
+    return(f"/data/projects/{project_id}/subjects/{subject_label}")
+
+def subject_values(demographics, fields):
+    return(object_values("xnat:subjectData",
+                         demographic_values(demographics), fields))
+
+def experiment_values(scan_info, bids_data):
+    # xsiType and everything to set on a new MR or PET session
+    attributes = {
+        'scanner/manufacturer': bids_extract(bids_data, 'Manufacturer', 'Unknown'),
+    }
+    if scan_info.modality == "MR":
+        xsi_type = "xnat:mrSessionData"
+        attributes['fieldStrength'] = bids_extract(
+            bids_data, 'MagneticFieldStrength', 'Not specified')
+    else:
+        xsi_type = "xnat:petSessionData"
+        attributes['tracer/name'] = bids_extract(
+            bids_data, 'Radiopharmaceutical', 'Unknown')
+        attributes['tracer/dose'] = bids_extract(
+            bids_data, 'InjectedRadioactivity', '0.0')
+    return(xsi_type, object_values(xsi_type, attributes, scan_info.fields))
+
+def scan_values(modality, bids_data):
+    # xsiType and everything to set on a new MR or PET scan
+    if modality == "MR":
+        xsi_type = "xnat:mrScanData"
+        series_description = bids_extract(bids_data, "SeriesDescription", "T1")
+        attributes = {
+            'parameters/te': bids_extract(bids_data, 'EchoTime', '0.0'),
+            'parameters/tr': bids_extract(bids_data, 'RepetitionTime', '0.0'),
+            'parameters/ti': bids_extract(bids_data, 'InversionTime', '0.0'),
+        }
+    else:
+        xsi_type = "xnat:petScanData"
+        series_description = bids_extract(bids_data, "SeriesDescription", "PET AC")
+        attributes = {}
+    attributes['type'] = series_description
+    attributes['series_description'] = series_description
+    return(xsi_type, object_values(xsi_type, attributes))
+
+def put_subject(session, project_id, subject_label, demographics, fields):
+    return(put_object(session, subject_uri(project_id, subject_label),
+                      "xnat:subjectData", subject_values(demographics, fields),
+                      'create_subject'))
+
+def create_subject(session, project_id, subject_label, subject_info, inventory):
+    if inventory.has_subject(subject_label):
+        print("Subject already in project")
+        return(inventory.subject_object(subject_label))
+    if subject_info is None:
+        print("This subject ID is not in the main subject info spreadsheet")
+        return None
+    print("Creating Subject")
+    subject_id = put_subject(session, project_id, subject_label,
+                             subject_info.demographics, subject_info.fields)
+    inventory.add_subject(subject_label, subject_id)
+    print(f"Subject created {subject_label}")
+    return(inventory.subject_object(subject_label))
+
+def create_experiment(session, project_id, scan_info, bids_data, inventory):
+    experiment_label = scan_info.experiment_label
+    if inventory.has_experiment(experiment_label):
+        print("Session already in project")
+        return(inventory.experiment_object(experiment_label))
+    print(f"Creating Session {experiment_label}")
+    xsi_type, values = experiment_values(scan_info, bids_data)
+    experiment_id = put_object(
+        session,
+        f"{subject_uri(project_id, scan_info.subject_label)}/experiments/{experiment_label}",
+        xsi_type, values, 'create_experiment')
+    inventory.register_experiment(experiment_label, experiment_id,
+                                  scan_info.subject_label, xsi_type)
+    return(inventory.experiment_object(experiment_label))
+
+def create_scan(session, experiment_label, modality, series_number,
+                bids_data, inventory):
+    xsi_type, values = scan_values(modality, bids_data)
+    put_object(session,
+               f"{inventory.experiment_uri(experiment_label)}/scans/{series_number}",
+               xsi_type, values, 'create_scan')
+    inventory.add_scan(experiment_label, series_number)
+    return(inventory.scan_object(experiment_label, series_number, xsi_type))
+
+def get_resource(session, experiment_label, scan_id, resource_label,
+                 inventory):
+    # URI of the scan resource, made first if it is not there yet
+    resource_uri = inventory.resource_uri(experiment_label, scan_id,
+                                          resource_label)
+    if inventory.has_resource(experiment_label, scan_id, resource_label):
+        return(resource_uri)
+    with metrics.span('create_resource'):
+        session.put(path=resource_uri,
+                    query={'xsiType': 'xnat:resourceCatalog'})
+    inventory.add_resource(experiment_label, scan_id, resource_label)
+    return(resource_uri)
+
+def scan_files(adapter, json_path, scan_info, ledger=None):
+    # The NIfTI and any bval/bvec that go with a sidecar,
+    # or None if this scan should not be imported
+    # Check to see if there is both a JSON and a GZIPPED NII
+    nii_path = Path(str(json_path).replace('.json','.nii.gz'))
+    if not adapter.has_file(nii_path):
+        print('This is not a complete set, the nifti file is missing')
+        return None
+    if scan_info is None:
+        return None
+    if ledger is not None:
+        target = {'project': adapter.project,
+                  'subject': scan_info.subject_label,
+                  'experiment': scan_info.experiment_label}
+        if ledger.is_done(json_path, target) and \
+                ledger.is_done(nii_path, target):
+            print('Already uploaded according to the ledger, skipping')
+            return None
+    print(f"Subject ID: {scan_info.subject_label}")
+    print(f"Session: {scan_info.experiment_label}")
+    print(f"Modality: {scan_info.modality}")
+    print(f"Image: {scan_info.image_type}")
+    # Optional bval/bvec for diffusion go along with the sidecar
+    extra_files = [Path(str(json_path).replace('.json', x))
+                   for x in ('.bval', '.bvec')]
+    extra_files = [x for x in extra_files if adapter.has_file(x)]
+    return(nii_path, extra_files)
+
+def ledger_target(adapter, scan_info, series_number, resource):
+    return({
+        'project': adapter.project,
+        'subject': scan_info.subject_label,
+        'experiment': scan_info.experiment_label,
+        'scan': series_number,
+        'resource': resource,
+    })
+
+def import_scan(session, adapter, json_path, scan_info,
+                inventory, ledger=None):
+    found_files = scan_files(adapter, json_path, scan_info, ledger)
+    if found_files is None:
+        return None
+    nii_path, extra_files = found_files
+
+    xnat_subject = create_subject(session, adapter.project,
+                                  scan_info.subject_label,
+                                  adapter.subject_info(scan_info.subject_label),
+                                  inventory)
+    if xnat_subject is None:
+        return None
+    bids_data = load_sidecar(json_path)
+    xnat_experiment = create_experiment(session, adapter.project,
+                                        scan_info, bids_data, inventory)
+
+    resource = "BIDS"
+    experiment_label = scan_info.experiment_label
+    series_number = bids_extract(bids_data,"SeriesNumber",3)
+    target = ledger_target(adapter, scan_info, series_number, resource)
+
+    # Diffusion bval/bvec go in the resource with the NIfTI and sidecar
+    src_files = [nii_path, json_path] + extra_files
+
+    if inventory.has_scan(experiment_label, series_number):
+        # This data has already been uploaded
+        for src_file in src_files:
+            adapter.mark_uploaded(src_file, ledger, target)
+        return(xnat_experiment)
+
+    create_scan(session, experiment_label, scan_info.modality,
+                series_number, bids_data, inventory)
+    resource_uri = get_resource(session, experiment_label, series_number,
+                                resource, inventory)
+    scheduler.upload(session, resource_uri, src_files)
+    for src_file in src_files:
+        adapter.mark_uploaded(src_file, ledger, target)
+    return(xnat_experiment)
+
+def import_subject_scans(session, adapter, indexed_scans,
+                         scan_infos, inventory, ledger=None,
+                         thread_stdout=None):
+    # All scans for one subject go through the same worker in order
+    # so create_subject/create_experiment never race for a subject
+    for i, json_path in indexed_scans:
+        with scan_log(thread_stdout):
+            print(f"{i} - {json_path.name}")
+            with metrics.span('import_scan'):
+                import_scan(session, adapter, json_path,
+                            scan_infos[json_path], inventory, ledger)
+        metrics.step(json_path.name)
+
+def prepare_scans(adapter, indexed_scans):
+    with metrics.span('prepare_scans'):
+        adapter.prepare([x[1] for x in indexed_scans])
+        scan_infos = {x[1]: adapter.parse_scan(x[1]) for x in indexed_scans}
+    metrics.add_total(len(indexed_scans))
+    return(scan_infos)
+
+def shard_scans(adapter, indexed_scans, shard):
+    # Only the scans of subjects in shard (K, N), keeping their indexes
+    shard_index, n_shards = shard
+    return([x for x in indexed_scans
+            if subject_shard(adapter.scan_subject(x[1]), n_shards) == shard_index])
+
+def group_by_subject(indexed_scans, scan_infos):
+    subject_scans = {}
+    for i, json_path in indexed_scans:
+        scan_info = scan_infos[json_path]
+        subject_label = "" if scan_info is None else scan_info.subject_label
+        subject_scans.setdefault(subject_label, []).append((i, json_path))
+    return(subject_scans)
+
+def run_import(session, adapter, indexed_scans, inventory,
+               ledger=None, workers=1):
+    """
+    Import (index, json_path) pairs with the cohort adapter.
+    With more than one worker each subject's scans go to one thread.
+    Returns a dict of subject label to the exception that stopped it.
+    """
+    scan_infos = prepare_scans(adapter, indexed_scans)
+
+    if workers <= 1:
+        import_subject_scans(session, adapter, indexed_scans,
+                             scan_infos, inventory, ledger)
+        return({})
+
+    subject_scans = group_by_subject(indexed_scans, scan_infos)
+    print(f"{len(subject_scans)} subjects across {workers} workers")
+    xnat_sessions.ensure_pool(session, workers)
+    with buffered_stdout() as thread_stdout:
+        failures = run_grouped(
+            subject_scans,
+            lambda subject_label, subject_indexed: import_subject_scans(
+                session, adapter, subject_indexed,
+                scan_infos, inventory, ledger, thread_stdout),
+            workers)
+    return(failures)
+
+
+# Planning the same import without sending anything (see import_plan),
+# and running a saved plan
+
+def plan_scan(plan, adapter, json_path, scan_info, inventory, ledger=None):
+    # Adds the actions import_scan would take for one sidecar
+    found_files = scan_files(adapter, json_path, scan_info, ledger)
+    if found_files is None:
+        return
+    nii_path, extra_files = found_files
+    subject_label = scan_info.subject_label
+    new_subject_uri = subject_uri(adapter.project, subject_label)
+    if not inventory.has_subject(subject_label) and \
+            not plan.has(new_subject_uri):
+        subject_info = adapter.subject_info(subject_label)
+        if subject_info is None:
+            print("This subject ID is not in the main subject info spreadsheet")
+            return
+        plan.add('create_subject', subject_label, new_subject_uri,
+                 xsi_type="xnat:subjectData",
+                 values=subject_values(subject_info.demographics,
+                                       subject_info.fields))
+
+    bids_data = load_sidecar(json_path)
+    experiment_label = scan_info.experiment_label
+    if inventory.has_experiment(experiment_label):
+        experiment_uri = inventory.experiment_uri(experiment_label)
+    else:
+        experiment_uri = f"{new_subject_uri}/experiments/{experiment_label}"
+        if not plan.has(experiment_uri):
+            xsi_type, values = experiment_values(scan_info, bids_data)
+            plan.add('create_experiment', subject_label, experiment_uri,
+                     after=new_subject_uri, xsi_type=xsi_type, values=values)
+
+    resource = "BIDS"
+    series_number = bids_extract(bids_data,"SeriesNumber",3)
+    target = ledger_target(adapter, scan_info, series_number, resource)
+    src_files = [nii_path, json_path] + extra_files
+    move_to = [adapter.uploaded_path(x) or x for x in src_files]
+    scan_uri = f"{experiment_uri}/scans/{series_number}"
+    if inventory.has_scan(experiment_label, series_number) or \
+            plan.has(scan_uri):
+        # This data has already been uploaded
+        plan.add_mark(subject_label, src_files, target, scan_uri,
+                      move_to=move_to)
+        return
+
+    xsi_type, values = scan_values(scan_info.modality, bids_data)
+    plan.add('create_scan', subject_label, scan_uri, after=experiment_uri,
+             xsi_type=xsi_type, values=values)
+    resource_uri = f"{scan_uri}/resources/{resource}"
+    plan.add('create_resource', subject_label, resource_uri, after=scan_uri,
+             xsi_type='xnat:resourceCatalog')
+    upload_step = plan.add_upload(subject_label, resource_uri, src_files)
+    plan.add_mark(subject_label, src_files, target, upload_step,
+                  move_to=move_to)
+
+def plan_subject_scans(adapter, indexed_scans, scan_infos, inventory,
+                       ledger=None, thread_stdout=None):
+    plan = ImportPlan(adapter.project)
+    for i, json_path in indexed_scans:
+        with scan_log(thread_stdout):
+            print(f"{i} - {json_path.name}")
+            plan_scan(plan, adapter, json_path, scan_infos[json_path],
+                      inventory, ledger)
+    return(plan)
+
+def plan_import(adapter, indexed_scans, inventory, ledger=None, workers=1):
+    """
+    The ImportPlan of what run_import would do with these scans,
+    worked out from the files, the spreadsheets and the inventory only.
+    Subjects are planned on up to workers threads.
+    """
+    scan_infos = prepare_scans(adapter, indexed_scans)
+    subject_scans = group_by_subject(indexed_scans, scan_infos)
+    plan = ImportPlan(adapter.project)
+    with buffered_stdout() as thread_stdout, \
+            ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for subject_plan in executor.map(
+                lambda x: plan_subject_scans(
+                    adapter, x, scan_infos, inventory, ledger,
+                    thread_stdout if workers > 1 else None),
+                subject_scans.values()):
+            plan.extend(subject_plan)
+    return(plan)
+
+def put_planned(session, planned, ledger):
+    put_object(session, planned['uri'], planned['xsi_type'],
+               planned['values'], planned['action'])
+
+def create_planned_resource(session, planned, ledger):
+    with metrics.span('create_resource'):
+        session.put(path=planned['uri'],
+                    query={'xsiType': planned['xsi_type']})
+
+def upload_planned(session, planned, ledger):
+    src_files = [Path(x) for x in planned['files']]
+    target = {'project': planned['project'], 'subject': planned['subject']}
+    if ledger is not None and all(ledger.is_done(x, target) for x in src_files):
+        print(f"Already uploaded according to the ledger, skipping {planned['uri']}")
+        return
+    scheduler.upload(session, planned['uri'], src_files)
+
+def mark_planned(session, planned, ledger):
+    src_files = [Path(x) for x in planned['files']]
+    if ledger is not None:
+        ledger.record_many(src_files, **planned['target'])
+    elif planned['local_action'] == 'move':
+        for src_file, done_path in zip(src_files, planned['move_to']):
+            done_path = Path(done_path)
+            if done_path != src_file:
+                done_path.parent.mkdir(parents=True,exist_ok=True)
+                src_file.rename(done_path)
+    elif planned['local_action'] == 'delete':
+        for src_file in src_files:
+            src_file.unlink()
+
+# What to do for each kind of planned action.
+# Importers with their own kinds of action pass extra handlers to run_plan
+plan_handlers = {
+    'create_subject': put_planned,
+    'create_experiment': put_planned,
+    'create_scan': put_planned,
+    'update_scan': put_planned,
+    'create_resource': create_planned_resource,
+    'upload': upload_planned,
+    'mark_uploaded': mark_planned,
+}
+
+def run_subject_plan(session, subject_label, subject_actions, handlers,
+                     ledger=None, thread_stdout=None):
+    with scan_log(thread_stdout):
+        print(f"=== {subject_label}: {len(subject_actions)} actions")
+        for planned in subject_actions:
+            print(f"{planned['step']} {planned['action']} {planned['uri']}")
+            handlers[planned['action']](session, planned, ledger)
+    metrics.step(subject_label)
+
+def run_plan(session, actions, ledger=None, workers=1, handlers=None):
+    """
+    Run the actions of a saved plan. Each subject's actions run in
+    order on one thread, with up to workers subjects at once.
+    Returns a dict of subject label to the exception that stopped it.
+    """
+    handlers = dict(plan_handlers, **(handlers or {}))
+    subject_actions = {}
+    for planned in actions:
+        subject_actions.setdefault(planned['subject'], []).append(planned)
+    metrics.add_total(len(subject_actions))
+    workers = max(workers, 1)
+    xnat_sessions.ensure_pool(session, workers)
+    with buffered_stdout() as thread_stdout:
+        failures = run_grouped(
+            subject_actions,
+            lambda subject_label, subject_planned: run_subject_plan(
+                session, subject_label, subject_planned, handlers, ledger,
+                thread_stdout if workers > 1 else None),
+            workers)
+    return(failures)
+
+# The same import over the asyncio transport. Each subject is a task,
+# so its scans still go in order, and the session caps the requests
+# in flight rather than a pool of threads
+
+async def import_scan_async(session, adapter, json_path, scan_info,
+                            inventory, ledger=None):
+    found_files = scan_files(adapter, json_path, scan_info, ledger)
+    if found_files is None:
+        return None
+    nii_path, extra_files = found_files
+    subject_label = scan_info.subject_label
+    if not inventory.has_subject(subject_label):
+        subject_info = adapter.subject_info(subject_label)
+        if subject_info is None:
+            print("This subject ID is not in the main subject info spreadsheet")
+            return None
+        with metrics.span('create_subject'):
+            subject_id = await session.put_object(
+                subject_uri(adapter.project, subject_label),
+                "xnat:subjectData",
+                subject_values(subject_info.demographics, subject_info.fields))
+        inventory.add_subject(subject_label, subject_id)
+
+    bids_data = load_sidecar(json_path)
+    experiment_label = scan_info.experiment_label
+    if not inventory.has_experiment(experiment_label):
+        xsi_type, values = experiment_values(scan_info, bids_data)
+        with metrics.span('create_experiment'):
+            experiment_id = await session.put_object(
+                f"{subject_uri(adapter.project, subject_label)}/experiments/{experiment_label}",
+                xsi_type, values)
+        inventory.register_experiment(experiment_label, experiment_id,
+                                      subject_label, xsi_type)
+
+    resource = "BIDS"
+    series_number = bids_extract(bids_data,"SeriesNumber",3)
+    target = ledger_target(adapter, scan_info, series_number, resource)
+    src_files = [nii_path, json_path] + extra_files
+    if inventory.has_scan(experiment_label, series_number):
+        # This data has already been uploaded
+        for src_file in src_files:
+            adapter.mark_uploaded(src_file, ledger, target)
+        return experiment_label
+
+    xsi_type, values = scan_values(scan_info.modality, bids_data)
+    with metrics.span('create_scan'):
+        await session.put_object(
+            f"{inventory.experiment_uri(experiment_label)}/scans/{series_number}",
+            xsi_type, values)
+    inventory.add_scan(experiment_label, series_number)
+    # A new scan can't have the resource yet
+    resource_uri = inventory.resource_uri(experiment_label, series_number,
+                                          resource)
+    with metrics.span('create_resource'):
+        await session.put(resource_uri, {'xsiType': 'xnat:resourceCatalog'})
+    inventory.add_resource(experiment_label, series_number, resource)
+    await scheduler.upload_async(session, resource_uri, src_files)
+    for src_file in src_files:
+        adapter.mark_uploaded(src_file, ledger, target)
+    return experiment_label
+
+async def import_subject_scans_async(session, adapter, indexed_scans,
+                                     scan_infos, inventory, ledger=None,
+                                     thread_stdout=None):
+    # Each task has its own buffer, so scans still log in one block
+    for i, json_path in indexed_scans:
+        with scan_log(thread_stdout):
+            print(f"{i} - {json_path.name}")
+            with metrics.span('import_scan'):
+                await import_scan_async(session, adapter, json_path,
+                                        scan_infos[json_path], inventory,
+                                        ledger)
+        metrics.step(json_path.name)
+
+async def import_subjects_async(xnat_host, adapter, subject_scans,
+                                scan_infos, inventory, ledger,
+                                max_in_flight, thread_stdout=None):
+    async with AsyncXnatSession(xnat_host, max_in_flight,
+                                cookies=xnat_sessions.cookies(xnat_host)) as session:
+        subject_labels = list(subject_scans)
+        results = await asyncio.gather(
+            *[import_subject_scans_async(session, adapter,
+                                         subject_scans[x], scan_infos,
+                                         inventory, ledger, thread_stdout)
+              for x in subject_labels],
+            return_exceptions=True)
+    failures = {}
+    for subject_label, result in zip(subject_labels, results):
+        if isinstance(result, Exception):
+            print(f"[ERROR] {subject_label} failed: {type(result).__name__}: {result}")
+            failures[subject_label] = result
+    return(failures)
+
+def run_import_async(xnat_host, adapter, indexed_scans, inventory,
+                     ledger=None, max_in_flight=100):
+    """
+    Same as run_import, but over the asyncio transport with up to
+    max_in_flight requests to xnat_host at once. Needs httpx.
+    The inventory should already be loaded, and the login of the
+    shared session for xnat_host is reused if there is one.
+    """
+    scan_infos = prepare_scans(adapter, indexed_scans)
+    subject_scans = group_by_subject(indexed_scans, scan_infos)
+    print(f"{len(subject_scans)} subjects with up to {max_in_flight} requests in flight")
+    with buffered_stdout() as thread_stdout:
+        failures = asyncio.run(import_subjects_async(xnat_host, adapter,
+                                                     subject_scans, scan_infos,
+                                                     inventory, ledger,
+                                                     max_in_flight,
+                                                     thread_stdout))
+    return(failures)
@@ -0,0 +1,331 @@
+import argparse
+import importlib
+import json
+import math
+import subprocess
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from run_metrics import metrics
+from upload_scheduler import scheduler
+from file_digest import local_digests
+from upload_ledger import UploadLedger
+from xnat_sessions import xnat_sessions
+from parallel_upload import buffered_stdout
+from import_plan import read_plan
+from importer_core import plan_handlers, run_subject_plan
+
+# Long running ingest service for all the cohorts, so the imports share
+# the NOTEPAD server instead of fighting over it.
+# Every interval each cohort's importer is run with --plan (the same
+# main() as an ad hoc run, so the same spreadsheets, ledgers and checks)
+# and the subjects in its plan go into one work queue. A pool of
+# workers takes subjects from the queue and runs their actions in this
+# process, so the limits below hold across every cohort:
+#   - the highest priority cohort with work waiting goes first, and
+#     cohorts of the same priority get the server in proportion to
+#     their share, counting bytes sent and requests made
+#   - at most --max_uploads uploads at once, and at most --inflight_mb
+#     being sent at once (the upload scheduler's byte budget)
+#   - the number of subjects running is halved when the median time of
+#     small requests goes over --latency_ms, and raised again by one at
+#     a time once the server is quick again
+# A cohort is only planned again once all of its subjects have run.
+# Failed subjects are left as they are and turn up in the next plan.
+# Cohorts that can't be planned (e.g. DIAN, which copies between
+# servers) can be run as a command, which takes one worker while it runs.
+#
+# The config is a JSON list of cohorts, e.g.
+# [
+#  {"name": "wrap", "importer": "import_wrap", "priority": 1, "share": 2,
+#   "args": ["--in_path", "/data/wrap"], "ledger": "/data/ledgers/wrap.sqlite"},
+#  {"name": "adni", "importer": "import_adni", "share": 1,
+#   "args": ["--batch_root", "/data/adni", "--mr_study", "..."]},
+#  {"name": "dian", "importer": "import_dian", "mode": "command",
+#   "args": ["--mr_sessions", "...", "--pet_sessions", "..."]}
+# ]
+
+script_dir = Path(__file__).resolve().parent
+# A request costs the same share of the server as sending this many bytes
+request_cost_bytes = 1024 * 1024
+poll_seconds = 1
+
+# One subject of a cohort's plan, or a whole command run (actions is None)
+Work = namedtuple("Work", ["cohort", "subject", "actions", "cost"])
+
+
+class Cohort:
+    def __init__(self, config, plan_dir):
+        self.name = config['name']
+        self.importer = config['importer']
+        self.args = [str(x) for x in config.get('args', [])]
+        self.priority = config.get('priority', 0)
+        self.share = config.get('share', 1)
+        self.mode = config.get('mode', 'plan')
+        self.ledger_path = config.get('ledger')
+        self.plan_path = Path(plan_dir) / f"{self.name}.json"
+        self.ledger = None
+        if self.ledger_path is not None:
+            self.ledger = UploadLedger(self.ledger_path)
+        self.host = None
+        self.handlers = dict(plan_handlers)
+        if self.mode == 'plan':
+            # The importer's own host and any actions only it plans
+            module = importlib.import_module(self.importer)
+            self.host = module.xnat_host
+            if hasattr(module, 'plan_handlers'):
+                self.handlers.update(module.plan_handlers())
+
+    def command(self):
+        command = [sys.executable, str(script_dir / f"{self.importer}.py")] + self.args
+        if self.ledger_path is not None:
+            command = command + ['--ledger', str(self.ledger_path)]
+        return(command)
+
+
+class WorkQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Cohort -> deque of Work, cohort -> cost served / share
+        self.pending = {}
+        self.served = {}
+
+    def put(self, work):
+        cohort = work.cohort
+        with self.lock:
+            waiting = self.pending.setdefault(cohort, deque())
+            if not waiting:
+                # A cohort that has been idle starts level with the
+                # busy ones rather than getting everything until it
+                # catches up
+                served = self.served.get(cohort, 0.0)
+                busy = [self.served[x] for x, y in self.pending.items() if y]
+                if busy:
+                    served = max(served, min(busy))
+                self.served[cohort] = served
+            waiting.append(work)
+
+    def take(self):
+        # Next Work to run, or None if nothing is waiting
+        with self.lock:
+            waiting = [x for x, y in self.pending.items() if y]
+            if not waiting:
+                return None
+            top_priority = max(x.priority for x in waiting)
+            cohort = min((x for x in waiting if x.priority == top_priority),
+                         key=lambda x: self.served[x])
+            work = self.pending[cohort].popleft()
+            self.served[cohort] = self.served[cohort] + work.cost / cohort.share
+            return(work)
+
+    def clear(self):
+        with self.lock:
+            for waiting in self.pending.values():
+                waiting.clear()
+
+    def __len__(self):
+        with self.lock:
+            return(sum(len(x) for x in self.pending.values()))
+
+
+class LatencyGovernor:
+    # How many subjects may run at once. Halved when the median latency
+    # of small requests goes over the target and raised by one while it
+    # is under half the target, checked every check_seconds
+    def __init__(self, max_running, target_seconds, check_seconds=30):
+        self.max_running = max_running
+        self.limit = max_running
+        self.target_seconds = target_seconds
+        self.check_seconds = check_seconds
+        self.last_check = time.monotonic()
+
+    def update(self):
+        now = time.monotonic()
+        if now - self.last_check < self.check_seconds:
+            return(self.limit)
+        self.last_check = now
+        latency = metrics.recent_latency(self.check_seconds)
+        if latency is None:
+            return(self.limit)
+        if latency > self.target_seconds and self.limit > 1:
+            self.limit = max(1, self.limit // 2)
+            metrics.count('backoffs')
+            print(f"[WARNING] Median request took {latency:.2f}s, running at most {self.limit} subjects")
+        elif latency < self.target_seconds / 2 and self.limit < self.max_running:
+            self.limit = self.limit + 1
+            print(f"Median request took {latency:.2f}s, running up to {self.limit} subjects")
+        return(self.limit)
+
+
+def limit_uploads(handler, upload_slots, reserve_bytes=False):
+    # Wraps an action handler so it waits for an upload slot. Uploads
+    # through the scheduler already wait on its byte budget, anything
+    # else that sends files (reserve_bytes) waits on it here
+    def run_limited(xnat_session, planned, ledger):
+        with upload_slots:
+            if not reserve_bytes:
+                return(handler(xnat_session, planned, ledger))
+            with scheduler.budget.reserve(planned['bytes']):
+                return(handler(xnat_session, planned, ledger))
+    return(run_limited)
+
+
+def plan_cohort(cohort):
+    # Run the cohort's importer with --plan and split the plan by subject
+    print(f"Planning {cohort.name}")
+    log_path = cohort.plan_path.with_suffix('.log')
+    cohort.plan_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, 'w') as log_file, metrics.span('plan'):
+        # Run from our working directory, so the plan, the ledger and
+        # any paths in the cohort's args are the files we read and write
+        subprocess.run(cohort.command() + ['--plan', str(cohort.plan_path)],
+                       stdout=log_file, stderr=subprocess.STDOUT, check=True)
+    subject_actions = {}
+    for planned in read_plan(cohort.plan_path):
+        subject_actions.setdefault(planned['subject'], []).append(planned)
+    print(f"{cohort.name}: {len(subject_actions)} subjects to import")
+    return([Work(cohort, subject_label, actions,
+                 sum(x['bytes'] + x['requests'] * request_cost_bytes
+                     for x in actions))
+            for subject_label, actions in subject_actions.items()])
+
+
+def run_work(work, thread_stdout=None):
+    cohort = work.cohort
+    if work.actions is None:
+        print(f"Running {cohort.name}")
+        with metrics.span(f'command_{cohort.name}'):
+            subprocess.run(cohort.command(), check=True)
+        metrics.step(cohort.name)
+        return
+    xnat_session = xnat_sessions.get(cohort.host)
+    run_subject_plan(xnat_session, work.subject, work.actions,
+                     cohort.handlers, cohort.ledger, thread_stdout)
+
+
+def run_daemon(cohorts, max_running, target_seconds, interval_seconds):
+    """
+    Plan and import the cohorts until interrupted. With interval_seconds
+    of 0 each cohort is planned and imported once and then it returns.
+    Returns the number of subjects that failed.
+    """
+    work_queue = WorkQueue()
+    governor = LatencyGovernor(max_running, target_seconds)
+    next_plan = {x: 0 for x in cohorts}
+    # Work queued or running for each cohort
+    busy = {x: 0 for x in cohorts}
+    planning = {}
+    running = {}
+    n_failed = 0
+    with buffered_stdout() as thread_stdout, \
+            ThreadPoolExecutor(max_workers=1) as planner, \
+            ThreadPoolExecutor(max_workers=max_running) as workers:
+        try:
+            while True:
+                now = time.monotonic()
+                for cohort in cohorts:
+                    if busy[cohort] > 0 or now < next_plan[cohort] or \
+                            cohort in planning.values():
+                        continue
+                    next_plan[cohort] = now + interval_seconds if interval_seconds > 0 else math.inf
+                    if cohort.mode == 'command':
+                        work_queue.put(Work(cohort, cohort.name, None, 0))
+                        busy[cohort] = 1
+                        metrics.add_total(1)
+                    else:
+                        planning[planner.submit(plan_cohort, cohort)] = cohort
+
+                for future in [x for x in planning if x.done()]:
+                    cohort = planning.pop(future)
+                    if future.exception() is not None:
+                        print(f"[ERROR] Planning {cohort.name} failed: {future.exception()}")
+                        continue
+                    work_list = future.result()
+                    for work in work_list:
+                        work_queue.put(work)
+                    busy[cohort] = busy[cohort] + len(work_list)
+                    metrics.add_total(len(work_list))
+
+                for future in [x for x in running if x.done()]:
+                    work = running.pop(future)
+                    busy[work.cohort] = busy[work.cohort] - 1
+                    error = future.exception()
+                    if error is not None:
+                        print(f"[ERROR] {work.cohort.name} {work.subject} failed: {type(error).__name__}: {error}")
+                        metrics.count('subjects_failed')
+                        n_failed = n_failed + 1
+
+                limit = governor.update()
+                while len(running) < limit:
+                    work = work_queue.take()
+                    if work is None:
+                        break
+                    running[workers.submit(run_work, work, thread_stdout)] = work
+
+                if not planning and not running and not len(work_queue) and \
+                        all(x == math.inf for x in next_plan.values()):
+                    return(n_failed)
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            print(f"Stopping, waiting for {len(running)} running subjects to finish")
+            work_queue.clear()
+    return(n_failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Keep importing every cohort into NOTEPAD XNAT, sharing the server between them')
+    parser.add_argument('--config', type=str, required=True,
+                        help='JSON list of the cohorts to import (see the top of this file)')
+    parser.add_argument('--plan_dir', type=str, default='ingest_plans',
+                        help='Where the plans and planning logs of each cohort are kept')
+    parser.add_argument('--interval', type=float, default=60,
+                        help='Minutes between looking at a cohort for new data. 0 imports everything once and stops')
+    parser.add_argument('--max_subjects', type=int, default=4,
+                        help='Most subjects to import at once, across all cohorts')
+    parser.add_argument('--max_uploads', type=int, default=4,
+                        help='Most uploads to run at once, across all cohorts')
+    parser.add_argument('--inflight_mb', type=int, default=512,
+                        help='Most MB of files to be uploading at once, across all cohorts')
+    parser.add_argument('--bundle_mb', type=int, default=16,
+                        help='Files smaller than this are zipped together into one upload per resource')
+    parser.add_argument('--latency_ms', type=float, default=2000,
+                        help='Run fewer subjects at once while the median small request takes longer than this')
+    parser.add_argument('--digest_cache', type=str, default=None,
+                        help='SQLite file to keep checksums of local files in, so unchanged files are never hashed twice')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write stage timings and REST call counts to this JSON (or .csv) file at the end of the run')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show a progress line with an ETA on stderr')
+    args = parser.parse_args()
+    metrics.start('ingest_daemon', args.metrics, args.progress)
+    scheduler.configure(max_bytes=args.inflight_mb * 1024 * 1024,
+                        small_file_bytes=args.bundle_mb * 1024 * 1024)
+    xnat_sessions.configure(pool_size=args.max_subjects)
+    if args.digest_cache is not None:
+        local_digests.open(args.digest_cache)
+
+    with open(args.config, 'r') as config_file:
+        cohorts = [Cohort(x, args.plan_dir) for x in json.load(config_file)]
+    upload_slots = threading.BoundedSemaphore(args.max_uploads)
+    for cohort in cohorts:
+        cohort.handlers['upload'] = limit_uploads(cohort.handlers['upload'],
+                                                  upload_slots)
+        if 'import_dicom' in cohort.handlers:
+            cohort.handlers['import_dicom'] = limit_uploads(
+                cohort.handlers['import_dicom'], upload_slots,
+                reserve_bytes=True)
+    print(f"Importing {', '.join(x.name for x in cohorts)}")
+
+    n_failed = run_daemon(cohorts, args.max_subjects,
+                          args.latency_ms / 1000, args.interval * 60)
+    if n_failed:
+        print(f"{n_failed} subjects failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
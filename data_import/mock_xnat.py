@@ -0,0 +1,703 @@
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from urllib.parse import urlsplit, parse_qsl, unquote
+from zipfile import ZipFile, ZIP_STORED
+from run_metrics import endpoint_key
+
+# Local stand-in for the parts of the XNAT REST API the importers use,
+# so their throughput can be measured without the UCL or CNDA servers.
+# Everything is kept in memory: projects, subjects, experiments, scans,
+# resources and the names, sizes and MD5s of uploaded files (not their bytes).
+# Every request sleeps for a fixed latency and request and response
+# bodies are throttled to a bandwidth, to look like a remote server.
+# xnatpy builds its classes from the XNAT schemas. mock_schemas has a
+# cut down xnat.xsd with the types the importers use, or point
+# schema_dir at a copy of the .xsd files from a real server.
+
+# Zip entry names in ADNI import zips carry the series number
+adni_series_pattern = re.compile(r"_S(\d+)_I\d+\.")
+# Zip entry names in XNAT downloads look like label/scans/3-T1/...
+xnat_scan_pattern = re.compile(r"/scans/([^/-]+)(?:-([^/]*))?/")
+body_chunk_size = 256 * 1024
+default_schema_dir = Path(__file__).resolve().parent / 'mock_schemas'
+server_version = "1.8.10"
+
+
+def zip_entries(zip_stream):
+    # (name, size, MD5) of the files in an uploaded zip
+    try:
+        with ZipFile(zip_stream) as upload_zip:
+            return([(x.filename, x.file_size,
+                     hashlib.md5(upload_zip.read(x)).hexdigest())
+                    for x in upload_zip.infolist() if not x.is_dir()])
+    except Exception:
+        return([])
+
+
+class DigestSink:
+    # Request body sink that only keeps the MD5
+    def __init__(self):
+        self.md5 = hashlib.md5()
+
+    def write(self, chunk):
+        self.md5.update(chunk)
+
+def result_set(rows):
+    return({"ResultSet": {"Result": rows, "totalRecords": str(len(rows))}})
+
+
+class MockXnatState:
+    def __init__(self, schema_dir=None, archive_delay=0):
+        self.lock = threading.Lock()
+        self.schema_dir = Path(schema_dir or default_schema_dir)
+        # Seconds before an imported session shows up in listings
+        self.archive_delay = archive_delay
+        self.projects = {}
+        self.subjects = {}
+        self.experiments = {}
+        self.next_id = 1
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = Counter()
+            self.unmatched = Counter()
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.files_uploaded = 0
+            self.files_imported = 0
+            self.scans_created = 0
+            self.sessions_imported = 0
+
+    def stats(self):
+        with self.lock:
+            return({
+                "calls": dict(self.calls),
+                "total_calls": sum(self.calls.values()),
+                "unmatched": dict(self.unmatched),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "files_uploaded": self.files_uploaded,
+                "files_imported": self.files_imported,
+                "scans_created": self.scans_created,
+                "sessions_imported": self.sessions_imported,
+                "subjects": len(self.subjects),
+                "experiments": len(self.experiments),
+            })
+
+    def new_id(self, prefix):
+        with self.lock:
+            new_id = f"{prefix}{self.next_id:05d}"
+            self.next_id = self.next_id + 1
+        return(new_id)
+
+    def project(self, project_id):
+        with self.lock:
+            return(self.projects.setdefault(
+                project_id, {"subjects": {}, "experiments": {}}))
+
+    def find_subject(self, project_id, subject_ref):
+        if subject_ref in self.subjects:
+            return(self.subjects[subject_ref])
+        subject_id = self.project(project_id)["subjects"].get(subject_ref)
+        return(None if subject_id is None else self.subjects[subject_id])
+
+    def add_subject(self, project_id, label):
+        subject = self.find_subject(project_id, label)
+        if subject is not None:
+            return(subject)
+        subject_id = self.new_id("MOCK_S")
+        subject = {"ID": subject_id, "label": label, "project": project_id,
+                   "fields": {}}
+        with self.lock:
+            self.subjects[subject_id] = subject
+            self.projects[project_id]["subjects"][label] = subject_id
+        return(subject)
+
+    def touch(self, experiment):
+        # last_modified as XNAT lists it, which sorts as text
+        experiment["last_modified"] = datetime.now().isoformat(
+            sep=' ', timespec='milliseconds')
+
+    def find_experiment(self, project_id, experiment_ref):
+        if experiment_ref in self.experiments:
+            return(self.experiments[experiment_ref])
+        if project_id is None:
+            return(None)
+        experiment_id = self.project(project_id)["experiments"].get(experiment_ref)
+        return(None if experiment_id is None else self.experiments[experiment_id])
+
+    def add_experiment(self, project_id, subject_label, label,
+                       xsi_type="xnat:mrSessionData", archive_delay=0,
+                       date="", session_time=""):
+        experiment = self.find_experiment(project_id, label)
+        if experiment is not None:
+            return(experiment)
+        self.add_subject(project_id, subject_label)
+        experiment_id = self.new_id("MOCK_E")
+        experiment = {"ID": experiment_id, "label": label,
+                      "project": project_id, "subject_label": subject_label,
+                      "xsiType": xsi_type, "date": date, "time": session_time,
+                      "fields": {}, "scans": {},
+                      "archived_at": time.monotonic() + archive_delay}
+        self.touch(experiment)
+        with self.lock:
+            self.experiments[experiment_id] = experiment
+            self.projects[project_id]["experiments"][label] = experiment_id
+        return(experiment)
+
+    def add_scan(self, experiment, scan_id, xsi_type=None, scan_type=""):
+        with self.lock:
+            if scan_id not in experiment["scans"]:
+                if xsi_type is None:
+                    xsi_type = experiment["xsiType"].replace("SessionData", "ScanData")
+                experiment["scans"][scan_id] = {
+                    "ID": scan_id, "xsiType": xsi_type, "type": scan_type,
+                    "fields": {}, "resources": {}, "digests": {}}
+                self.scans_created = self.scans_created + 1
+                self.touch(experiment)
+            return(experiment["scans"][scan_id])
+
+    def visible(self, experiment):
+        return(experiment["archived_at"] <= time.monotonic())
+
+    def seed(self, seed_path):
+        # Sessions already on the server, e.g. the CNDA side of DIAN
+        with open(seed_path, 'r') as f:
+            seed_data = json.load(f)
+        for session in seed_data["sessions"]:
+            experiment = self.add_experiment(
+                session["project"], session["subject_label"],
+                session["label"], session["xsiType"],
+                date=session.get("date", ""),
+                session_time=session.get("time", ""))
+            for scan in session["scans"]:
+                xnat_scan = self.add_scan(experiment, str(scan["ID"]),
+                                          scan_type=scan["type"])
+                xnat_scan["resources"]["DICOM"] = {
+                    f"{i:04d}.dcm": scan["file_size"]
+                    for i in range(scan["n_files"])}
+        # Seeded scans are not part of the benchmark
+        self.reset_stats()
+
+
+class MockXnatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set on the subclass made by make_server
+    state = None
+    latency = 0
+    bandwidth = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def throttle(self, n_bytes):
+        if self.bandwidth:
+            time.sleep(n_bytes / self.bandwidth)
+
+    def read_body(self, sink=None):
+        # Reads (and throttles) the whole request body so the
+        # connection can be reused. Returns its size
+        n_bytes = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().strip(), 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                chunk = self.rfile.read(chunk_size)
+                self.rfile.readline()
+                n_bytes = n_bytes + len(chunk)
+                self.throttle(len(chunk))
+                if sink is not None:
+                    sink.write(chunk)
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(body_chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining = remaining - len(chunk)
+                n_bytes = n_bytes + len(chunk)
+                self.throttle(len(chunk))
+                if sink is not None:
+                    sink.write(chunk)
+        with self.state.lock:
+            self.state.bytes_in = self.state.bytes_in + n_bytes
+        return(n_bytes)
+
+    def send_body(self, body, content_type="application/json", status=200,
+                  headers=()):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.throttle(len(body))
+            self.wfile.write(body)
+        with self.state.lock:
+            self.state.bytes_out = self.state.bytes_out + len(body)
+
+    def send_stream(self, stream, n_bytes, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(n_bytes))
+        self.end_headers()
+        for chunk in iter(lambda: stream.read(body_chunk_size), b''):
+            self.throttle(len(chunk))
+            self.wfile.write(chunk)
+        with self.state.lock:
+            self.state.bytes_out = self.state.bytes_out + n_bytes
+
+    def not_found(self):
+        with self.state.lock:
+            self.state.unmatched[endpoint_key(self.command, self.path_only)] += 1
+        self.send_body(f"Not found: {self.path_only}", "text/plain", 404)
+
+    def handle_any(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path.startswith('/REST/'):
+            path = '/data/' + path[len('/REST/'):]
+        self.path_only = path.rstrip('/') or '/'
+        self.query = dict(parse_qsl(url.query, keep_blank_values=True))
+        if self.path_only.startswith('/benchmark/'):
+            self.read_body()
+            if self.path_only == '/benchmark/reset':
+                self.state.reset_stats()
+            self.send_body(self.state.stats())
+            return
+        with self.state.lock:
+            self.state.calls[endpoint_key(self.command, self.path_only)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.path_only == '/data/services/import':
+            self.import_session()
+            return
+        self.extracted = None
+        if self.query.get('extract') == 'true':
+            # Zip uploads into a resource are unpacked into its files
+            with SpooledTemporaryFile(max_size=64 * 1024 * 1024) as zip_stream:
+                self.body_size = self.read_body(zip_stream)
+                zip_stream.seek(0)
+                self.extracted = zip_entries(zip_stream)
+        else:
+            body_digest = DigestSink()
+            self.body_size = self.read_body(body_digest)
+            self.body_md5 = body_digest.md5.hexdigest()
+        self.route()
+
+    do_GET = handle_any
+    do_PUT = handle_any
+    do_POST = handle_any
+    do_DELETE = handle_any
+    do_HEAD = handle_any
+
+    def route(self):
+        path = self.path_only
+        parts = path.strip('/').split('/')
+        if path == '/':
+            self.send_body("<html>Mock XNAT</html>", "text/html")
+        elif path in ('/data/JSESSION', '/data/services/auth'):
+            # Any user and password will do
+            jsession_id = uuid.uuid4().hex.upper()
+            self.send_body(jsession_id, "text/plain",
+                           headers=[('Set-Cookie', f"JSESSIONID={jsession_id}; Path=/")])
+        elif path == '/data/auth':
+            # xnatpy checks the login against this text
+            self.send_body("User 'benchmark' is logged in", "text/plain")
+        elif path == '/data/version':
+            self.send_body(server_version, "text/plain")
+        elif path == '/xapi/siteConfig/buildInfo':
+            self.send_body({"version": server_version})
+        elif parts[0] in ('xapi', 'schemas') and 'schemas' in parts:
+            self.schema()
+        elif parts[:3] == ['data', 'prearchive', 'projects'] or \
+                parts[:3] == ['data', 'search', 'elements']:
+            # No search display fields, xnatpy manages without them
+            self.send_body(result_set([]))
+        elif parts[:2] == ['data', 'projects'] and len(parts) == 2:
+            rows = [{"ID": x, "name": x, "secondary_ID": x,
+                     "URI": f"/data/projects/{x}"}
+                    for x in sorted(self.state.projects)]
+            self.send_body(result_set(rows))
+        elif parts[:2] == ['data', 'projects'] and len(parts) == 3:
+            self.state.project(parts[2])
+            self.send_object("xnat:projectData",
+                             {"ID": parts[2], "name": parts[2]})
+        elif parts[:2] == ['data', 'projects'] and parts[3] == 'subjects':
+            self.subject_route(parts[2], parts[4:])
+        elif parts[:2] == ['data', 'projects'] and parts[3] == 'experiments':
+            self.experiment_route(parts[2], None, parts[4:])
+        elif parts[:2] == ['data', 'subjects'] and len(parts) == 3:
+            subject = self.state.subjects.get(parts[2])
+            if subject is None:
+                self.not_found()
+            else:
+                self.subject_route(subject["project"], [parts[2]])
+        elif parts[:2] == ['data', 'experiments'] and len(parts) > 2:
+            self.experiment_route(None, None, parts[2:])
+        else:
+            self.not_found()
+
+    def schema(self):
+        schema_dir = self.state.schema_dir
+        if self.path_only == '/xapi/schemas':
+            self.send_body(sorted(x.stem for x in schema_dir.glob('*.xsd')))
+            return
+        schema_name = self.path_only.split('/')[-1]
+        schema_path = schema_dir / (Path(schema_name).stem + '.xsd')
+        if not schema_path.exists():
+            self.not_found()
+            return
+        self.send_body(schema_path.read_bytes(), "application/xml")
+
+    def send_object(self, xsi_type, data_fields, children=None):
+        self.send_body({"items": [{
+            "meta": {"xsi:type": xsi_type, "isHistory": False},
+            "data_fields": data_fields,
+            "children": children or [],
+        }]})
+
+    def set_fields(self, fields):
+        # xnatpy and the importers set values through the query string
+        for key, value in self.query.items():
+            if '/' in key or key.startswith('xnat:'):
+                fields[key] = value
+
+    def subject_route(self, project_id, rest):
+        if not rest:
+            rows = [{"ID": x["ID"], "label": x["label"], "project": project_id,
+                     "URI": f"/data/subjects/{x['ID']}"}
+                    for x in self.state.subjects.values()
+                    if x["project"] == project_id]
+            self.send_body(result_set(rows))
+            return
+        subject = self.state.find_subject(project_id, rest[0])
+        if len(rest) == 1:
+            if self.command == 'PUT':
+                subject = self.state.add_subject(project_id, rest[0])
+                self.set_fields(subject["fields"])
+                self.send_body(subject["ID"], "text/plain")
+            elif subject is None:
+                self.not_found()
+            else:
+                self.send_object("xnat:subjectData",
+                                 {"ID": subject["ID"],
+                                  "label": subject["label"],
+                                  "project": project_id})
+        elif rest[1] == 'experiments':
+            if subject is None and self.command != 'PUT':
+                self.not_found()
+            else:
+                self.experiment_route(project_id, rest[0], rest[2:])
+        else:
+            self.not_found()
+
+    def experiment_rows(self, project_id, subject_label):
+        columns = self.query.get("columns", "ID,label").split(',')
+        xsi_type = self.query.get("xsiType")
+        # Only the '>=value' form of the column filter is understood
+        modified_since = self.query.get("last_modified", ">=")[2:]
+        with_scans = "xnat:imagescandata/id" in columns
+        rows = []
+        for experiment in list(self.state.experiments.values()):
+            if experiment["project"] != project_id or \
+                    not self.state.visible(experiment):
+                continue
+            if subject_label is not None and \
+                    experiment["subject_label"] != subject_label:
+                continue
+            if xsi_type is not None and experiment["xsiType"] != xsi_type:
+                continue
+            if experiment["last_modified"] < modified_since:
+                continue
+            row = {"ID": experiment["ID"], "label": experiment["label"],
+                   "subject_label": experiment["subject_label"],
+                   "xsiType": experiment["xsiType"],
+                   "date": experiment["date"], "time": experiment["time"],
+                   "last_modified": experiment["last_modified"],
+                   "project": project_id,
+                   "URI": f"/data/experiments/{experiment['ID']}"}
+            row = {k: v for k, v in row.items()
+                   if k in columns or k in ("ID", "URI")}
+            if with_scans:
+                # One row per scan, like the XNAT search engine
+                for scan_id in experiment["scans"]:
+                    rows.append(dict(row, **{"xnat:imagescandata/id": scan_id}))
+            else:
+                rows.append(row)
+        return(rows)
+
+    def experiment_route(self, project_id, subject_label, rest):
+        if not rest:
+            self.send_body(result_set(
+                self.experiment_rows(project_id, subject_label)))
+            return
+        experiment = self.state.find_experiment(project_id, rest[0])
+        if experiment is None and self.command == 'PUT' and \
+                len(rest) == 1 and subject_label is not None:
+            experiment = self.state.add_experiment(
+                project_id, subject_label, rest[0],
+                self.query.get("xsiType", "xnat:mrSessionData"))
+        if experiment is None:
+            self.not_found()
+            return
+        if len(rest) == 1:
+            if self.command == 'PUT':
+                self.set_fields(experiment["fields"])
+                self.state.touch(experiment)
+                self.send_body(experiment["ID"], "text/plain")
+            else:
+                self.send_object(experiment["xsiType"],
+                                 {"ID": experiment["ID"],
+                                  "label": experiment["label"],
+                                  "project": experiment["project"]},
+                                 self.scan_children(experiment))
+        elif rest[1] == 'scans':
+            self.scan_route(experiment, rest[2:])
+        else:
+            self.not_found()
+
+    def scan_children(self, experiment):
+        # Scans and their resources, as nested in a session document
+        scan_items = []
+        for scan in list(experiment["scans"].values()):
+            resource_items = [{
+                "meta": {"xsi:type": "xnat:resourceCatalog", "isHistory": False},
+                "data_fields": {"label": x, "xnat_abstractresource_id": x},
+                "children": [],
+            } for x in scan["resources"]]
+            scan_items.append({
+                "meta": {"xsi:type": scan["xsiType"], "isHistory": False},
+                "data_fields": {"ID": scan["ID"], "type": scan["type"]},
+                "children": [{"field": "file", "items": resource_items}],
+            })
+        return([{"field": "scans/scan", "items": scan_items}])
+
+    def scan_route(self, experiment, rest):
+        if not rest:
+            rows = [{"ID": x["ID"], "type": x["type"], "xsiType": x["xsiType"],
+                     "URI": f"/data/experiments/{experiment['ID']}/scans/{x['ID']}"}
+                    for x in experiment["scans"].values()]
+            self.send_body(result_set(rows))
+            return
+        if len(rest) == 2 and rest[1] == 'files':
+            scan_ids = list(experiment["scans"]) if rest[0] == 'ALL' \
+                else rest[0].split(',')
+            if self.query.get("format") == "zip":
+                self.send_scan_zip(experiment, scan_ids)
+            else:
+                self.send_body(result_set(self.file_rows(experiment, scan_ids)))
+            return
+        scan = experiment["scans"].get(rest[0])
+        if scan is None and self.command == 'PUT' and len(rest) == 1:
+            scan = self.state.add_scan(experiment, rest[0],
+                                       self.query.get("xsiType"),
+                                       self.query.get("type", ""))
+        if scan is None:
+            self.not_found()
+            return
+        if len(rest) == 1:
+            if self.command == 'PUT':
+                self.set_fields(scan["fields"])
+                self.send_body(scan["ID"], "text/plain")
+            else:
+                self.send_object(scan["xsiType"],
+                                 {"ID": scan["ID"], "type": scan["type"]})
+        elif rest[1] == 'resources':
+            self.resource_route(experiment, scan, rest[2:])
+        else:
+            self.not_found()
+
+    def resource_route(self, experiment, scan, rest):
+        if not rest:
+            rows = [{"label": x, "xnat_abstractresource_id": x}
+                    for x in scan["resources"]]
+            self.send_body(result_set(rows))
+            return
+        if self.command == 'PUT' and len(rest) == 1:
+            with self.state.lock:
+                scan["resources"].setdefault(rest[0], {})
+            self.send_body(rest[0], "text/plain")
+            return
+        resource = scan["resources"].get(rest[0])
+        if resource is None:
+            self.not_found()
+        elif len(rest) == 1:
+            self.send_object("xnat:resourceCatalog", {"label": rest[0]})
+        elif rest[1] == 'files' and len(rest) > 2 and \
+                self.command in ('PUT', 'POST'):
+            uploaded = self.extracted
+            if uploaded is None:
+                uploaded = [('/'.join(rest[2:]), self.body_size, self.body_md5)]
+            with self.state.lock:
+                for file_name, file_size, file_md5 in uploaded:
+                    resource[file_name] = file_size
+                    scan["digests"][(rest[0], file_name)] = file_md5
+                self.state.files_uploaded = self.state.files_uploaded + len(uploaded)
+            self.send_body("", "text/plain")
+        elif rest[1] == 'files':
+            rows = [{"Name": x, "Size": str(y),
+                     "digest": scan["digests"].get((rest[0], x), "")}
+                    for x, y in resource.items()]
+            self.send_body(result_set(rows))
+        else:
+            self.not_found()
+
+    def file_rows(self, experiment, scan_ids):
+        rows = []
+        for scan_id in scan_ids:
+            scan = experiment["scans"].get(scan_id)
+            if scan is None:
+                continue
+            for resource_label, resource in scan["resources"].items():
+                for file_name, file_size in resource.items():
+                    rows.append({
+                        "Name": file_name,
+                        "Size": str(file_size),
+                        "collection": resource_label,
+                        "digest": scan["digests"].get((resource_label, file_name), ""),
+                        "URI": f"/data/experiments/{experiment['ID']}/scans/{scan_id}/resources/{resource_label}/files/{file_name}",
+                    })
+        return(rows)
+
+    def send_scan_zip(self, experiment, scan_ids):
+        # Same layout as an XNAT download, with zeros for the file contents
+        with SpooledTemporaryFile(max_size=64 * 1024 * 1024) as zip_stream:
+            with ZipFile(zip_stream, 'w', ZIP_STORED) as scan_zip:
+                for scan_id in scan_ids:
+                    scan = experiment["scans"].get(scan_id)
+                    if scan is None:
+                        continue
+                    for resource_label, resource in scan["resources"].items():
+                        for file_name, file_size in resource.items():
+                            arc_name = f"{experiment['label']}/scans/{scan_id}-{scan['type']}/resources/{resource_label}/files/{file_name}"
+                            scan_zip.writestr(arc_name, bytes(file_size))
+            n_bytes = zip_stream.tell()
+            zip_stream.seek(0)
+            self.send_stream(zip_stream, n_bytes, "application/zip")
+
+    def import_session(self):
+        # The import service archives a zip into a new session.
+        # Scans are made from the entry names rather than reading DICOM
+        project_id = self.query.get("project")
+        subject_label = self.query.get("subject")
+        label = self.query.get("session") or self.query.get("experiment")
+        with SpooledTemporaryFile(max_size=64 * 1024 * 1024) as zip_stream:
+            self.read_body(zip_stream)
+            zip_stream.seek(0)
+            try:
+                with ZipFile(zip_stream) as import_zip:
+                    entries = [(x.filename, x.file_size)
+                               for x in import_zip.infolist() if not x.is_dir()]
+            except Exception:
+                entries = []
+        if project_id is None or subject_label is None or label is None:
+            self.send_body("Missing project, subject or session", "text/plain", 400)
+            return
+        xsi_type = "xnat:petSessionData" if "PET" in label.upper() \
+            else "xnat:mrSessionData"
+        experiment = self.state.add_experiment(
+            project_id, subject_label, label, xsi_type,
+            archive_delay=self.state.archive_delay)
+        for entry_name, entry_size in entries:
+            adni_match = adni_series_pattern.search(entry_name)
+            xnat_match = xnat_scan_pattern.search(entry_name)
+            if adni_match is not None:
+                scan = self.state.add_scan(experiment, adni_match.group(1))
+            elif xnat_match is not None:
+                scan = self.state.add_scan(experiment, xnat_match.group(1),
+                                           scan_type=xnat_match.group(2) or "")
+            else:
+                continue
+            with self.state.lock:
+                scan["resources"].setdefault("DICOM", {})[
+                    entry_name.split('/')[-1]] = entry_size
+        with self.state.lock:
+            self.state.sessions_imported = self.state.sessions_imported + 1
+            self.state.files_imported = self.state.files_imported + len(entries)
+        self.send_body(f"/data/prearchive/projects/{project_id}/{label}",
+                       "text/plain")
+
+
+def make_server(host='127.0.0.1', port=0, latency=0, bandwidth=None,
+                schema_dir=None, archive_delay=0, seed_path=None):
+    """
+    Make (but do not start) a mock XNAT server.
+    latency is in seconds per request, bandwidth in bytes per second
+    (None for unlimited). Port 0 picks a free port, see server_address.
+    """
+    state = MockXnatState(schema_dir, archive_delay)
+    if seed_path is not None:
+        state.seed(seed_path)
+    handler = type('BoundMockXnatHandler', (MockXnatHandler,), {
+        'state': state,
+        'latency': latency,
+        'bandwidth': bandwidth,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return(server)
+
+
+def start_server(**kwargs):
+    # Runs the server on a background thread and returns it with its URL
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return(server, f"http://{host}:{port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a mock XNAT server for benchmarking the importers')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--latency_ms', type=float, default=0,
+                        help='Added delay for every request')
+    parser.add_argument('--bandwidth_mbps', type=float, default=0,
+                        help='Limit for request and response bodies in megabits per second. 0 is unlimited')
+    parser.add_argument('--archive_delay', type=float, default=0,
+                        help='Seconds before a session sent to the import service is archived')
+    parser.add_argument('--schema_dir', type=str, default=None,
+                        help='Directory of XNAT .xsd files for xnatpy to build its classes from. Default is mock_schemas')
+    parser.add_argument('--seed', type=str, default=None,
+                        help='JSON file of sessions already on the server (see synthetic_data.py)')
+    args = parser.parse_args()
+
+    bandwidth = args.bandwidth_mbps * 1e6 / 8 if args.bandwidth_mbps > 0 else None
+    server = make_server(port=args.port,
+                         latency=args.latency_ms / 1000,
+                         bandwidth=bandwidth,
+                         schema_dir=args.schema_dir,
+                         archive_delay=args.archive_delay,
+                         seed_path=args.seed)
+    print(f"Mock XNAT on http://127.0.0.1:{server.server_address[1]}")
+    print("GET /benchmark/stats for call counts, POST /benchmark/reset to clear them")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
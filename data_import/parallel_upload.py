@@ -0,0 +1,107 @@
+import contextvars
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+
+# Helpers for running the importers with a pool of upload workers.
+# The XNAT session is shared between the workers, so the HTTP
+# connection pool behind it needs to be big enough for all of them.
+
+
+class ThreadBufferedStdout:
+    """
+    Stand-in for sys.stdout that keeps print() output from each
+    worker thread (or asyncio task) in its own buffer, so the log for
+    a scan is written out in one block instead of interleaved with
+    other scans
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        # A context variable is per thread, and per task within a thread
+        self.buffer = contextvars.ContextVar('stdout_buffer', default=None)
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = self.buffer.get()
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if self.buffer.get() is None:
+            with self.lock:
+                self.stream.flush()
+
+    def start_capture(self):
+        self.buffer.set(io.StringIO())
+
+    def stop_capture(self):
+        buffer = self.buffer.get()
+        self.buffer.set(None)
+        with self.lock:
+            self.stream.write(buffer.getvalue())
+            self.stream.flush()
+
+
+@contextmanager
+def buffered_stdout():
+    # Swap in the thread aware stdout for the duration of a pool run
+    original_stdout = sys.stdout
+    thread_stdout = ThreadBufferedStdout(original_stdout)
+    sys.stdout = thread_stdout
+    try:
+        yield thread_stdout
+    finally:
+        sys.stdout = original_stdout
+
+
+@contextmanager
+def scan_log(thread_stdout):
+    # Everything printed inside this block comes out together
+    if thread_stdout is None:
+        yield
+        return
+    thread_stdout.start_capture()
+    try:
+        yield
+    finally:
+        thread_stdout.stop_capture()
+
+
+def tune_connection_pool(xnat_session, pool_size):
+    # requests keeps 10 connections per host by default
+    # which would make extra workers queue up for a socket
+    interface = xnat_session.interface
+    for prefix, adapter in list(interface.adapters.items()):
+        if isinstance(adapter, HTTPAdapter):
+            interface.mount(prefix, HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=adapter.max_retries))
+
+
+def run_grouped(groups, group_function, n_workers):
+    """
+    Run group_function(key, items) for every entry of the groups
+    dict on a pool of n_workers threads. Items inside a group are
+    always handled by one thread in order, so anything keyed on the
+    group (e.g. creating a subject) never races with itself.
+    Returns a dict of group key to the exception it raised.
+    """
+    failures = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(group_function, key, items): key
+            for key, items in groups.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            error = future.exception()
+            if error is not None:
+                print(f"[ERROR] {key} failed: {type(error).__name__}: {error}")
+                failures[key] = error
+    return(failures)
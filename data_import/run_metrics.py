@@ -0,0 +1,204 @@
+import atexit
+import csv
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlsplit
+
+# Timing and REST call counts for an importer run.
+# Stages are timed with spans (with metrics.span('upload'): ...),
+# every HTTP request made through an XNAT session is counted and timed
+# by endpoint, and request bodies are added up as bytes uploaded.
+# The importers share the module level metrics object. When a run is
+# started with a summary path the totals are written there (JSON, or
+# CSV if the name ends in .csv) when the process exits.
+
+# Path segments that are part of the API rather than an ID or label.
+# Anything else is replaced by * so calls group by endpoint
+api_words = {
+    'data', 'REST', 'projects', 'subjects', 'experiments', 'scans',
+    'resources', 'files', 'services', 'import', 'prearchive', 'JSESSION',
+    'version', 'xapi', 'siteConfig', 'buildInfo', 'schemas', 'ALL',
+}
+progress_interval = 1.0
+# Requests sending less than this count towards the recent latency,
+# so the time to push a large file is not taken for a slow server
+small_request_bytes = 1024 * 1024
+recent_requests = 500
+
+
+def endpoint_key(method, path):
+    parts = ['*' if x not in api_words else x
+             for x in path.strip('/').split('/') if x]
+    return(f"{method} /{'/'.join(parts)}")
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.name = None
+        self.summary_path = None
+        self.show_progress = False
+        self.started = time.perf_counter()
+        self.started_at = datetime.now()
+        # Stage name -> [count, seconds]
+        self.spans = {}
+        # Endpoint -> [count, seconds, bytes sent, bytes received]
+        self.requests = {}
+        # (finished at, seconds) of the latest small requests
+        self.recent = deque(maxlen=recent_requests)
+        self.counters = {}
+        self.total = 0
+        self.done = 0
+        self.last_progress = 0
+        self.finished = False
+
+    def start(self, name, summary_path=None, show_progress=False):
+        self.name = name
+        self.summary_path = None if summary_path is None else Path(summary_path)
+        self.show_progress = show_progress
+        self.started = time.perf_counter()
+        self.started_at = datetime.now()
+        atexit.register(self.finish)
+
+    @contextmanager
+    def span(self, stage):
+        span_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - span_start
+            with self.lock:
+                totals = self.spans.setdefault(stage, [0, 0.0])
+                totals[0] = totals[0] + 1
+                totals[1] = totals[1] + elapsed
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def attach(self, xnat_session):
+        # Counts every request made through this session
+        xnat_session.interface.hooks['response'].append(self.response_hook)
+
+    def response_hook(self, response, *args, **kwargs):
+        request = response.request
+        # Read sizes from headers, the body may be a file or a stream
+        self.record_request(request.method, request.url,
+                            response.elapsed.total_seconds(),
+                            int(request.headers.get('Content-Length') or 0),
+                            int(response.headers.get('Content-Length') or 0))
+        return(response)
+
+    def record_request(self, method, url, seconds, bytes_sent, bytes_received):
+        # For transports that do not go through a requests session
+        key = endpoint_key(method, urlsplit(str(url)).path)
+        with self.lock:
+            totals = self.requests.setdefault(key, [0, 0.0, 0, 0])
+            totals[0] = totals[0] + 1
+            totals[1] = totals[1] + seconds
+            totals[2] = totals[2] + bytes_sent
+            totals[3] = totals[3] + bytes_received
+            if bytes_sent < small_request_bytes:
+                self.recent.append((time.perf_counter(), seconds))
+
+    def recent_latency(self, window_seconds=60):
+        # Median seconds of the small requests in the last window,
+        # or None if there were none
+        since = time.perf_counter() - window_seconds
+        with self.lock:
+            latencies = sorted(x[1] for x in self.recent if x[0] >= since)
+        if not latencies:
+            return None
+        return(latencies[len(latencies) // 2])
+
+    def add_total(self, n_steps):
+        # More steps (scans, subjects, sessions) for the run to do
+        with self.lock:
+            self.total = self.total + n_steps
+
+    def step(self, label=""):
+        # One step finished. Shows a progress line on stderr with an
+        # ETA, rewritten at most once a second
+        with self.lock:
+            self.done = self.done + 1
+            done = self.done
+            total = self.total
+            now = time.perf_counter()
+            if not self.show_progress or total <= 0:
+                return
+            if done < total and now - self.last_progress < progress_interval:
+                return
+            self.last_progress = now
+        elapsed = now - self.started
+        eta = ""
+        if done < total:
+            eta = f", ETA {time.strftime('%H:%M:%S', time.gmtime(elapsed / done * (total - done)))}"
+        line = f"{done}/{total} ({100 * done / total:.0f}%) in {elapsed:.0f}s{eta} {label}"
+        sys.stderr.write(f"\r{line[:120]:<120}")
+        if done >= total:
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+
+    def summary(self):
+        with self.lock:
+            requests = {k: list(v) for k, v in self.requests.items()}
+            spans = {k: list(v) for k, v in self.spans.items()}
+            counters = dict(self.counters)
+        return({
+            "name": self.name,
+            "started": self.started_at.isoformat(timespec='seconds'),
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "rest_calls": sum(x[0] for x in requests.values()),
+            "rest_seconds": round(sum(x[1] for x in requests.values()), 3),
+            "bytes_uploaded": sum(x[2] for x in requests.values()),
+            "bytes_downloaded": sum(x[3] for x in requests.values()),
+            "steps": self.done,
+            "counters": counters,
+            "spans": {k: {"count": v[0], "seconds": round(v[1], 3)}
+                      for k, v in sorted(spans.items(), key=lambda x: -x[1][1])},
+            "requests": {k: {"count": v[0], "seconds": round(v[1], 3),
+                             "bytes_sent": v[2], "bytes_received": v[3]}
+                         for k, v in sorted(requests.items(), key=lambda x: -x[1][1])},
+        })
+
+    def write(self, summary_path):
+        summary = self.summary()
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        if summary_path.suffix == '.csv':
+            with open(summary_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['kind', 'name', 'count', 'seconds', 'bytes_sent', 'bytes_received'])
+                writer.writerow(['run', summary['name'], summary['rest_calls'],
+                                 summary['seconds'], summary['bytes_uploaded'],
+                                 summary['bytes_downloaded']])
+                for stage, totals in summary['spans'].items():
+                    writer.writerow(['span', stage, totals['count'], totals['seconds'], '', ''])
+                for key, totals in summary['requests'].items():
+                    writer.writerow(['request', key, totals['count'], totals['seconds'],
+                                     totals['bytes_sent'], totals['bytes_received']])
+                for counter, value in summary['counters'].items():
+                    writer.writerow(['counter', counter, value, '', '', ''])
+        else:
+            with open(summary_path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return(summary)
+
+    def finish(self):
+        if self.finished or self.summary_path is None:
+            return
+        self.finished = True
+        summary = self.write(self.summary_path)
+        print(f"Run took {summary['seconds']}s, {summary['rest_calls']} REST calls "
+              f"taking {summary['rest_seconds']}s, {summary['bytes_uploaded']} bytes uploaded")
+        for stage, totals in list(summary['spans'].items())[:10]:
+            print(f"  {totals['seconds']:10.2f}s {totals['count']:7d}x  {stage}")
+        print(f"Run summary written to {self.summary_path}")
+
+
+metrics = RunMetrics()
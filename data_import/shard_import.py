@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from upload_ledger import UploadLedger
+
+# Runs a BIDS importer (WRAP or A4/LEARN) as N worker processes on this
+# machine, worker K with --shard K/N, so each subject is imported by
+# exactly one of them and they never race to create it.
+# Each worker keeps its own ledger and metrics file. The ledgers start
+# as a copy of the main ledger so nothing already uploaded is sent
+# again, and are merged back into it once every worker has finished.
+# The metrics are added up into one summary.
+# To spread an import over several machines, run the importer itself
+# on each with --shard K/N and the same N.
+# Any arguments not listed here are passed on to the importer, e.g.
+#   python shard_import.py --importer import_wrap --shards 8 \
+#       --ledger wrap.sqlite --in_path /data/wrap --workers 2
+
+script_dir = Path(__file__).resolve().parent
+
+
+def shard_path(base_path, shard_index, n_shards, suffix=None):
+    base_path = Path(base_path)
+    suffix = suffix or base_path.suffix
+    return(base_path.with_name(f"{base_path.stem}.shard{shard_index}of{n_shards}{suffix}"))
+
+
+def merge_summaries(summaries):
+    # One run summary from the summaries of the workers
+    merged = {
+        "name": "shard_import",
+        "started": min(x["started"] for x in summaries),
+        "seconds": max(x["seconds"] for x in summaries),
+        "shards": len(summaries),
+        "counters": {},
+        "spans": {},
+        "requests": {},
+    }
+    for key in ("rest_calls", "rest_seconds", "bytes_uploaded",
+                "bytes_downloaded", "steps"):
+        merged[key] = round(sum(x[key] for x in summaries), 3)
+    for summary in summaries:
+        for counter, value in summary["counters"].items():
+            merged["counters"][counter] = merged["counters"].get(counter, 0) + value
+        for section in ("spans", "requests"):
+            for name, totals in summary[section].items():
+                merged_totals = merged[section].setdefault(
+                    name, dict.fromkeys(totals, 0))
+                for total_key, value in totals.items():
+                    merged_totals[total_key] = round(merged_totals[total_key] + value, 3)
+    return(merged)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Run a BIDS importer as N local workers, one shard of the subjects each')
+    parser.add_argument('--importer', type=str, required=True,
+                        choices=['import_wrap', 'import_a4learn'],
+                        help='Importer to run')
+    parser.add_argument('--shards', type=int, default=os.cpu_count(),
+                        help='Number of worker processes. Default is one per CPU')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='SQLite ledger of uploads. Each worker gets a copy and they are merged back in at the end')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write the added up stage timings and REST call counts of all workers to this JSON file')
+    parser.add_argument('--log_dir', type=str, default='shard_logs',
+                        help='Where the output of each worker goes')
+    args, importer_args = parser.parse_known_args()
+    n_shards = max(args.shards, 1)
+    log_dir = Path(args.log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    workers = []
+    for shard_index in range(1, n_shards + 1):
+        command = [sys.executable, str(script_dir / f"{args.importer}.py")] + \
+            importer_args + ['--shard', f"{shard_index}/{n_shards}"]
+        shard_ledger = None
+        if args.ledger is not None:
+            shard_ledger = shard_path(args.ledger, shard_index, n_shards)
+            if Path(args.ledger).exists():
+                shutil.copyfile(args.ledger, shard_ledger)
+            command = command + ['--ledger', str(shard_ledger)]
+        shard_metrics = None
+        if args.metrics is not None:
+            shard_metrics = shard_path(args.metrics, shard_index, n_shards, '.json')
+            command = command + ['--metrics', str(shard_metrics)]
+        log_path = log_dir / f"{args.importer}.shard{shard_index}of{n_shards}.log"
+        log_file = open(log_path, 'w')
+        print(f"Starting shard {shard_index}/{n_shards}, log in {log_path}")
+        # Same working directory as ours, so relative paths in the
+        # arguments mean the same files to the workers
+        process = subprocess.Popen(command, stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        workers.append((shard_index, process, log_file, shard_ledger, shard_metrics))
+
+    failed = []
+    for shard_index, process, log_file, shard_ledger, shard_metrics in workers:
+        return_code = process.wait()
+        log_file.close()
+        print(f"Shard {shard_index}/{n_shards} finished with exit code {return_code}")
+        if return_code != 0:
+            failed.append(shard_index)
+
+    # Everything a worker recorded counts, even if it failed part way
+    if args.ledger is not None:
+        ledger = UploadLedger(args.ledger)
+        for shard_index, process, log_file, shard_ledger, shard_metrics in workers:
+            if not shard_ledger.exists():
+                continue
+            n_rows = ledger.merge(shard_ledger)
+            print(f"{n_rows} uploads merged from {shard_ledger.name}")
+            shard_ledger.unlink()
+        ledger.close()
+
+    if args.metrics is not None:
+        summaries = []
+        for shard_index, process, log_file, shard_ledger, shard_metrics in workers:
+            if shard_metrics.exists():
+                with open(shard_metrics, 'r') as f:
+                    summaries.append(json.load(f))
+        if summaries:
+            merged = merge_summaries(summaries)
+            with open(args.metrics, 'w') as f:
+                json.dump(merged, f, indent=2)
+            print(f"{merged['steps']} scans, {merged['rest_calls']} REST calls and "
+                  f"{merged['bytes_uploaded']} bytes uploaded across {len(summaries)} shards")
+
+    if failed:
+        print(f"Shards {failed} failed, see their logs")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
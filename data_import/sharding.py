@@ -0,0 +1,24 @@
+import argparse
+import hashlib
+
+# Splitting an import between workers by subject. Every subject's scans
+# go to one shard, picked from a hash of its label, so two workers never
+# both try to create the same subject and a subject always lands on the
+# same worker from one run to the next. Shards are numbered 1 to N.
+
+
+def shard_spec(text):
+    # argparse type for --shard K/N
+    try:
+        shard_index, n_shards = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard should look like K/N, not {text}")
+    if n_shards < 1 or not 1 <= shard_index <= n_shards:
+        raise argparse.ArgumentTypeError(f"Shard {text} is not one of 1/{n_shards} to {n_shards}/{n_shards}")
+    return((shard_index, n_shards))
+
+
+def subject_shard(subject_label, n_shards):
+    # MD5 rather than hash(), which is different in every process
+    digest = hashlib.md5(str(subject_label).encode()).hexdigest()
+    return(int(digest, 16) % n_shards + 1)
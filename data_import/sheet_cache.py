@@ -0,0 +1,101 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+import pandas as pd
+
+# On-disk cache for the cleaned spreadsheets the importers load.
+# The CSVs are large and slow to parse, but rarely change, so the
+# cleaned and indexed DataFrames are kept as Parquet files next to
+# a key made from the source files' size and modification time.
+# Change cache_version when the cleaning code changes.
+# Shard workers can share one cache_dir, so every file is written
+# under a temporary name and renamed into place, and a build only
+# clears out files made for other versions of the sources.
+# Files are named {name}-{path key}-{version key}, the path key from
+# where the sources are, so data trees sharing a cache_dir each keep
+# their own entries.
+
+cache_version = 1
+
+
+def path_key(source_files):
+    key = hashlib.sha1()
+    for source_file in source_files:
+        key.update(f"{Path(source_file).resolve()}\n".encode())
+    return(key.hexdigest()[:8])
+
+
+def source_key(name, source_files):
+    key = hashlib.sha1(f"{name}:{cache_version}".encode())
+    for source_file in source_files:
+        source_file = Path(source_file)
+        stat = source_file.stat()
+        key.update(f"{source_file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return(f"{path_key(source_files)}-{key.hexdigest()[:16]}")
+
+
+def write_atomic(write_function, cache_path):
+    # Readers only ever see a whole file, or none at all
+    tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        write_function(tmp_path)
+        os.replace(tmp_path, cache_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return(cache_path)
+
+
+def write_frame(df, cache_path):
+    # Parquet keeps the index and dtypes, but pyarrow can refuse
+    # columns with mixed types, so fall back to a pickle for those
+    try:
+        return(write_atomic(df.to_parquet, cache_path))
+    except Exception as e:
+        print(f"Could not write {cache_path.name} as Parquet ({type(e).__name__}), using pickle")
+        return(write_atomic(df.to_pickle, cache_path.with_suffix('.pkl')))
+
+
+def read_frame(cache_path):
+    if cache_path.suffix == '.pkl':
+        return(pd.read_pickle(cache_path))
+    return(pd.read_parquet(cache_path))
+
+
+def cached_frames(name, source_files, build_function, cache_dir=None):
+    """
+    Return the tuple of DataFrames made by build_function(),
+    reading them from cache_dir if the source files are unchanged
+    since they were written. With no cache_dir this just calls
+    build_function().
+    """
+    if cache_dir is None:
+        return(build_function())
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = source_key(name, source_files)
+    index_path = cache_dir / f"{name}-{key}.pkl"
+    if index_path.exists():
+        try:
+            with open(index_path, 'rb') as f:
+                frame_paths = pickle.load(f)
+            print(f"Loading {name} from cache")
+            return(tuple(read_frame(cache_dir / x) for x in frame_paths))
+        except FileNotFoundError:
+            # Cleared out by a worker that saw newer sources
+            print(f"Cached {name} has gone")
+
+    print(f"Building {name} from source spreadsheets")
+    frames = build_function()
+    # Clear out anything written for older versions of these sources.
+    # Another worker may be writing this version too, so leave those
+    for old_path in cache_dir.glob(f"{name}-{path_key(source_files)}-*"):
+        if not old_path.name.startswith(f"{name}-{key}"):
+            old_path.unlink(missing_ok=True)
+    frame_paths = []
+    for i, df in enumerate(frames):
+        frame_path = write_frame(df, cache_dir / f"{name}-{key}-{i}.parquet")
+        frame_paths.append(frame_path.name)
+    # The index goes last, so it only names frames that are in place
+    write_atomic(lambda x: x.write_bytes(pickle.dumps(frame_paths)), index_path)
+    return(tuple(frames))
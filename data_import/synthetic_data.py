@@ -0,0 +1,302 @@
+import argparse
+import csv
+import json
+import os
+import random
+from pathlib import Path
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# Synthetic data in the layouts the importers expect, for benchmarking
+# against mock_xnat.py. Images are random bytes (or random pixels for
+# DICOM) of a chosen size and the spreadsheets only have the columns
+# the importers read, with one row per subject or visit.
+# Everything is seeded, so the same arguments give the same tree.
+
+mr_sop_class = "1.2.840.10008.5.1.4.1.1.4"
+pet_sop_class = "1.2.840.10008.5.1.4.1.1.128"
+
+
+def write_csv(csv_path, columns, rows):
+    csv_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def write_image(image_path, image_bytes):
+    image_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(image_path, 'wb') as f:
+        f.write(os.urandom(image_bytes))
+
+
+def write_sidecar(json_path, series_number, modality):
+    sidecar = {
+        "SeriesNumber": series_number,
+        "Manufacturer": "Siemens",
+        "SliceThickness": 1.0,
+    }
+    if modality == "MR":
+        sidecar.update({"SeriesDescription": "MPRAGE",
+                        "MagneticFieldStrength": 3,
+                        "EchoTime": 0.003, "RepetitionTime": 2.3,
+                        "InversionTime": 0.9})
+    else:
+        sidecar.update({"SeriesDescription": "PET AC",
+                        "Radiopharmaceutical": "MK6240",
+                        "InjectedRadioactivity": 185.0})
+    json_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(json_path, 'w') as f:
+        json.dump(sidecar, f)
+
+
+def make_wrap_data(out_dir, n_subjects, sessions_per_subject=2,
+                   image_bytes=1024 * 1024, seed=0):
+    # BIDS tree of sub-wrapNNNNN/ses-AGE/{anat,pet} plus Data/ sheets
+    rng = random.Random(seed)
+    out_dir = Path(out_dir)
+    demographics, apoe, visits, cdr, mmse = [], [], [], [], []
+    for s in range(n_subjects):
+        wrapnum = f"wrap{s + 1:05d}"
+        baseline_age = rng.randint(45, 70)
+        demographics.append([wrapnum, rng.choice([1, 2, 5]), '', 2,
+                             rng.choice([1, 2]), rng.randint(10, 20)])
+        apoe.append([wrapnum, 'E3', rng.choice(['E3', 'E4'])])
+        for v in range(sessions_per_subject):
+            visit_number = f"{v + 1}"
+            days = v * 2 * 365
+            visits.append([wrapnum, visit_number, baseline_age, days])
+            cdr.append([wrapnum, visit_number, rng.choice([0, 0.5, 1]),
+                        0, days])
+            mmse.append([wrapnum, visit_number, rng.randint(24, 30)])
+            scan_age = f"{baseline_age + v * 2:03d}"
+            for modality, suffix in (("MR", "T1w"), ("PET", "trc-18FMK6240_pet")):
+                sub_dir = "anat" if modality == "MR" else "pet"
+                stem = f"sub-{wrapnum}_ses-{scan_age}_{suffix}"
+                image_dir = out_dir / f"sub-{wrapnum}" / f"ses-{scan_age}" / sub_dir
+                write_sidecar(image_dir / f"{stem}.json", 3, modality)
+                write_image(image_dir / f"{stem}.nii.gz", image_bytes)
+    data_dir = out_dir / 'Data'
+    write_csv(data_dir / 'Demographics.csv',
+              ['wrapnum', 'race1', 'race2', 'hispanic_or_latino', 'gender',
+               'EducYrs'], demographics)
+    write_csv(data_dir / 'APG.csv', ['wrapnum', 'all1', 'all2'], apoe)
+    write_csv(data_dir / 'fqryStatisticalData.csv',
+              ['wrapnum', 'VisNo', 'Age_At_Baseline_Int',
+               'Days_Since_Baseline'], visits)
+    write_csv(data_dir / 'CDR.csv',
+              ['wrapnum', 'VisNo', 'SumOfBoxes', 'CDRRating',
+               'estimated_questionnaire_days_after_baseline'], cdr)
+    write_csv(data_dir / 'NeuropsychScores.csv',
+              ['wrapnum', 'VisNo', 'mmseTot'], mmse)
+    return({"in_path": out_dir})
+
+
+def make_a4_data(out_dir, n_subjects, sessions_per_subject=2,
+                 image_bytes=1024 * 1024, seed=0):
+    # Flat directory of GROUP_MODALITY_SUB_BID_VISIT.{json,nii.gz}
+    rng = random.Random(seed)
+    out_dir = Path(out_dir)
+    subjects, visits, cdr, mmse = [], [], [], []
+    for s in range(n_subjects):
+        bid = f"B{s + 1:08d}"
+        subjects.append([bid, rng.randint(65, 85), rng.choice(['A4', 'LEARN']),
+                         rng.choice([1, 2]), 56, rng.randint(12, 20),
+                         1, rng.choice(['E3/E3', 'E3/E4'])])
+        for v in range(sessions_per_subject):
+            visit_code = f"{(v + 1) * 3:03d}"
+            visits.append([bid, visit_code, f"Visit {visit_code}", v * 180])
+            cdr.append([bid, visit_code, 0.5, 0.5, 0])
+            mmse.append([bid, visit_code, rng.randint(24, 30)])
+            for modality, submodality in (("MR", "T1"), ("PET", "FBP")):
+                stem = f"A4_{modality}_{submodality}_{bid}_{visit_code}"
+                write_sidecar(out_dir / f"{stem}.json", 3, modality)
+                write_image(out_dir / f"{stem}.nii.gz", image_bytes)
+    write_csv(out_dir / 'SUBJINFO.csv',
+              ['BID', 'AGEYR', 'SUBSTUDY', 'SEX', 'ETHNIC', 'EDCCNTU',
+               'RACE', 'APOEGN'], subjects)
+    write_csv(out_dir / 'SV.csv',
+              ['BID', 'VISITCD', 'VISIT', 'SVSTDTC_DAYS_T0'], visits)
+    write_csv(out_dir / 'cdr.csv',
+              ['BID', 'VISCODE', 'CDSOB', 'CDRSB', 'CDGLOBAL'], cdr)
+    write_csv(out_dir / 'mmse.csv', ['BID', 'VISCODE', 'MMSCORE'], mmse)
+    return({"in_path": out_dir})
+
+
+def write_dicom(dcm_path, study_uid, series_uid, series_number,
+                modality, subject_id, instance, matrix_size, rng):
+    sop_class = mr_sop_class if modality == "MR" else pet_sop_class
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.InstanceNumber = instance
+    ds.PatientID = subject_id
+    ds.Modality = "MR" if modality == "MR" else "PT"
+    ds.Rows = matrix_size
+    ds.Columns = matrix_size
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = rng.randbytes(matrix_size * matrix_size * 2)
+    dcm_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        ds.save_as(dcm_path, enforce_file_format=True)
+    except TypeError:
+        # pydicom before 3.0
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(dcm_path, write_like_original=False)
+
+
+def make_adni_data(out_dir, n_subjects, sessions_per_subject=1,
+                   series_per_session=2, slices_per_series=32,
+                   matrix_size=128, image_bytes=1024 * 1024, seed=0):
+    # One directory per subject (002_S_0001 ...) holding DICOM and
+    # NIfTI in the ADNI download layout, plus the four spreadsheets
+    rng = random.Random(seed)
+    out_dir = Path(out_dir)
+    batch_root = out_dir / 'subjects'
+    study_rows = {"MR": [], "PET": []}
+    image_rows = {"MR": [], "PET": []}
+    image_id = 100000
+    study_id = 1000
+    for s in range(n_subjects):
+        subject_id = f"002_S_{s + 1:04d}"
+        for v in range(sessions_per_subject):
+            visit = "bl" if v == 0 else f"m{v * 12:02d}"
+            image_date = f"{2010 + v}-01-15"
+            date_dir = f"{2010 + v}-01-15_10_00_00.0"
+            for modality in ("MR", "PET"):
+                study_id = study_id + 1
+                study_rows[modality].append(
+                    [subject_id, visit, 1940 + s % 30, rng.choice([1, 2]),
+                     2, 5, rng.randint(12, 20), '3/3'])
+                study_uid = generate_uid()
+                for series_number in range(1, series_per_session + 1):
+                    series_uid = generate_uid()
+                    description = "MPRAGE" if modality == "MR" else "AV45_Coreg"
+                    image_id = image_id + 1
+                    dicom_image_id = image_id
+                    image_id = image_id + 1
+                    nifti_image_id = image_id
+                    for row_image_id in (dicom_image_id, nifti_image_id):
+                        if modality == "MR":
+                            image_rows["MR"].append(
+                                [row_image_id, subject_id, study_id, visit,
+                                 image_date, description, 1.2, 'Siemens',
+                                 'Prisma', 3.0])
+                        else:
+                            image_rows["PET"].append(
+                                [row_image_id, subject_id, study_id, visit,
+                                 image_date, description, 'Siemens',
+                                 'Biograph', '18F-AV45'])
+                    series_dir = batch_root / subject_id / description / date_dir
+                    file_stem = f"ADNI_{subject_id}_{modality}_{description}_br_raw_{image_date.replace('-', '')}"
+                    for instance in range(1, slices_per_series + 1):
+                        dcm_path = series_dir / f"I{dicom_image_id}" / \
+                            f"{file_stem}_{instance}_S{series_number}_I{dicom_image_id}.dcm"
+                        write_dicom(dcm_path, study_uid, series_uid,
+                                    series_number, modality, subject_id,
+                                    instance, matrix_size, rng)
+                    write_image(series_dir / f"I{nifti_image_id}" /
+                                f"{file_stem}_S{series_number}_I{nifti_image_id}.nii.gz",
+                                image_bytes)
+    study_columns = ['subject_id', 'visit', 'PTDOBYY', 'PTGENDER',
+                     'PTETHCAT', 'PTRACCAT', 'PTEDUCAT', 'GENOTYPE']
+    write_csv(out_dir / 'mr_study.csv', study_columns, study_rows["MR"])
+    write_csv(out_dir / 'pet_study.csv', study_columns, study_rows["PET"])
+    write_csv(out_dir / 'mr_image.csv',
+              ['image_id', 'subject_id', 'study_id', 'mri_visit', 'mri_date',
+               'mri_description', 'mri_thickness', 'mri_mfr',
+               'mri_mfr_model', 'mri_field_str'], image_rows["MR"])
+    write_csv(out_dir / 'pet_image.csv',
+              ['image_id', 'subject_id', 'study_id', 'pet_visit', 'pet_date',
+               'pet_description', 'pet_mfr', 'pet_mfr_model',
+               'pet_radiopharm'], image_rows["PET"])
+    return({"batch_root": batch_root,
+            "mr_study": out_dir / 'mr_study.csv',
+            "mr_image": out_dir / 'mr_image.csv',
+            "pet_study": out_dir / 'pet_study.csv',
+            "pet_image": out_dir / 'pet_image.csv'})
+
+
+def make_dian_seed(out_dir, n_subjects, sessions_per_subject=1,
+                   files_per_scan=32, image_bytes=256 * 1024,
+                   project="DIANDF17", seed=0):
+    # DIAN has nothing local to read, the sessions are on CNDA.
+    # This writes the seed file mock_xnat.py loads them from
+    rng = random.Random(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    sessions = []
+    mr_scan_types = ["Localizer", "MPRAGE", "FLAIR", "DTI", "BOLD"]
+    for s in range(n_subjects):
+        subject_label = f"DIAN{s + 1:05d}"
+        for v in range(sessions_per_subject):
+            for modality in ("mr", "pet"):
+                scan_types = mr_scan_types if modality == "mr" else ["PIB", "CT"]
+                sessions.append({
+                    "project": project,
+                    "subject_label": subject_label,
+                    "label": f"{subject_label}_v{v:02d}_{modality}",
+                    "xsiType": f"xnat:{modality}SessionData",
+                    "date": f"{2015 + v}-0{rng.randint(1, 9)}-01",
+                    "time": "10:00:00",
+                    "scans": [{"ID": str(i + 1), "type": x,
+                               "n_files": files_per_scan,
+                               "file_size": image_bytes}
+                              for i, x in enumerate(scan_types)],
+                })
+    seed_path = out_dir / 'dian_seed.json'
+    with open(seed_path, 'w') as f:
+        json.dump({"sessions": sessions}, f)
+    return({"seed": seed_path})
+
+
+cohort_makers = {
+    "wrap": make_wrap_data,
+    "a4": make_a4_data,
+    "adni": make_adni_data,
+    "dian": make_dian_seed,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Make synthetic data for benchmarking the importers')
+    parser.add_argument('--cohort', type=str, required=True,
+                        choices=sorted(cohort_makers),
+                        help='Which importer the data is for')
+    parser.add_argument('--out_dir', type=str, required=True,
+                        help='Where to write the data')
+    parser.add_argument('--subjects', type=int, default=10,
+                        help='Number of subjects')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='Number of visits per subject')
+    parser.add_argument('--image_kb', type=int, default=1024,
+                        help='Size of each NIfTI (or each DIAN file)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    args = parser.parse_args()
+    paths = cohort_makers[args.cohort](args.out_dir, args.subjects,
+                                       args.sessions,
+                                       image_bytes=args.image_kb * 1024,
+                                       seed=args.seed)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+
+
+if __name__ == "__main__":
+    main()
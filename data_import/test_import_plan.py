@@ -0,0 +1,35 @@
+from pathlib import Path
+import synthetic_data
+from xnat_inventory import ProjectInventory
+from importer_core import plan_import
+from import_wrap import WrapAdapter, load_clinical_data, notepad_project
+
+# Plan a small WRAP tree against an empty project, without a server,
+# and check the plan sends every file it later marks as uploaded.
+
+
+def test_plan_uploads_diffusion_gradients(tmp_path):
+    in_dir = tmp_path / 'wrap'
+    synthetic_data.make_wrap_data(in_dir, 1, 1, image_bytes=16 * 1024)
+    sidecar = sorted(in_dir.rglob('*_T1w.json'))[0]
+    gradient_files = [Path(str(sidecar).replace('.json', x))
+                      for x in ('.bval', '.bvec')]
+    for gradient_file in gradient_files:
+        gradient_file.write_text("0 1000 1000\n")
+
+    frames = load_clinical_data(in_dir)
+    done_dir_insert_pos = len((in_dir / 'uploaded').parts) - 1
+    adapter = WrapAdapter(in_dir, done_dir_insert_pos, *frames)
+    scan_list = adapter.find_scans()
+    inventory = ProjectInventory(None, notepad_project, load=False)
+    plan = plan_import(adapter, list(enumerate(scan_list)), inventory)
+
+    upload_files = set()
+    mark_files = set()
+    for planned in plan.actions:
+        if planned['action'] == 'upload':
+            upload_files.update(planned['files'])
+        elif planned['action'] == 'mark_uploaded':
+            mark_files.update(planned['files'])
+    assert set(str(x) for x in gradient_files) <= upload_files
+    assert mark_files == upload_files
@@ -0,0 +1,39 @@
+import synthetic_data
+from upload_scheduler import UploadScheduler
+from dicom_index import DicomHeaderIndex
+from import_adni import make_dcm_zip, import_dcm_zip
+
+# Study zips and resource bundles are built in a SpooledTemporaryFile
+# so they stay in memory up to a limit. Sending them must not roll
+# them over to disk.
+
+
+def test_study_zip_stays_in_memory(xnat_session, tmp_path):
+    paths = synthetic_data.make_adni_data(tmp_path / 'adni', 1,
+                                          slices_per_series=4,
+                                          image_bytes=16 * 1024)
+    dcm_list = sorted(paths['batch_root'].rglob('*.dcm'))
+    zip_stream = make_dcm_zip(dcm_list, 'study', DicomHeaderIndex())
+    with zip_stream:
+        import_dcm_zip(xnat_session, zip_stream, '002_S_0001', 'study')
+        assert not zip_stream._rolled
+
+
+def test_bundle_stays_in_memory(xnat_session, tmp_path):
+    resource_uri = '/data/projects/BUNDLE/subjects/S1/experiments/E1/scans/1/resources/BIDS'
+    for uri, xsi_type in (('/data/projects/BUNDLE/subjects/S1', 'xnat:subjectData'),
+                          ('/data/projects/BUNDLE/subjects/S1/experiments/E1', 'xnat:mrSessionData'),
+                          ('/data/projects/BUNDLE/subjects/S1/experiments/E1/scans/1', 'xnat:mrScanData'),
+                          (resource_uri, 'xnat:resourceCatalog')):
+        xnat_session.put(uri, query={'xsiType': xsi_type})
+    src_files = []
+    for name in ('a.json', 'b.json', 'c.bval'):
+        src_file = tmp_path / name
+        src_file.write_text('{}')
+        src_files.append(src_file)
+    scheduler = UploadScheduler()
+    zip_stream, bundle_name = scheduler.make_bundle(src_files)
+    with zip_stream:
+        scheduler.send_bundle(xnat_session, f"{resource_uri}/files/{bundle_name}",
+                              zip_stream)
+        assert not zip_stream._rolled
@@ -0,0 +1,40 @@
+import os
+from upload_ledger import UploadLedger
+
+# What the ledger counts as already uploaded, when the path alone
+# does not answer it
+
+
+def write_sidecars(tmp_path):
+    # The same template sidecar for two subjects
+    sidecars = []
+    for subject in ('sub-01', 'sub-02'):
+        subject_dir = tmp_path / subject
+        subject_dir.mkdir()
+        sidecar = subject_dir / 'template.json'
+        sidecar.write_text('{"Manufacturer": "Siemens"}')
+        sidecars.append(sidecar)
+    return(sidecars)
+
+
+def test_moved_file_is_done(tmp_path):
+    ledger = UploadLedger(tmp_path / 'ledger.sqlite')
+    sidecar = write_sidecars(tmp_path)[0]
+    ledger.record(sidecar, 'P', 'sub-01', 'E1', 3, 'BIDS')
+    moved_dir = tmp_path / 'moved'
+    moved_dir.mkdir()
+    moved_sidecar = moved_dir / sidecar.name
+    os.rename(sidecar, moved_sidecar)
+    assert ledger.is_done(moved_sidecar, {'project': 'P', 'subject': 'sub-01'})
+
+
+def test_same_content_for_another_subject_is_not_done(tmp_path):
+    for match_content in (False, True):
+        ledger = UploadLedger(tmp_path / f'ledger{match_content}.sqlite',
+                              match_content)
+        first, second = write_sidecars(tmp_path)
+        ledger.record(first, 'P', 'sub-01', 'E1', 3, 'BIDS')
+        assert not ledger.is_done(second, {'project': 'P', 'subject': 'sub-02'})
+        for sidecar in (first, second):
+            sidecar.unlink()
+            sidecar.parent.rmdir()
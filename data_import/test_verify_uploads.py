@@ -0,0 +1,58 @@
+from pathlib import Path
+import synthetic_data
+from upload_ledger import UploadLedger
+from xnat_inventory import ProjectInventory
+from importer_core import run_import
+from import_wrap import WrapAdapter, load_clinical_data, notepad_project
+from verify_uploads import verify_experiment
+
+# Import a small WRAP tree into mock_xnat.py over the direct (not planned)
+# path with a ledger, then check every ledger row with verify_uploads,
+# as the verifier would after a real run.
+
+
+def import_wrap_tree(xnat_session, tmp_path):
+    in_dir = tmp_path / 'wrap'
+    synthetic_data.make_wrap_data(in_dir, 2, 1, image_bytes=64 * 1024)
+    # One scan gets diffusion gradients next to its sidecar
+    sidecar = sorted(in_dir.rglob('*_T1w.json'))[0]
+    for suffix in ('.bval', '.bvec'):
+        Path(str(sidecar).replace('.json', suffix)).write_text("0 1000 1000\n")
+
+    ledger = UploadLedger(tmp_path / 'ledger.sqlite')
+    frames = load_clinical_data(in_dir)
+    done_dir_insert_pos = len((in_dir / 'uploaded').parts) - 1
+    adapter = WrapAdapter(in_dir, done_dir_insert_pos, *frames)
+    scan_list = adapter.find_scans()
+    inventory = ProjectInventory(xnat_session, notepad_project)
+    failures = run_import(xnat_session, adapter, list(enumerate(scan_list)),
+                          inventory, ledger)
+    assert failures == {}
+    return(ledger)
+
+
+def verify_ledger(xnat_session, ledger):
+    rows_by_experiment = {}
+    for row in ledger.uploaded_files(notepad_project):
+        rows_by_experiment.setdefault(row['experiment'], []).append(row)
+    inventory = ProjectInventory(xnat_session, notepad_project)
+    problems = []
+    for experiment_label, rows in rows_by_experiment.items():
+        problems = problems + verify_experiment(xnat_session, inventory,
+                                                experiment_label, rows)
+    return(problems)
+
+
+def test_direct_import_verifies_clean(xnat_session, tmp_path):
+    ledger = import_wrap_tree(xnat_session, tmp_path)
+    uploaded = [Path(x['path']).suffix for x in ledger.uploaded_files(notepad_project)]
+    assert uploaded.count('.bval') == 1 and uploaded.count('.bvec') == 1
+    assert verify_ledger(xnat_session, ledger) == []
+
+
+def test_changed_file_is_reported(xnat_session, tmp_path):
+    ledger = import_wrap_tree(xnat_session, tmp_path)
+    bval_file = next((tmp_path / 'wrap').rglob('*.bval'))
+    bval_file.write_text("0 2000 2000\n")
+    assert verify_ledger(xnat_session, ledger) == [
+        (str(bval_file), 'checksum does not match')]
@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from file_digest import local_digests
+
+# Local record of what has been sent to XNAT.
+# Replaces moving files into an 'uploaded' directory (or deleting them)
+# as the way the importers remember their progress between runs.
+# Each row is keyed on the source path and carries the content hash
+# so a file that has been moved or touched is still recognised.
+# Whole-session transfers (DIAN) are tracked in their own table by label.
+
+ledger_schema = """
+CREATE TABLE IF NOT EXISTS uploads (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    project TEXT,
+    subject TEXT,
+    experiment TEXT,
+    scan TEXT,
+    resource TEXT,
+    status TEXT,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_sha256 ON uploads (sha256);
+CREATE INDEX IF NOT EXISTS uploads_size ON uploads (size);
+CREATE TABLE IF NOT EXISTS sessions (
+    project TEXT,
+    label TEXT,
+    state TEXT,
+    updated TEXT,
+    PRIMARY KEY (project, label)
+);
+"""
+
+
+# Columns that say where an upload went, in the order they nest
+target_columns = ('project', 'subject', 'experiment', 'scan', 'resource')
+
+
+def file_sha256(file_path):
+    # Files hashed while they were uploaded come from the digest cache
+    return(local_digests.sha256(file_path))
+
+
+class UploadLedger:
+    def __init__(self, db_path, match_content=False):
+        self.db_path = Path(db_path)
+        # Look for moved files by content alone, at the cost of hashing
+        # every file that has the size of something already uploaded
+        self.match_content = match_content
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Shared between upload workers, so serialise access ourselves
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.db_path),
+                                  check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.executescript(ledger_schema)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def merge(self, other_path):
+        # Copy in every row of another ledger, e.g. one a shard worker
+        # wrote. Returns the number of uploads copied
+        with self.lock:
+            self.db.execute("ATTACH DATABASE ? AS other", (str(other_path),))
+            try:
+                with self.db:
+                    n_rows = self.db.execute(
+                        "INSERT OR REPLACE INTO uploads SELECT * FROM other.uploads").rowcount
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO sessions SELECT * FROM other.sessions")
+            finally:
+                self.db.execute("DETACH DATABASE other")
+        return(n_rows)
+
+    def is_done(self, file_path, target=None):
+        """
+        True if this file has already been uploaded.
+        target is a dict with some of target_columns, e.g. the project
+        and subject the file belongs to. Another file only counts if it
+        went to the same place, so identical files of two subjects (a
+        shared template sidecar, say) are both uploaded.
+        A matching path, size and mtime answers straight from the index.
+        Otherwise the file is only hashed when an uploaded file of the
+        same size and name exists, to catch content that was moved or
+        touched. Files of one size are common (DICOM slices of a series
+        all are), so matching on size alone is left to match_content.
+        """
+        file_path = Path(file_path)
+        if not file_path.exists():
+            return False
+        stat = file_path.stat()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, sha256, status FROM uploads WHERE path = ?",
+                (str(file_path),)).fetchone()
+        if row is not None and row['status'] == 'uploaded' and \
+                row['size'] == stat.st_size and \
+                row['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        target = target or {}
+        target_query = "".join(f" AND {x} = ?" for x in target_columns
+                               if x in target)
+        target_args = tuple(None if target[x] is None else str(target[x])
+                            for x in target_columns if x in target)
+        # Only pay for a hash if something like this was uploaded
+        name_query = ""
+        query_args = (stat.st_size,)
+        if not self.match_content:
+            name_suffix = f"/{file_path.name}"
+            name_query = " AND substr(path, -?) = ?"
+            query_args = (stat.st_size, len(name_suffix), name_suffix)
+        with self.lock:
+            candidate = self.db.execute(
+                "SELECT 1 FROM uploads WHERE size = ? AND status = 'uploaded'"
+                + name_query + target_query + " LIMIT 1",
+                query_args + target_args).fetchone()
+        if candidate is None:
+            return False
+        content_hash = file_sha256(file_path)
+        with self.lock:
+            match = self.db.execute(
+                "SELECT 1 FROM uploads WHERE sha256 = ? AND size = ? AND status = 'uploaded'"
+                + target_query,
+                (content_hash, stat.st_size) + target_args).fetchone()
+        return match is not None
+
+    def record(self, file_path, project, subject, experiment,
+               scan=None, resource=None, status='uploaded'):
+        self.record_many([file_path], project, subject, experiment,
+                         scan, resource, status)
+
+    def record_many(self, file_list, project, subject, experiment,
+                    scan=None, resource=None, status='uploaded'):
+        # Hash outside the lock so other workers are not held up
+        rows = []
+        updated = datetime.now().isoformat(timespec='seconds')
+        for file_path in file_list:
+            file_path = Path(file_path)
+            stat = file_path.stat()
+            rows.append((str(file_path), stat.st_size, stat.st_mtime_ns,
+                         file_sha256(file_path),
+                         project, subject, experiment,
+                         None if scan is None else str(scan),
+                         resource, status, updated))
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO uploads VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                rows)
+
+    def uploaded_files(self, project):
+        # Every file recorded as uploaded to the project
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, subject, experiment, scan, resource FROM uploads "
+                "WHERE project = ? AND status = 'uploaded'",
+                (project,)).fetchall()
+        return([dict(row) for row in rows])
+
+    def session_state(self, project, label):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT state FROM sessions WHERE project = ? AND label = ?",
+                (project, label)).fetchone()
+        return None if row is None else row['state']
+
+    def mark_session(self, project, label, state):
+        updated = datetime.now().isoformat(timespec='seconds')
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?,?,?,?)",
+                (project, label, state, updated))
+
+    def sessions_in_state(self, project, state):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT label FROM sessions WHERE project = ? AND state = ?",
+                (project, state)).fetchall()
+        return(set(row['label'] for row in rows))
@@ -0,0 +1,340 @@
+import asyncio
+import io
+import threading
+import time
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+from run_metrics import metrics
+from file_digest import HashingReader, local_digests, matches_catalog
+
+# Sends the files for one XNAT resource in as few requests as makes sense.
+# Small files (BIDS sidecars, bval/bvec, small NIfTIs) are zipped together
+# and sent as one upload that XNAT extracts into the resource. Large files
+# are streamed from disk one at a time and retried if the upload fails.
+# How much is sent at once is limited by bytes in flight rather than by
+# a number of files, so a few multi-GB PET images can't swamp the link
+# while lots of small uploads still run side by side.
+# Every file is hashed as it is sent and checked against the MD5 in the
+# resource catalog once the resource is uploaded.
+# The importers share the module level scheduler object.
+
+# Files already compressed are stored in the bundle as they are
+compressed_suffixes = ('.gz', '.zip', '.bz2', '.xz')
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class StreamBody(io.RawIOBase):
+    # Upload body over an open stream, e.g. a SpooledTemporaryFile.
+    # requests asks a body without __len__ for its fileno() to size it,
+    # and that call rolls a spooled file over to disk, so the length is
+    # given here and fileno() is left unsupported
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.n_bytes = stream.seek(0, io.SEEK_END)
+        stream.seek(0)
+
+    def readable(self):
+        return(True)
+
+    def seekable(self):
+        return(True)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return(self.stream.seek(offset, whence))
+
+    def tell(self):
+        return(self.stream.tell())
+
+    def read(self, size=-1):
+        return(self.stream.read(size))
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return(len(chunk))
+
+    def __len__(self):
+        return(self.n_bytes)
+
+
+def send_stream(session, uri, stream, query, content_type, method='put'):
+    # xnatpy's upload() only takes real file objects and upload_stream()
+    # rewinds with seek(), so the body goes straight to requests,
+    # which reads any file-like in blocks with a Content-Length
+    if not hasattr(stream, '__len__'):
+        stream = StreamBody(stream)
+    send_request = session.interface.post if method == 'post' \
+        else session.interface.put
+    response = send_request(session._format_uri(uri, query=query),
+                            data=stream,
+                            headers={'Content-Type': content_type})
+    session._check_response(response, uri=uri)
+    return(response)
+
+
+class ByteBudget:
+    # Limits the bytes being uploaded at once across all threads.
+    # A file bigger than the whole budget waits until nothing else
+    # is in flight and then goes on its own
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, n_bytes):
+        n_bytes = min(n_bytes, self.max_bytes)
+        with self.condition:
+            while self.used_bytes > 0 and \
+                    self.used_bytes + n_bytes > self.max_bytes:
+                self.condition.wait()
+            self.used_bytes = self.used_bytes + n_bytes
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used_bytes = self.used_bytes - n_bytes
+                self.condition.notify_all()
+
+
+class UploadScheduler:
+    def __init__(self, max_bytes=512 * 1024 * 1024,
+                 small_file_bytes=16 * 1024 * 1024,
+                 retries=3, retry_wait=5):
+        self.budget = ByteBudget(max_bytes)
+        self.small_file_bytes = small_file_bytes
+        self.retries = retries
+        self.retry_wait = retry_wait
+
+    def configure(self, max_bytes=None, small_file_bytes=None, retries=None):
+        if max_bytes is not None:
+            self.budget = ByteBudget(max_bytes)
+        if small_file_bytes is not None:
+            self.small_file_bytes = small_file_bytes
+        if retries is not None:
+            self.retries = retries
+
+    def plan(self, src_files):
+        # Split into one bundle of small files and the files to send
+        # on their own. A single small file is not worth zipping
+        src_sizes = {x: x.stat().st_size for x in src_files}
+        bundle = [x for x in src_files if src_sizes[x] < self.small_file_bytes]
+        if len(bundle) < 2:
+            bundle = []
+        single = [x for x in src_files if x not in bundle]
+        return(bundle, single, src_sizes)
+
+    def upload(self, session, resource_uri, src_files):
+        """
+        Upload src_files into the resource at resource_uri and check
+        them against the MD5s in its catalog. Raises if a file could not
+        be sent after all the retries, or still does not match once sent
+        again on its own.
+        """
+        bundle, single, src_sizes = self.plan(list(src_files))
+        if bundle:
+            self.upload_bundle(session, resource_uri, bundle)
+        for src_file in single:
+            self.upload_single(session, resource_uri, src_file,
+                               src_sizes[src_file])
+        bad_files = self.verify(session, resource_uri, bundle + single)
+        for src_file in bad_files:
+            print(f"[WARNING] {src_file.name} does not match the catalog, sending it again")
+            self.upload_single(session, resource_uri, src_file,
+                               src_sizes[src_file])
+        if bad_files and self.verify(session, resource_uri, bad_files):
+            raise ChecksumError(f"Files in {resource_uri} do not match the local copies")
+
+    def send(self, session, uri, stream, query, content_type):
+        return(send_stream(session, uri, stream, query, content_type))
+
+    def make_bundle(self, src_files):
+        # Zip of src_files to be extracted into the resource, and its name
+        zip_stream = SpooledTemporaryFile(max_size=4 * self.small_file_bytes)
+        with ZipFile(zip_stream, 'w') as bundle_zip:
+            for src_file in src_files:
+                self.add_to_bundle(bundle_zip, src_file)
+        bundle_name = f"{src_files[0].name.split('.')[0]}_bundle.zip"
+        return(zip_stream, bundle_name)
+
+    def upload_bundle(self, session, resource_uri, src_files):
+        zip_stream, bundle_name = self.make_bundle(src_files)
+        with zip_stream:
+            n_bytes = zip_stream.tell()
+            uri = f"{resource_uri}/files/{bundle_name}"
+            with self.budget.reserve(n_bytes):
+                self.with_retries(
+                    bundle_name,
+                    lambda attempt: self.send_bundle(session, uri, zip_stream))
+        metrics.count('upload_bundles')
+        metrics.count('files_uploaded', len(src_files))
+
+    def add_to_bundle(self, bundle_zip, src_file):
+        # Hashed as it is copied into the zip
+        zip_info = ZipInfo.from_file(src_file, src_file.name)
+        zip_info.compress_type = ZIP_DEFLATED
+        if src_file.suffix in compressed_suffixes:
+            zip_info.compress_type = ZIP_STORED
+        with open(src_file, 'rb') as src_stream, \
+                bundle_zip.open(zip_info, 'w') as zip_entry:
+            reader = HashingReader(src_stream, zip_info.file_size)
+            for chunk in reader:
+                zip_entry.write(chunk)
+        local_digests.store(src_file, *reader.digests())
+
+    def send_bundle(self, session, uri, zip_stream):
+        zip_stream.seek(0)
+        with metrics.span('upload_bundle'):
+            self.send(session, uri, zip_stream,
+                      {'extract': 'true', 'overwrite': 'true'},
+                      'application/zip')
+
+    def upload_single(self, session, resource_uri, src_file, n_bytes):
+        uri = f"{resource_uri}/files/{src_file.name}"
+        with self.budget.reserve(n_bytes):
+            self.with_retries(
+                src_file.name,
+                lambda attempt: self.send_single(session, resource_uri, uri,
+                                                 src_file, n_bytes, attempt))
+        metrics.count('files_uploaded')
+
+    def send_single(self, session, resource_uri, uri, src_file, n_bytes,
+                    attempt=0):
+        # requests streams the file in blocks rather than reading
+        # it all in, and the MD5 is worked out on the way. XNAT has no
+        # ranged uploads, so a retry resumes at the file: if the server
+        # kept the whole file before the connection dropped it is not
+        # sent again
+        if attempt > 0:
+            remote_file = self.remote_files(session, resource_uri).get(src_file.name)
+            if remote_file is not None and \
+                    matches_catalog(src_file, *remote_file):
+                print(f"{src_file.name} is already on the server")
+                return
+        with open(src_file, 'rb') as src_stream, metrics.span('upload'):
+            reader = HashingReader(src_stream, n_bytes)
+            self.send(session, uri, reader, {'overwrite': 'true'},
+                      'application/octet-stream')
+        local_digests.store(src_file, *reader.digests())
+
+    def remote_files(self, session, resource_uri):
+        # Name -> (size, MD5) from the resource catalog, without any file
+        # contents. The MD5 is empty if the server does not keep checksums
+        try:
+            listing = session.get_json(f"{resource_uri}/files")
+        except Exception:
+            return({})
+        return({x["Name"]: (int(x["Size"]), x.get("digest") or "")
+                for x in listing["ResultSet"]["Result"]})
+
+    def verify(self, session, resource_uri, src_files):
+        # Files that are missing from the catalog or differ from it
+        with metrics.span('verify'):
+            remote = self.remote_files(session, resource_uri)
+        bad_files = []
+        for src_file in src_files:
+            remote_file = remote.get(src_file.name)
+            if remote_file is None or not matches_catalog(src_file, *remote_file):
+                metrics.count('checksum_mismatches')
+                bad_files.append(src_file)
+            else:
+                metrics.count('files_verified')
+        return(bad_files)
+
+    def with_retries(self, name, send_function):
+        for attempt in range(self.retries + 1):
+            try:
+                return send_function(attempt)
+            except Exception as error:
+                if attempt == self.retries:
+                    raise
+                wait = self.retry_wait * 2 ** attempt
+                print(f"[WARNING] Upload of {name} failed ({type(error).__name__}: {error}), "
+                      f"retry {attempt + 1} of {self.retries} in {wait}s")
+                metrics.count('upload_retries')
+                time.sleep(wait)
+
+    # The same over an async_xnat.AsyncXnatSession. The session's cap on
+    # requests in flight stands in for the byte budget, which is
+    # made for threads and would block the event loop
+
+    async def upload_async(self, session, resource_uri, src_files):
+        bundle, single, src_sizes = self.plan(list(src_files))
+        if bundle:
+            zip_stream, bundle_name = await asyncio.to_thread(self.make_bundle,
+                                                              bundle)
+            with zip_stream:
+                with metrics.span('upload_bundle'):
+                    await self.with_retries_async(
+                        bundle_name,
+                        lambda attempt: session.upload_stream(
+                            f"{resource_uri}/files/{bundle_name}", zip_stream,
+                            {'extract': 'true', 'overwrite': 'true'}))
+            metrics.count('upload_bundles')
+            metrics.count('files_uploaded', len(bundle))
+        for src_file in single:
+            await self.upload_single_async(session, resource_uri, src_file)
+        bad_files = await self.verify_async(session, resource_uri, bundle + single)
+        for src_file in bad_files:
+            print(f"[WARNING] {src_file.name} does not match the catalog, sending it again")
+            await self.upload_single_async(session, resource_uri, src_file)
+        if bad_files and await self.verify_async(session, resource_uri, bad_files):
+            raise ChecksumError(f"Files in {resource_uri} do not match the local copies")
+
+    async def upload_single_async(self, session, resource_uri, src_file):
+        async def send_single(attempt):
+            if attempt > 0:
+                remote = await self.remote_files_async(session, resource_uri)
+                remote_file = remote.get(src_file.name)
+                if remote_file is not None and \
+                        matches_catalog(src_file, *remote_file):
+                    print(f"{src_file.name} is already on the server")
+                    return
+            with metrics.span('upload'):
+                await session.upload_file(f"{resource_uri}/files/{src_file.name}",
+                                          src_file, {'overwrite': 'true'})
+
+        await self.with_retries_async(src_file.name, send_single)
+        metrics.count('files_uploaded')
+
+    async def remote_files_async(self, session, resource_uri):
+        try:
+            rows = await session.result_rows(f"{resource_uri}/files")
+        except Exception:
+            return({})
+        return({x["Name"]: (int(x["Size"]), x.get("digest") or "")
+                for x in rows})
+
+    async def verify_async(self, session, resource_uri, src_files):
+        with metrics.span('verify'):
+            remote = await self.remote_files_async(session, resource_uri)
+        bad_files = []
+        for src_file in src_files:
+            remote_file = remote.get(src_file.name)
+            if remote_file is None or not matches_catalog(src_file, *remote_file):
+                metrics.count('checksum_mismatches')
+                bad_files.append(src_file)
+            else:
+                metrics.count('files_verified')
+        return(bad_files)
+
+    async def with_retries_async(self, name, send_function):
+        for attempt in range(self.retries + 1):
+            try:
+                return await send_function(attempt)
+            except Exception as error:
+                if attempt == self.retries:
+                    raise
+                wait = self.retry_wait * 2 ** attempt
+                print(f"[WARNING] Upload of {name} failed ({type(error).__name__}: {error}), "
+                      f"retry {attempt + 1} of {self.retries} in {wait}s")
+                metrics.count('upload_retries')
+                await asyncio.sleep(wait)
+
+
+scheduler = UploadScheduler()
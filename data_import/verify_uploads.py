@@ -0,0 +1,107 @@
+import argparse
+import sys
+from pathlib import Path
+from xnat_sessions import xnat_sessions
+from upload_ledger import UploadLedger
+from xnat_inventory import ProjectInventory, get_result_rows
+from file_digest import local_digests, matches_catalog
+from run_metrics import metrics
+
+# Check that what the ledger says was uploaded to a project is on XNAT
+# and matches the local files. Only the catalog listing of each session
+# is fetched (names, sizes and MD5s, never file contents), and local
+# files are only hashed if they have changed since the digest cache
+# last saw them, so this can be run over a whole project often.
+# DICOM sent through the import service is rewritten on the way in,
+# so for those only the presence of the scan's DICOM is checked.
+
+# Host for the xnat where data is going
+xnat_host = "https://xnat-srv.drc.ion.ucl.ac.uk"
+
+
+def catalog_files(xnat_session, inventory, experiment_label):
+    # (scan, resource, file name) -> (size, MD5) for a whole session
+    file_rows = get_result_rows(
+        xnat_session,
+        f"{inventory.experiment_uri(experiment_label)}/scans/ALL/files",
+        {"format": "json"})
+    files = {}
+    for row in file_rows:
+        uri_parts = row["URI"].split('/')
+        scan_id = uri_parts[uri_parts.index('scans') + 1]
+        files[(scan_id, row["collection"], row["Name"])] = (
+            int(row["Size"]), row.get("digest") or "")
+    return(files)
+
+
+def verify_experiment(xnat_session, inventory, experiment_label, ledger_rows):
+    # Returns a list of (path, problem)
+    if not inventory.has_experiment(experiment_label):
+        return([(x['path'], 'session not on XNAT') for x in ledger_rows])
+    with metrics.span('catalog'):
+        files = catalog_files(xnat_session, inventory, experiment_label)
+    dicom_scans = set(x[0] for x in files if x[1] == 'DICOM')
+    problems = []
+    for row in ledger_rows:
+        local_path = Path(row['path'])
+        if row['resource'] == 'DICOM':
+            if not dicom_scans:
+                problems.append((row['path'], 'no DICOM on XNAT'))
+            continue
+        if not local_path.exists():
+            metrics.count('missing_locally')
+            continue
+        remote_file = files.get((row['scan'], row['resource'], local_path.name))
+        if remote_file is None:
+            problems.append((row['path'], 'not in the catalog'))
+            continue
+        with metrics.span('local_digest'):
+            file_ok = matches_catalog(local_path, *remote_file)
+        if not file_ok:
+            problems.append((row['path'], 'checksum does not match'))
+        else:
+            metrics.count('files_verified')
+    return(problems)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Check uploads recorded in a ledger against the XNAT catalog')
+    parser.add_argument('--project', type=str, required=True,
+                        help='XNAT project to check, e.g. NOTEPAD_WRAP')
+    parser.add_argument('--ledger', type=str, required=True,
+                        help='SQLite ledger the importer recorded its uploads in')
+    parser.add_argument('--digest_cache', type=str, default=None,
+                        help='SQLite file of local checksums, shared with the importers')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write stage timings and REST call counts to this JSON (or .csv) file at the end of the run')
+    args = parser.parse_args()
+    metrics.start('verify_uploads', args.metrics)
+    if args.digest_cache is not None:
+        local_digests.open(args.digest_cache)
+
+    ledger = UploadLedger(args.ledger)
+    ledger_rows = ledger.uploaded_files(args.project)
+    rows_by_experiment = {}
+    for row in ledger_rows:
+        rows_by_experiment.setdefault(row['experiment'], []).append(row)
+    print(f"{len(ledger_rows)} files in {len(rows_by_experiment)} sessions to check")
+
+    problems = []
+    with xnat_sessions.connect(xnat_host) as xnat_session:
+        with metrics.span('inventory'):
+            inventory = ProjectInventory(xnat_session, args.project)
+        for experiment_label in sorted(rows_by_experiment):
+            problems = problems + verify_experiment(
+                xnat_session, inventory, experiment_label,
+                rows_by_experiment[experiment_label])
+
+    for file_path, problem in problems:
+        print(f"[ERROR] {file_path}: {problem}")
+    print(f"{len(problems)} problems found")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import threading
+
+# Snapshot of what is already in an XNAT project.
+# Built from a few bulk listing queries (the same way
+# import_dian.get_session_list asks for experiments with columns)
+# so the importers can check for subjects, experiments, scans and
+# resources from memory instead of walking lazy xnatpy collections,
+# where every "x in collection" turns into more REST calls.
+# Build it once per run. Anything the importer makes is added to it as
+# it goes, and refresh_subject picks up the sessions the import
+# service has archived for one subject without listing the project again.
+
+scan_id_column = "xnat:imagescandata/id"
+
+
+def get_result_rows(xnat_session, uri, query):
+    response_json = xnat_session.get_json(uri, query=query)
+    if response_json is None:
+        return([])
+    return(response_json["ResultSet"]["Result"])
+
+
+class ProjectInventory:
+    def __init__(self, xnat_session, project, load=True):
+        self.session = xnat_session
+        self.project = project
+        self.lock = threading.Lock()
+        # Subject label -> ID
+        self.subjects = {}
+        # Experiment label -> dict with ID, subject label and xsiType
+        self.experiments = {}
+        # Experiment label -> set of scan IDs
+        self.scans = {}
+        # (Experiment label, scan ID) -> set of resource labels
+        # Filled in one experiment at a time, only when asked for
+        self.resources = {}
+        self.resources_loaded = set()
+        if load:
+            self.refresh()
+
+    def experiment_listing(self, experiments_uri):
+        # Experiments and their scan IDs, from one listing with
+        # columns and one with a row per scan
+        experiments = {}
+        scans = {}
+        experiment_rows = get_result_rows(
+            self.session,
+            experiments_uri,
+            {"columns": "ID,label,subject_label,xsiType"})
+        scan_rows = get_result_rows(
+            self.session,
+            experiments_uri,
+            {"columns": f"label,{scan_id_column}"})
+        for row in experiment_rows:
+            experiments[row["label"]] = {
+                "ID": row["ID"],
+                "subject_label": row["subject_label"],
+                "xsiType": row["xsiType"],
+            }
+            scans[row["label"]] = set()
+        for row in scan_rows:
+            scan_id = row.get(scan_id_column)
+            if scan_id and row["label"] in scans:
+                scans[row["label"]].add(str(scan_id))
+        return(experiments, scans)
+
+    def refresh(self):
+        print(f"Fetching inventory of {self.project}")
+        subject_rows = get_result_rows(
+            self.session,
+            f"/data/projects/{self.project}/subjects",
+            {"columns": "ID,label"})
+        subjects = {row["label"]: row["ID"] for row in subject_rows}
+        experiments, scans = self.experiment_listing(
+            f"/data/projects/{self.project}/experiments")
+        with self.lock:
+            self.subjects = subjects
+            self.experiments = experiments
+            self.scans = scans
+            self.resources = {}
+            self.resources_loaded = set()
+        print(f"{len(subjects)} subjects, {len(experiments)} experiments, "
+              f"{sum(len(x) for x in scans.values())} scans")
+
+    def refresh_subject(self, subject_label):
+        # Pick up one subject's sessions, e.g. once the import service
+        # has archived them, with two listings of that subject only
+        experiments, scans = self.experiment_listing(
+            f"/data/projects/{self.project}/subjects/{subject_label}/experiments")
+        for experiment_label, experiment in experiments.items():
+            with self.lock:
+                known = self.experiments.get(experiment_label)
+            if known is None:
+                self.register_experiment(experiment_label, experiment["ID"],
+                                         subject_label, experiment["xsiType"],
+                                         new=False)
+            for scan_id in scans[experiment_label]:
+                self.add_scan(experiment_label, scan_id)
+
+    def has_subject(self, subject_label):
+        with self.lock:
+            return subject_label in self.subjects
+
+    def add_subject(self, subject_label, subject_id=None):
+        with self.lock:
+            if subject_id or subject_label not in self.subjects:
+                self.subjects[subject_label] = subject_id
+
+    def subject_object(self, subject_label):
+        # xnatpy caches objects by ID. Before the ID is known the
+        # label stands in, the URI works either way
+        with self.lock:
+            subject_id = self.subjects.get(subject_label) or subject_label
+        return self.session.create_object(
+            f"/data/projects/{self.project}/subjects/{subject_label}",
+            type_="xnat:subjectData", id_=subject_id)
+
+    def has_experiment(self, experiment_label):
+        with self.lock:
+            return experiment_label in self.experiments
+
+    def add_experiment(self, xnat_experiment, subject_label):
+        self.register_experiment(xnat_experiment.label, xnat_experiment.id,
+                                 subject_label, xnat_experiment.__xsi_type__)
+
+    def register_experiment(self, experiment_label, experiment_id,
+                            subject_label, xsi_type, new=True):
+        # For a session created by REST, where only its ID came back.
+        # A new session has no resources to look up
+        with self.lock:
+            self.experiments[experiment_label] = {
+                "ID": experiment_id,
+                "subject_label": subject_label,
+                "xsiType": xsi_type,
+            }
+            self.scans.setdefault(experiment_label, set())
+            if new:
+                self.resources_loaded.add(experiment_label)
+
+    def experiment_uri(self, experiment_label):
+        return f"/data/experiments/{self.experiments[experiment_label]['ID']}"
+
+    def experiment_object(self, experiment_label):
+        with self.lock:
+            experiment = self.experiments[experiment_label]
+            uri = self.experiment_uri(experiment_label)
+        return self.session.create_object(uri, type_=experiment["xsiType"],
+                                          id_=experiment["ID"])
+
+    def has_scan(self, experiment_label, scan_id):
+        with self.lock:
+            return str(scan_id) in self.scans.get(experiment_label, ())
+
+    def add_scan(self, experiment_label, scan_id):
+        with self.lock:
+            self.scans.setdefault(experiment_label, set()).add(str(scan_id))
+
+    def scan_object(self, experiment_label, scan_id, xsi_type):
+        with self.lock:
+            uri = f"{self.experiment_uri(experiment_label)}/scans/{scan_id}"
+        return self.session.create_object(uri, type_=xsi_type,
+                                          id_=str(scan_id))
+
+    def load_resources(self, experiment_label):
+        # The session document lists the resources of every scan,
+        # including empty ones that a files listing would not show
+        with self.lock:
+            if experiment_label in self.resources_loaded:
+                return
+            uri = self.experiment_uri(experiment_label)
+        experiment_json = self.session.get_json(uri)
+        resources = {}
+        for item in experiment_json["items"]:
+            for child in item.get("children", []):
+                if child["field"] != "scans/scan":
+                    continue
+                for scan in child["items"]:
+                    scan_key = (experiment_label, str(scan["data_fields"]["ID"]))
+                    labels = resources.setdefault(scan_key, set())
+                    for scan_child in scan.get("children", []):
+                        if scan_child["field"] == "file":
+                            labels.update(x["data_fields"]["label"]
+                                          for x in scan_child["items"]
+                                          if x["data_fields"].get("label"))
+        with self.lock:
+            self.resources.update(resources)
+            self.resources_loaded.add(experiment_label)
+
+    def has_resource(self, experiment_label, scan_id, resource_label):
+        if not self.has_experiment(experiment_label):
+            return False
+        self.load_resources(experiment_label)
+        with self.lock:
+            return resource_label in self.resources.get(
+                (experiment_label, str(scan_id)), ())
+
+    def add_resource(self, experiment_label, scan_id, resource_label):
+        with self.lock:
+            self.resources.setdefault(
+                (experiment_label, str(scan_id)), set()).add(resource_label)
+
+    def resource_uri(self, experiment_label, scan_id, resource_label):
+        with self.lock:
+            return f"{self.experiment_uri(experiment_label)}/scans/{scan_id}/resources/{resource_label}"
+
+    def resource_object(self, experiment_label, scan_id, resource_label):
+        uri = self.resource_uri(experiment_label, scan_id, resource_label)
+        return self.session.create_object(uri, type_="xnat:resourceCatalog",
+                                          id_=resource_label)
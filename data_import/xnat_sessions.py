@@ -0,0 +1,130 @@
+import atexit
+import threading
+from contextlib import contextmanager
+import xnat
+from run_metrics import metrics
+from parallel_upload import tune_connection_pool
+
+# One logged in XNAT session per host for the whole process.
+# xnat.connect logs in (TLS handshake and password check) every time
+# it is called, so the importers ask the shared xnat_sessions object
+# for a session instead and it hands back the one already open.
+# The JSESSIONID from the first login is reused by every request and
+# every worker thread. If the server lets it expire, the next request
+# that gets a 401 logs in again and is sent once more. The HTTP
+# connection pool behind each session is grown to the most workers
+# any caller asked for, so idle connections are kept alive for reuse
+# instead of being dropped when the pool is full.
+# Sessions are closed when the process exits.
+
+login_path = '/data/JSESSION'
+
+
+class SessionManager:
+    def __init__(self, pool_size=10):
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        # Host -> session, host -> connections in its pool
+        self.sessions = {}
+        self.pool_sizes = {}
+        self.login_locks = {}
+        atexit.register(self.close_all)
+
+    def configure(self, pool_size=None):
+        if pool_size is not None:
+            self.pool_size = pool_size
+
+    def get(self, host, pool_size=None, **connect_args):
+        """
+        The session for host, connecting the first time it is asked for.
+        connect_args go to xnat.connect and only count for that first call.
+        """
+        host = host.rstrip('/')
+        with self.lock:
+            xnat_session = self.sessions.get(host)
+            if xnat_session is None:
+                print(f"Connecting to {host}")
+                with metrics.span('connect'):
+                    xnat_session = xnat.connect(host, **connect_args)
+                metrics.attach(xnat_session)
+                self.login_locks[host] = threading.Lock()
+                xnat_session.interface.hooks['response'].append(
+                    lambda response, *args, **kwargs: self.relogin_hook(
+                        host, xnat_session, response, **kwargs))
+                self.sessions[host] = xnat_session
+                self.pool_sizes[host] = 0
+        self.ensure_pool(xnat_session, pool_size or self.pool_size)
+        return(xnat_session)
+
+    @contextmanager
+    def connect(self, host, pool_size=None, **connect_args):
+        # Stands in for "with xnat.connect(host) as xnat_session".
+        # The session is left open for the next caller
+        yield self.get(host, pool_size, **connect_args)
+
+    def ensure_pool(self, xnat_session, pool_size):
+        # Only ever grows the pool, remounting drops open connections
+        with self.lock:
+            host = self.host_of(xnat_session)
+            if host is None or self.pool_sizes[host] >= pool_size:
+                return
+            tune_connection_pool(xnat_session, pool_size)
+            self.pool_sizes[host] = pool_size
+
+    def host_of(self, xnat_session):
+        for host, open_session in self.sessions.items():
+            if open_session is xnat_session:
+                return(host)
+        return(None)
+
+    def cookies(self, host):
+        # Cookies of the open session for host, so another transport
+        # can use the same login. None if there is no session yet
+        xnat_session = self.sessions.get(host.rstrip('/'))
+        if xnat_session is None:
+            return None
+        return(xnat_session.interface.cookies.get_dict())
+
+    def relogin_hook(self, host, xnat_session, response, **send_args):
+        request = response.request
+        if response.status_code != 401 or \
+                request.url.split('?')[0].endswith(login_path) or \
+                getattr(request, 'relogin', False):
+            return(response)
+        interface = xnat_session.interface
+        sent_cookie = request.headers.get('Cookie', '')
+        with self.login_locks[host]:
+            # Another thread may have logged in while this request
+            # was out, in which case its session is used as it is
+            jsession_id = interface.cookies.get('JSESSIONID')
+            if jsession_id is None or f"JSESSIONID={jsession_id}" in sent_cookie:
+                print(f"[WARNING] Session on {host} has expired, logging in again")
+                metrics.count('relogins')
+                interface.post(f"{host}{login_path}")
+        # A streamed body has already been read. It is sent again from
+        # the start if it can be rewound (open files, spooled zips,
+        # HashingReader), otherwise the caller's retry uses the new session
+        body = request.body
+        if body is not None and not isinstance(body, (bytes, str)):
+            if not (hasattr(body, 'seekable') and body.seekable()):
+                return(response)
+            body.seek(0)
+        retry_request = request.copy()
+        retry_request.relogin = True
+        retry_request.headers.pop('Cookie', None)
+        retry_request.prepare_cookies(interface.cookies)
+        return(interface.send(retry_request, **send_args))
+
+    def close_all(self):
+        with self.lock:
+            open_sessions = list(self.sessions.values())
+            self.sessions = {}
+            self.pool_sizes = {}
+        for xnat_session in open_sessions:
+            try:
+                xnat_session.disconnect()
+            except Exception as e:
+                print(f"[WARNING] Could not close XNAT session: {e}")
+
+
+xnat_sessions = SessionManager()